@@ -17,6 +17,7 @@ import hashlib
 import json
 import logging
 import traceback
+import time
 import ConfigParser
 
 from pyramid.config import Configurator
@@ -44,6 +45,7 @@ from . objects.endpoint import EndpointNotFound
 from . zookeeper.connection import ZookeeperException
 from . zookeeper.client import ZookeeperClient
 from . zookeeper.cache import Cache
+from . zookeeper.cache import Mirror
 
 def authorized(forbidden_view=None, allow_endpoint=False):
     """
@@ -128,6 +130,7 @@ class ReactorApi(Atomic):
         self.zkobj = Reactor(self.client)
         self.config = Configurator()
         self._lookup_cache = None
+        self._active_mirror = None
         self._endpoints_zkobj = self.zkobj.endpoints()
 
         # Set up auth-ticket authentication.
@@ -261,6 +264,7 @@ class ReactorApi(Atomic):
 
     def disconnect(self):
         self._lookup_cache = None
+        self._active_mirror = None
         self.client.disconnect()
 
     def connect(self):
@@ -268,6 +272,10 @@ class ReactorApi(Atomic):
         self._lookup_cache = Cache(
             self.zkobj.endpoint_ips(),
             populate=self._endpoint_name_for_ip)
+        if self._active_mirror is None:
+            # NOTE: This is called for every request, so we hold
+            # on to the mirror until we are explicitly disconnected.
+            self._active_mirror = Mirror(self.zkobj.managers().active())
         self._endpoints_zkobj.list(watch=self._endpoint_names_purge)
 
     def _endpoint_name_for_ip(self, ip):
@@ -497,7 +505,10 @@ class ReactorApi(Atomic):
     @authorized()
     def handle_info_action(self, context, request):
         if request.method == "GET":
-            active = self.zkobj.managers().active_count()
+            active = sum([
+                count or 0
+                for count in self._active_mirror.as_map().values()
+            ])
             endpoint_states = self.zkobj.endpoints().state_counts()
             instances = len(self.zkobj.endpoint_ips().list())
             managers = len(self.zkobj.managers().list_active())
@@ -688,10 +699,15 @@ class ReactorApi(Atomic):
             state = endpoint.state().current()
             active = endpoint.active
             manager = endpoint.manager
+            schedule = endpoint.schedule
+            if schedule:
+                # Note how far behind the schedule we are.
+                schedule['lag'] = max(0.0, time.time() - schedule.get('next', 0))
             value = {
                 'state': state,
                 'active': active or [],
                 'manager': manager or None,
+                'schedule': schedule or None,
             }
             return Response(body=json.dumps(value))
 
@@ -20,6 +20,7 @@ import traceback
 import math
 
 from . import utils
+from . import scheduler
 from . atomic import Atomic
 from . config import Config
 from . submodules import cloud_submodules, cloud_options
@@ -93,6 +94,12 @@ class EndpointConfig(Config):
             Config.error("Timeout must be positive."),
         description="Timeout for unknown instances.")
 
+    interval = Config.integer(label="Update Interval (s)",
+        default=0, order=2,
+        validate=lambda self: self.interval >= 0 or \
+            Config.error("Interval must be non-negative."),
+        description="Period for updates (zero to adapt automatically).")
+
     auth_hash = Config.string(label="Auth Hash Token", default=None, order=3,
         description="The authentication token for this endpoint.")
 
@@ -201,6 +208,11 @@ class ScalingConfig(Config):
             Config.error("Ramp limit must be positive."),
         description="The maximum operations (start and stop instances) per round.")
 
+    spare = Config.integer(label="Hot Spares", default=0, order=3,
+        validate=lambda self: self.spare >= 0 or \
+            Config.error("Hot spares must be zero or greater."),
+        description="Idle instances to keep ready for new (exclusive) connections.")
+
 def _as_ip(ips):
     if isinstance(ips, list):
         return len(ips) > 0 and ips[0] or "unknown"
@@ -225,6 +237,8 @@ class EndpointLog(EventLog):
         lambda args: "Target number of instances has changed: %d => %d" % (args[0], args[1]))
     METRICS_CONFLICT = Event(
         lambda args: "Scaling rules conflict detected.")
+    INVALID_RULES = Event(
+        lambda args: "Ignoring invalid scaling rules: %s" % args[0])
     CONFIG_UPDATED = Event(
         lambda args: "Configuration reloaded.")
     RECOMMISSION_INSTANCE = Event(
@@ -270,7 +284,8 @@ class Endpoint(Atomic):
     def __init__(self, zkobj,
                  collect=None,
                  find_cloud_connection=None,
-                 find_loadbalancer_connection=None):
+                 find_loadbalancer_connection=None,
+                 changed=None):
         super(Endpoint, self).__init__()
 
         # Our zookeeper object.
@@ -280,6 +295,10 @@ class Endpoint(Atomic):
         self._collect = utils.callback(collect)
         self._find_cloud_connection = utils.callback(find_cloud_connection)
         self._find_loadbalancer_connection = utils.callback(find_loadbalancer_connection)
+        self._changed = utils.callback(changed)
+
+        # Whether we have instances in transition (see _health_check()).
+        self._settling = False
 
         # Initialize endpoint-specific logging.
         self.logging = EndpointLog(zkobj.log())
@@ -290,6 +309,7 @@ class Endpoint(Atomic):
         # Initialize configuration.
         self.config = EndpointConfig()
         self.scaling = ScalingConfig()
+        self.rules = metric_calculator.RuleProgram(self.scaling.rules)
 
         # Instances is a cache which maps instances to their names.
         self.instances = Cache(self.zkobj.instances(), update=self._clear_cloud_cache)
@@ -365,6 +385,7 @@ class Endpoint(Atomic):
     # called by the cache whenever the confirmed IPs change.
     def _update_confirmed(self):
         self.reload()
+        self._changed(self.uuid(), scheduler.CONFIRMED)
 
     def uuid(self):
         return self.zkobj.uuid()
@@ -384,18 +405,24 @@ class Endpoint(Atomic):
             return utils.sha_hash("uuid:%s" % self.uuid())
 
     def managed(self, uuid):
-        # Mark that this is our manager.
-        # NOTE: This is really for informational
-        # purposes only, we don't make any decisions
-        # internally on whether or not we will call
-        # update() based on this uuid etc.
-        self.zkobj.manager = uuid
+        # Take the lease for the given manager.
+        # NOTE: This returns False if some other manager
+        # still holds the lease (i.e. it hasn't finished
+        # handing the endpoint off yet). Callers must not
+        # call update() on this endpoint until it succeeds.
+        return self.zkobj.acquire(uuid)
+
+    def unmanaged(self, uuid):
+        # Give up the lease (if we hold it).
+        return self.zkobj.release(uuid)
 
     def update(self,
                metrics=None,
                metric_instances=None,
                active_ports=None,
-               update_interval=None):
+               update_interval=None,
+               schedule=None,
+               pending=0):
         """
         Update the endpoint based on current metrics and
         active instances. This will launch new instances or
@@ -415,6 +442,8 @@ class Endpoint(Atomic):
             # by the API for debugging purposes, etc.
             self.zkobj.metrics = metrics
             self.zkobj.active = active_ports
+            if schedule is not None:
+                self.zkobj.schedule = schedule
 
             # Get our cloud connection.
             cloud_conn = self._find_cloud_connection(self.config.cloud)
@@ -440,7 +469,8 @@ class Endpoint(Atomic):
                                 active_ids=active_ids,
                                 inactive_ids=inactive_ids,
                                 metrics=metrics,
-                                metric_instances=metric_instances)
+                                metric_instances=metric_instances,
+                                pending=pending)
 
         except Exception, e:
             traceback.print_exc()
@@ -455,8 +485,7 @@ class Endpoint(Atomic):
 
         # Evaluate the metrics on these instances and get the ideal bounds on
         # the number of servers that should exist.
-        ideal_min, ideal_max = metric_calculator.calculate_ideal_uniform(
-                self.scaling.rules, metrics, num_instances)
+        ideal_min, ideal_max = self.rules.evaluate(metrics, num_instances)
         if ideal_max < ideal_min:
             # Either the metrics are undefined or have conflicting answers. We simply
             # return this conflicting result.
@@ -494,7 +523,8 @@ class Endpoint(Atomic):
                 active_ids,
                 inactive_ids,
                 metrics,
-                metric_instances):
+                metric_instances,
+                pending=0):
         """
         Launch new instances, decommission instances, etc.
         """
@@ -524,6 +554,17 @@ class Endpoint(Atomic):
                 # midpoint in the target range.
                 target = (target_min + target_max) / 2
 
+            if self.scaling.spare > 0:
+                # Keep a pool of hot spares on top of the instances that
+                # are busy (holding connections) and the connections that
+                # are waiting. Instances without connections count as
+                # spares, even if they are still booting -- they will be
+                # confirmed soon enough, and launching more won't help.
+                busy = len(set(active_ids).intersection(instances))
+                wanted = min(busy + pending + self.scaling.spare,
+                             self.scaling.max_instances)
+                target = max(target, wanted)
+
         elif self.state == State.stopped:
             target = 0
             ramp_limit = sys.maxint
@@ -614,6 +655,7 @@ class Endpoint(Atomic):
             self.logging.info(self.logging.ENDPOINT_PAUSED)
         elif state == State.stopped:
             self.logging.info(self.logging.ENDPOINT_STOPPED)
+        self._changed(self.uuid(), scheduler.STATE)
 
     @Atomic.sync
     def _update_config(self, config_val):
@@ -628,6 +670,7 @@ class Endpoint(Atomic):
         old_loadbalancer = self.config.loadbalancer
         new_config = EndpointConfig(values=config_val)
         new_scaling = ScalingConfig(obj=new_config)
+        new_rules = metric_calculator.RuleProgram(new_scaling.rules)
         new_url = new_config.url
         new_loadbalancer = new_config.loadbalancer
 
@@ -643,8 +686,14 @@ class Endpoint(Atomic):
             self.reload(exclude=True)
 
         # Reload the configuration.
+        # NOTE: The scaling rules are compiled here, once, rather
+        # than each time through update(). So this is the place to
+        # complain about any rules that we don't understand.
         self.config = new_config
         self.scaling = new_scaling
+        self.rules = new_rules
+        if new_rules.errors():
+            self.logging.warn(self.logging.INVALID_RULES, new_rules.errors())
 
         # We can't really know if loadbalancer settings
         # have changed in the backend, so we really need
@@ -654,6 +703,7 @@ class Endpoint(Atomic):
     def update_config(self, config_val):
         self._update_config(config_val)
         self.logging.info(self.logging.CONFIG_UPDATED)
+        self._changed(self.uuid(), scheduler.CONFIG)
 
     def _recommission_instances(self, num_instances, reason):
         """
@@ -692,8 +742,9 @@ class Endpoint(Atomic):
         """
         Drop the instances from the system.
         """
-        # It might be good to wait a little bit for the servers
-        # to clear out any requests they are currently serving.
+        # Connections that are in flight are not cut off here. The
+        # loadbalancer may drain them, and the health check will not
+        # delete the instance while its backends are reported active.
         for instance_id in instance_ids:
             # Write the instance id to decommission.
             # (NOTE: Our update hooks will take care of the rest).
@@ -985,9 +1036,21 @@ class Endpoint(Atomic):
             if inactive_instance_id in discarded_instances:
                 self._delete_instance(inactive_instance_id, discarded=True)
 
+        # Note whether any instances are still in transition. These
+        # have timeouts counting down, so the manager will need to
+        # keep updating us regularly until everything has settled.
+        self._settling = \
+            len(self.decommissioned.list()) > 0 or \
+            len(self.errored.list()) > 0 or \
+            len(self.discarded.list()) > 0 or \
+            len(self.zkobj.marked_instances().list()) > 0
+
         # Return the active instance ids for update().
         return (active_instance_ids, inactive_instance_ids)
 
+    def settling(self):
+        return self._settling
+
     def ip_confirmed(self, ip):
         for instance_id in self.instances.list():
             if ip in self.instance_ips.get(instance_id):
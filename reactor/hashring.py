@@ -0,0 +1,114 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+The consistent hashing ring used to assign endpoints and IPs to managers.
+
+Each manager publishes a set of random keys along with the clouds and
+loadbalancers it supports. An item (e.g. an endpoint) is owned by the manager
+with the first key after the item's key (wrapping around), skipping any
+managers that are not capable of handling the item's cloud and loadbalancer.
+
+The ring is immutable, and is rebuilt whenever the set of managers changes.
+At that point, we precompute a filtered ring for every (cloud, loadbalancer)
+combination, so finding an owner is always a single bisect.
+"""
+
+import bisect
+
+class HashRing(object):
+
+    def __init__(self, managers=None):
+        """
+        Build a ring from a map of manager uuid -> (keys, clouds, loadbalancers).
+        """
+        super(HashRing, self).__init__()
+        if managers is None:
+            managers = {}
+
+        self._info = {}
+        all_keys = []
+        all_clouds = set()
+        all_loadbalancers = set()
+        for (uuid, (keys, clouds, loadbalancers)) in managers.items():
+            self._info[uuid] = (clouds, loadbalancers)
+            all_clouds.update(clouds)
+            all_loadbalancers.update(loadbalancers)
+            for key in keys:
+                all_keys.append((key, uuid))
+
+        # NOTE: If (somehow) two managers share a key, the
+        # last one wins. This is the same as the old behaviour.
+        key_map = dict(all_keys)
+        self._keys = sorted(key_map.keys())
+        self._owners = [key_map[key] for key in self._keys]
+
+        # Precompute the filtered rings. A value of None for
+        # either the cloud or the loadbalancer means any.
+        self._filtered = {}
+        for cloud in [None] + list(all_clouds):
+            for loadbalancer in [None] + list(all_loadbalancers):
+                capable = [
+                    i for (i, uuid) in enumerate(self._owners)
+                    if (not cloud or cloud in self._info[uuid][0]) and
+                       (not loadbalancer or loadbalancer in self._info[uuid][1])
+                ]
+                if not capable:
+                    continue
+                elif len(capable) == len(self._keys):
+                    self._filtered[(cloud, loadbalancer)] = \
+                        (self._keys, self._owners)
+                else:
+                    self._filtered[(cloud, loadbalancer)] = (
+                        [self._keys[i] for i in capable],
+                        [self._owners[i] for i in capable])
+
+    def __len__(self):
+        return len(self._keys)
+
+    def managers(self):
+        return self._info.keys()
+
+    def info(self):
+        """ Returns a map of manager uuid -> (clouds, loadbalancers). """
+        return self._info.copy()
+
+    def owner(self, key, cloud=None, loadbalancer=None):
+        """
+        Returns the uuid of the manager that owns the given key, or
+        None if there is no manager capable of owning it.
+        """
+        ring = self._filtered.get((cloud or None, loadbalancer or None))
+        if ring is None:
+            return None
+        (keys, owners) = ring
+        index = bisect.bisect(keys, key)
+        return owners[index % len(keys)]
+
+    def moved(self, other, items):
+        """
+        Compare this ring to another ring for the given items.
+
+        The items are a map of id -> (key, cloud, loadbalancer). This
+        returns a map of id -> (old_owner, new_owner) for all items
+        which have a different owner in the other ring.
+        """
+        result = {}
+        for (item, (key, cloud, loadbalancer)) in items.iteritems():
+            old_owner = self.owner(key, cloud=cloud, loadbalancer=loadbalancer)
+            new_owner = other.owner(key, cloud=cloud, loadbalancer=loadbalancer)
+            if old_owner != new_owner:
+                result[item] = (old_owner, new_owner)
+        return result
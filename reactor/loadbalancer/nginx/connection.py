@@ -14,11 +14,9 @@
 #    under the License.
 
 import os
+import time
 import signal
-import shutil
 import glob
-import re
-import time
 import logging
 import subprocess
 import tempfile
@@ -26,125 +24,23 @@ import tempfile
 from mako.template import Template
 
 from reactor.atomic import Atomic
-from reactor.atomic import AtomicRunnable
 from reactor.config import Config
 from reactor.utils import sha_hash
 from reactor.loadbalancer.utils import read_pid
 from reactor.loadbalancer.connection import LoadBalancerConnection
-from reactor.loadbalancer.netstat import connection_count
-
-class NginxLogReader(object):
-
-    def __init__(self, log_filename, log_filter=None):
-        super(NginxLogReader, self).__init__()
-        self.logfile = None
-        self.log_filename = log_filename
-        self.log_filter = None
-        if log_filter != None:
-            self.log_filter = re.compile(log_filter)
-        self.connected = False
-
-    def connect(self):
-        # Re-open the file by name.
-        self.logfile = open(self.log_filename, 'r')
-
-        # Seek to the end of the file, always.
-        self.logfile.seek(0, 2)
-        self.connected = True
-
-    def nextline(self):
-        # Open the file initially.
-        if not(self.connected):
-            try:
-                self.connect()
-            except IOError:
-                return None
-
-        line = self.logfile.readline().strip()
-        while self.log_filter != None and line:
-            # Apply the filter to the line.
-            m = self.log_filter.match(line)
-            if m != None:
-                return m.groups()
-            else:
-                line = self.logfile.readline().strip()
-
-        # If we got nothing, make sure we've got
-        # the right file open (due to rotation) and
-        # seek to the end where we should still be.
-        if not(line):
-            try:
-                self.connect()
-            except IOError:
-                logging.warn("Unable to reopen Nginx log.")
-
-        return line
-
-class NginxLogWatcher(AtomicRunnable):
-    """
-    This will monitor the nginx access log.
-    """
-
-    LOG_FILTER = "reactor> " \
-               + "\[([^\]]*)\]" \
-               + "[^<]*" \
-               + "<([^>]*?)>" \
-               + "[^<]*" \
-               + "<([^>]*?)>" \
-               + "[^<]*" \
-               + "<([^>]*?)>" \
-               + ".*"
-
-    def __init__(self, access_logfile):
-        super(NginxLogWatcher, self).__init__()
-        self.log = NginxLogReader(access_logfile, log_filter=self.LOG_FILTER)
-        self.last_update = time.time()
-        self.record = {}
-
-    @Atomic.sync
-    def swap(self):
-        # Swap out the records.
-        now = time.time()
-        delta = now - self.last_update
-        self.last_update = now
-        cur = self.record
-        self.record = {}
-        return (cur, delta)
-
-    def pull(self):
-        (record, delta) = self.swap()
-
-        # Compute the response times.
-        for host in record:
-            hits = record[host][0]
-            metrics = \
-                {
-                "rate" : (hits, hits / delta),
-                "response" : (hits, record[host][2] / hits),
-                "bytes" : (hits, record[host][1] / delta),
-                }
-            record[host] = [metrics]
-
-        return record
-
-    @Atomic.sync
-    def run(self):
-        while self.is_running():
-            line = self.log.nextline()
-            if not(line):
-                # No updates.
-                self._wait(1.0)
-            else:
-                # We have some information.
-                (_, host, body, response) = line
-                try:
-                    if not(host in self.record):
-                        self.record[host] = [0, 0, 0.0]
-                    self.record[host][0] += 1
-                    self.record[host][1] += int(body)
-                    self.record[host][2] += float(response)
-                except ValueError:
-                    continue
+from reactor.loadbalancer.sockets import connection_count
+from reactor.loadbalancer.nginx.logs import NginxLogWatcher
+from reactor.loadbalancer.nginx.reload import NginxReloader
+from reactor.loadbalancer.nginx.reload import write_file
+from reactor.loadbalancer.nginx.reload import remove_file
+from reactor.loadbalancer.nginx.upstreams import UpstreamControl
+from reactor.loadbalancer.nginx.upstreams import format_servers
+
+# How long a single update of the upstreams may take, and how
+# long (and how often) to retry one after a reload.
+PUSH_DEADLINE = 2.0
+RELOAD_PUSH_DEADLINE = 5.0
+PUSH_INTERVAL = 0.1
 
 class NginxManagerConfig(Config):
 
@@ -160,6 +56,20 @@ class NginxManagerConfig(Config):
         default="/etc/nginx/sites-enabled",
         description="The site path for nginx.")
 
+    reload_window = Config.integer(label="Reload Window (ms)", default=500,
+        validate=lambda self: self.reload_window >= 0 or \
+            Config.error("The reload window must be non-negative."),
+        description="Changes saved within this window are applied by a" \
+                    + " single reload of nginx.")
+
+    dynamic_upstreams = Config.boolean(label="Dynamic Upstreams", default=False,
+        description="Update backends through a shared memory zone rather" \
+                    + " than reloading nginx (requires the nginx Lua module).")
+
+    control_socket = Config.string(label="Control Socket",
+        default="/var/run/reactor-nginx.sock",
+        description="The local socket used to update dynamic upstreams.")
+
 class NginxEndpointConfig(Config):
 
     sticky_sessions = Config.boolean(label="Use Sticky Sessions", default=False,
@@ -198,10 +108,23 @@ class Connection(LoadBalancerConnection):
     def __init__(self, **kwargs):
         super(Connection, self).__init__(**kwargs)
         self.tracked = {}
+        self.rendered = {}
+        self.members = {}
+        self.retired = {}
+        self.pushed = {}
+        self.pushed_pid = None
+        self.control = None
         template_file = os.path.join(os.path.dirname(__file__), 'nginx.template')
         self.template = Template(filename=template_file)
+        upstreams_file = os.path.join(os.path.dirname(__file__), 'upstreams.template')
+        self.upstreams_template = Template(filename=upstreams_file)
+        base_file = open(os.path.join(os.path.dirname(__file__), 'reactor.conf'), 'rb')
+        self.base_conf = base_file.read()
+        base_file.close()
         self.log_reader = NginxLogWatcher("/var/log/nginx/access.log")
         self.log_reader.start()
+        self.reloader = NginxReloader(self._reload, self._push)
+        self.reloader.start()
 
         if kwargs.get('zkobj') is not None:
             # Remove all sites configurations.
@@ -210,13 +133,16 @@ class Connection(LoadBalancerConnection):
             for conf in glob.glob(
                 os.path.join(self._manager_config().site_path, "reactor.*")):
                 try:
-                    os.remove(conf)
+                    if remove_file(conf):
+                        self.reloader.mark()
                 except OSError:
                     pass
 
     def __del__(self):
         self.log_reader.stop()
         self.log_reader.join()
+        self.reloader.stop()
+        self.reloader.join()
 
     def _generate_ssl(self, uniq_id, config):
         key = config.ssl_key
@@ -267,6 +193,8 @@ class Connection(LoadBalancerConnection):
         # We use a simple hash of the URL as the file name for the configuration file.
         uniq_id = sha_hash(url)
         conf_filename = "reactor.%s.conf" % uniq_id
+        full_conf_file = os.path.join(
+            self._manager_config().site_path, conf_filename)
 
         # Grab the endpoint configuration.
         config = self._endpoint_config(config)
@@ -276,16 +204,50 @@ class Connection(LoadBalancerConnection):
             # Remove the connection from our tracking list.
             if uniq_id in self.tracked:
                 del self.tracked[uniq_id]
+            if uniq_id in self.rendered:
+                del self.rendered[uniq_id]
+            self._retire(uniq_id)
 
             try:
-                full_conf_file = os.path.join(
-                    self._manager_config().site_path, conf_filename)
-                if os.path.exists(full_conf_file):
-                    os.remove(full_conf_file)
+                if remove_file(full_conf_file):
+                    self.reloader.mark()
             except OSError:
                 logging.warn("Unable to remove file: %s", conf_filename)
             return
 
+        # Add the connection to our tracking list.
+        self.tracked[uniq_id] = \
+            [(backend.ip, backend.port) for backend in backends]
+
+        # With dynamic upstreams, the backends are not part of the
+        # configuration file and are pushed to nginx by the reloader.
+        # Sticky sessions need the upstream module, so those stay static.
+        dynamic = self._manager_config().dynamic_upstreams and \
+            not config.sticky_sessions and len(backends) > 0
+        if dynamic:
+            self._admit(uniq_id, format_servers(backends))
+            ipspecs = None
+        else:
+            self._retire(uniq_id)
+            ipspecs = ["%s:%d weight=%d" % (backend.ip, backend.port, backend.weight)
+                       for backend in backends]
+
+        # Skip rendering if nothing that goes into the template
+        # has changed since we last wrote out this file.
+        inputs = sha_hash(repr((
+            url,
+            full_conf_file,
+            ipspecs,
+            config.sticky_sessions,
+            config.keepalive,
+            config.ssl,
+            config.ssl_certificate,
+            config.ssl_key,
+            config.redirect)))
+        if self.rendered.get(uniq_id) == inputs and \
+            os.path.exists(full_conf_file):
+            return
+
         # Parse the given URL.
         (scheme, netloc, listen, path) = self.url_info(url)
 
@@ -299,10 +261,7 @@ class Connection(LoadBalancerConnection):
         # Ensure that there is a path.
         path = path or "/"
 
-        # Add the connection to our tracking list, and
-        # compute the specification for the template.
-        ipspecs = []
-        self.tracked[uniq_id] = []
+        # Compute the specification for the template.
         extra = ''
 
         # Figure out if we're doing SSL.
@@ -319,11 +278,6 @@ class Connection(LoadBalancerConnection):
             # Don't use any SSL backend.
             (ssl_certificate, ssl_key) = (None, None)
 
-        # Collect all the backend IPs.
-        for backend in backends:
-            ipspecs.append("%s:%d weight=%d" % (backend.ip, backend.port, backend.weight))
-            self.tracked[uniq_id].append((backend.ip, backend.port))
-
         # Compute any extra bits for the template.
         if self._endpoint_config(config).sticky_sessions:
             extra += '    sticky;\n'
@@ -331,7 +285,7 @@ class Connection(LoadBalancerConnection):
             extra += '    keepalive %d single;\n' % self._endpoint_config(config).keepalive
 
         # Check if we're doing a redirect.
-        if len(ipspecs) == 0:
+        if len(backends) == 0:
             redirect = config.redirect
         else:
             redirect = False
@@ -343,24 +297,120 @@ class Connection(LoadBalancerConnection):
                                     path=path,
                                     scheme=scheme,
                                     listen=str(listen),
-                                    ipspecs=ipspecs,
+                                    ipspecs=ipspecs or [],
+                                    dynamic=dynamic,
                                     redirect=redirect,
                                     ssl=config.ssl,
                                     ssl_certificate=ssl_certificate,
                                     ssl_key=ssl_key,
                                     extra=extra)
 
-        # Write out the config file.
-        config_file = open(os.path.join(
-            self._manager_config().site_path, conf_filename), 'wb')
-        config_file.write(conf)
-        config_file.close()
+        # Write out the config file (if it differs).
+        if write_file(full_conf_file, conf):
+            self.reloader.mark()
+        self.rendered[uniq_id] = inputs
 
     def save(self):
         # Copy over our base configuration.
-        shutil.copyfile(os.path.join(os.path.dirname(__file__), 'reactor.conf'),
-                        os.path.join(self._manager_config().config_path, 'reactor.conf'))
+        config = self._manager_config()
+        if write_file(os.path.join(config.config_path, 'reactor.conf'),
+                      self.base_conf):
+            self.reloader.mark()
+
+        # Add (or remove) the shared zone and its control server.
+        upstreams_file = os.path.join(config.config_path, 'reactor.upstreams.conf')
+        if config.dynamic_upstreams:
+            if write_file(upstreams_file, self.upstreams_template.render(
+                    control_socket=config.control_socket)):
+                self.reloader.mark()
+        elif remove_file(upstreams_file):
+            self.reloader.mark()
+
+        # Make sure that nginx gets started, even if nothing changed.
+        if not read_pid(config.pid_file):
+            self.reloader.mark()
+
+        # Membership changes are pushed when the window closes, and
+        # reloads are coalesced, and skipped if no files changed.
+        # (Neither blocks the caller on nginx.)
+        self.reloader.request(config.reload_window / 1000.0)
+
+    @Atomic.sync
+    def _admit(self, uniq_id, servers):
+        self.members[uniq_id] = servers
+        if uniq_id in self.retired:
+            del self.retired[uniq_id]
+
+    @Atomic.sync
+    def _retire(self, uniq_id):
+        # The zone entry is still used by the server block until
+        # nginx has been reloaded without it, so we only note the
+        # reload it has to wait for here (see _push() below).
+        if uniq_id in self.members:
+            del self.members[uniq_id]
+            self.retired[uniq_id] = self.reloader.completed
+
+    @Atomic.sync
+    def _forget(self, uniq_id, completed):
+        if self.retired.get(uniq_id) == completed:
+            del self.retired[uniq_id]
 
+    @Atomic.sync
+    def _wanted(self):
+        return (dict(self.members), dict(self.retired))
+
+    def _push(self, deadline=None):
+        # Bring the shared zone in line with our dynamic upstreams.
+        # Returns False if nginx could not be updated in time (anything
+        # that is left over will be retried on the next push).
+        # NOTE: This is only called from the reloader thread (which
+        # is the only user of pushed and control), and does not hold
+        # the lock while talking to nginx.
+        if deadline is None:
+            deadline = time.time() + PUSH_DEADLINE
+        config = self._manager_config()
+        if not config.dynamic_upstreams:
+            self.pushed = {}
+            return True
+        pid = read_pid(config.pid_file)
+        if not pid:
+            return False
+        if pid != self.pushed_pid:
+            # The zone does not survive a restart.
+            self.pushed = {}
+            self.pushed_pid = pid
+        if self.control is None or \
+            self.control.socket_path != config.control_socket:
+            if self.control is not None:
+                self.control.close()
+            self.control = UpstreamControl(config.control_socket)
+
+        (members, retired) = self._wanted()
+        completed = self.reloader.completed
+        try:
+            for (uniq_id, servers) in members.items():
+                if self.pushed.get(uniq_id) != servers:
+                    self.control.set(uniq_id, servers, deadline=deadline)
+                    self.pushed[uniq_id] = servers
+            for uniq_id in self.pushed.keys():
+                if uniq_id in members:
+                    continue
+                # Wait for a reload to complete after the removal,
+                # otherwise requests could hit a missing entry.
+                if retired.get(uniq_id, -1) >= completed:
+                    continue
+                self.control.delete(uniq_id, deadline=deadline)
+                del self.pushed[uniq_id]
+                self._forget(uniq_id, retired.get(uniq_id))
+            for (uniq_id, reloads) in retired.items():
+                if not uniq_id in self.pushed:
+                    self._forget(uniq_id, reloads)
+        except Exception, e:
+            logging.debug("Unable to update nginx upstreams: %s", str(e))
+            return False
+        return True
+
+    def _reload(self):
         # Send a signal to NginX to reload the configuration
         # (Note: we might need permission to do this!!)
         pid = read_pid(self._manager_config().pid_file)
@@ -371,12 +421,24 @@ class Connection(LoadBalancerConnection):
                 ["service", "nginx", "start"],
                 close_fds=True)
 
+        # The zone is kept across reloads, but the control server
+        # may not be listening until nginx has processed this one.
+        deadline = time.time() + RELOAD_PUSH_DEADLINE
+        while not self._push(deadline):
+            if time.time() + PUSH_INTERVAL >= deadline:
+                logging.warn("Unable to update nginx upstreams.")
+                break
+            time.sleep(PUSH_INTERVAL)
+
     def metrics(self):
         # Grab the log records.
         records = self.log_reader.pull()
 
-        # Grab the active connections.
-        active_connections = connection_count()
+        # Grab the active connections (only for our backends).
+        backends = set()
+        for connection_list in self.tracked.values():
+            backends.update(connection_list)
+        active_connections = connection_count(backends)
 
         for connection_list in self.tracked.values():
             for (ip, port) in connection_list:
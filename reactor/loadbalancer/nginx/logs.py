@@ -0,0 +1,231 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+"""
+Incremental reading of the nginx access log.
+"""
+
+import os
+import re
+import time
+
+from reactor.atomic import Atomic
+from reactor.atomic import AtomicRunnable
+from reactor.metrics.histogram import Histogram
+
+# How much of the log is read at a time.
+CHUNK_SIZE = 1024 * 1024
+
+# How long to wait when there's nothing new in the log.
+POLL_INTERVAL = 1.0
+
+class NginxLogReader(object):
+
+    """
+    Reads the log in large chunks, returning only complete lines.
+
+    The file is tracked by inode and offset. When we reach the end, we
+    check whether the name now refers to a different file (rotation) or
+    a shorter one (truncation), rather than reopening it every time.
+    """
+
+    def __init__(self, log_filename, chunk_size=CHUNK_SIZE):
+        super(NginxLogReader, self).__init__()
+        self.log_filename = log_filename
+        self.chunk_size = chunk_size
+        self.fd = None
+        self.inode = None
+        self.offset = 0
+        self.partial = ""
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _open(self, start=False):
+        fd = os.open(self.log_filename, os.O_RDONLY)
+        stat = os.fstat(fd)
+        self.close()
+        self.fd = fd
+        self.inode = (stat.st_dev, stat.st_ino)
+        self.partial = ""
+
+        # We start at the end of the log the first time, as we only
+        # care about new entries. But a file that has replaced the
+        # one we were reading is all new, so we read it from the top.
+        if start:
+            self.offset = 0
+        else:
+            self.offset = stat.st_size
+        os.lseek(self.fd, self.offset, os.SEEK_SET)
+
+    def _reopen(self):
+        # We are at the end of the file, so check
+        # if the log has been rotated or truncated.
+        try:
+            stat = os.stat(self.log_filename)
+        except OSError:
+            # Rotated, but not yet recreated.
+            return False
+        if (stat.st_dev, stat.st_ino) != self.inode:
+            self._open(start=True)
+            return True
+        if stat.st_size < self.offset:
+            self.offset = 0
+            self.partial = ""
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            return True
+        return False
+
+    def read(self):
+        """
+        Returns the complete lines that have been written
+        since the last call (up to about one chunk's worth).
+        """
+        if self.fd is None:
+            try:
+                self._open()
+            except OSError:
+                return ""
+
+        data = os.read(self.fd, self.chunk_size)
+        if not data:
+            if not self._reopen():
+                return ""
+            data = os.read(self.fd, self.chunk_size)
+        self.offset += len(data)
+
+        # Hang on to anything after the last newline,
+        # until the rest of that line has been written.
+        data = self.partial + data
+        end = data.rfind("\n") + 1
+        self.partial = data[end:]
+        return data[:end]
+
+class NginxLogWatcher(AtomicRunnable):
+    """
+    This will monitor the nginx access log.
+    """
+
+    # Extracts (upstream, body bytes, response time) from each line,
+    # matching the reactor log_format (see reactor.conf). This is run
+    # over whole chunks, so there is no per-line splitting in Python.
+    LOG_FILTER = re.compile(
+        r"^reactor> \[[^\]\n]*\][^<\n]*"
+        r"<([^>\n]*)>[^<\n]*"
+        r"<([^>\n]*)>[^<\n]*"
+        r"<([^>\n]*)>", re.M)
+
+    def __init__(self, access_logfile):
+        super(NginxLogWatcher, self).__init__()
+        self.log = NginxLogReader(access_logfile)
+        self.last_update = time.time()
+        self.record = {}
+
+    @Atomic.sync
+    def swap(self):
+        # Swap out the records.
+        now = time.time()
+        delta = now - self.last_update
+        self.last_update = now
+        cur = self.record
+        self.record = {}
+        return (cur, delta)
+
+    def pull(self):
+        (record, delta) = self.swap()
+
+        # Compute the response times.
+        # The histogram buckets are published as well, so that the
+        # percentiles can be computed once they have been merged with
+        # those from other managers (see histogram.summarize()).
+        for host in record:
+            (hits, body, response, histogram) = record[host]
+            metrics = \
+                {
+                "rate" : (hits, hits / delta),
+                "response" : (hits, response / hits),
+                "bytes" : (hits, body / delta),
+                }
+            metrics.update(histogram.as_metrics("response"))
+            record[host] = [metrics]
+
+        return record
+
+    def aggregate(self, data):
+        # Add up [hits, bytes, response time, histogram] for each host.
+        # Entries without an upstream response (e.g. "-") are skipped.
+        record = {}
+        responses = {}
+        for (host, body, response) in self.LOG_FILTER.findall(data):
+            try:
+                body = int(body)
+                value = float(response)
+            except ValueError:
+                continue
+            totals = record.get(host)
+            if totals is None:
+                record[host] = [1, body, value, None]
+            else:
+                totals[0] += 1
+                totals[1] += body
+                totals[2] += value
+            # Response times are logged to the millisecond, so there
+            # are few distinct values. We count these, and add them to
+            # the histograms in one go below.
+            key = (host, response)
+            responses[key] = responses.get(key, 0) + 1
+
+        for ((host, response), count) in responses.items():
+            totals = record[host]
+            if totals[3] is None:
+                totals[3] = Histogram()
+            totals[3].add(float(response), count)
+        return record
+
+    @Atomic.sync
+    def merge(self, record):
+        if not self.record:
+            self.record = record
+            return
+        for (host, (hits, body, response, histogram)) in record.items():
+            totals = self.record.get(host)
+            if totals is None:
+                self.record[host] = [hits, body, response, histogram]
+            else:
+                totals[0] += hits
+                totals[1] += body
+                totals[2] += response
+                totals[3].merge(histogram)
+
+    @Atomic.sync
+    def _idle(self):
+        if self._running:
+            self._wait(POLL_INTERVAL)
+
+    def run(self):
+        # NOTE: Each chunk is read and added up without the lock,
+        # which is only taken to fold the totals into the record.
+        while self.is_running():
+            data = self.log.read()
+            if not data:
+                self._idle()
+            else:
+                self.merge(self.aggregate(data))
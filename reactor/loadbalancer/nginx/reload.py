@@ -0,0 +1,147 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Configuration writes and coalesced reloads for nginx.
+"""
+
+import os
+import time
+import errno
+import logging
+import tempfile
+
+from reactor.atomic import Atomic
+from reactor.atomic import AtomicRunnable
+
+def write_file(filename, data):
+    """
+    Replace the given file with data, unless it already has exactly
+    that content. The new file is written alongside and renamed into
+    place, so nginx never sees a partially written configuration.
+
+    Returns True if the file was changed.
+    """
+    try:
+        existing = open(filename, 'rb')
+        try:
+            if existing.read() == data:
+                return False
+        finally:
+            existing.close()
+    except IOError:
+        pass
+
+    (fd, temp_file) = tempfile.mkstemp(
+        dir=os.path.dirname(filename), prefix=".reactor.")
+    try:
+        temp = os.fdopen(fd, 'wb')
+        try:
+            temp.write(data)
+        finally:
+            temp.close()
+        os.chmod(temp_file, 0644)
+        os.rename(temp_file, filename)
+    except:
+        os.unlink(temp_file)
+        raise
+    return True
+
+def remove_file(filename):
+    """ Remove the given file, returning True if it existed. """
+    try:
+        os.remove(filename)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    return True
+
+class NginxReloader(AtomicRunnable):
+    """
+    Coalesces reload requests.
+
+    The first request opens a window, and all requests that arrive
+    before it closes are served by a single call to reload_fn. If no
+    change was marked during the window, the reload is skipped. The
+    optional push_fn is called as each window closes (before any
+    reload), for changes that are applied without reloading.
+    """
+
+    def __init__(self, reload_fn, push_fn=None):
+        super(NginxReloader, self).__init__()
+        self.daemon = True
+        self.reload_fn = reload_fn
+        self.push_fn = push_fn
+        self.deadline = None
+        self.dirty = False
+        self.reloads = 0
+        self.skipped = 0
+        self.completed = 0
+
+    @Atomic.sync
+    def mark(self):
+        self.dirty = True
+
+    @Atomic.sync
+    def request(self, window=0.0):
+        if self.deadline is None:
+            self.deadline = time.time() + window
+            self._notify()
+
+    @Atomic.sync
+    def _completed(self):
+        self.completed += 1
+
+    @Atomic.sync
+    def _next(self):
+        # Wait for the current window to close, and return whether
+        # there is anything for us to reload (None if we're stopped).
+        while self._running:
+            if self.deadline is None:
+                self._wait()
+                continue
+            remaining = self.deadline - time.time()
+            if remaining > 0:
+                self._wait(remaining)
+                continue
+            self.deadline = None
+            dirty = self.dirty
+            self.dirty = False
+            if dirty:
+                self.reloads += 1
+            else:
+                self.skipped += 1
+            return dirty
+        return None
+
+    def run(self):
+        # NOTE: The reload is done without the lock, so requests
+        # arriving in the meantime simply open the next window.
+        while True:
+            dirty = self._next()
+            if dirty is None:
+                break
+            if self.push_fn is not None:
+                try:
+                    self.push_fn()
+                except Exception:
+                    logging.exception("Error updating nginx.")
+            if dirty:
+                try:
+                    self.reload_fn()
+                except Exception:
+                    logging.exception("Error reloading nginx.")
+                self._completed()
@@ -0,0 +1,101 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Dynamic upstream membership for nginx.
+
+The servers for each upstream are kept in a shared memory zone, which
+is read by a Lua balancer in every worker (see upstreams.template).
+The zone is updated through a small HTTP server on a local unix
+socket, so changing backends does not require a reload.
+"""
+
+import time
+import socket
+import httplib
+
+# How long to wait for nginx to handle an update.
+CONTROL_TIMEOUT = 5.0
+
+def format_servers(backends):
+    """ The zone entry for the given backends (one server per line). """
+    return "".join(["%s %d %d\n" % (backend.ip, backend.port, backend.weight)
+                    for backend in backends])
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=CONTROL_TIMEOUT):
+        httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error:
+            sock.close()
+            raise
+        self.sock = sock
+
+class UpstreamControl(object):
+    """
+    A client for the control socket.
+
+    The connection is kept open between requests, and is dropped on
+    any error (it will be reopened on the next request).
+    """
+
+    def __init__(self, socket_path):
+        super(UpstreamControl, self).__init__()
+        self.socket_path = socket_path
+        self.conn = None
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _request(self, method, uniq_id, body=None, deadline=None):
+        timeout = CONTROL_TIMEOUT
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.time())
+            if timeout <= 0:
+                raise socket.timeout("Deadline exceeded.")
+        if self.conn is None:
+            self.conn = UnixHTTPConnection(self.socket_path, timeout=timeout)
+        else:
+            self.conn.timeout = timeout
+            if self.conn.sock is not None:
+                self.conn.sock.settimeout(timeout)
+        try:
+            self.conn.request(method, "/upstreams/%s" % uniq_id, body)
+            response = self.conn.getresponse()
+            response.read()
+        except (socket.error, httplib.HTTPException):
+            self.close()
+            raise
+        if response.status != httplib.NO_CONTENT:
+            self.close()
+            raise Exception("Upstream %s failed (%d)." % (method, response.status))
+
+    def set(self, uniq_id, servers, deadline=None):
+        self._request("PUT", uniq_id, servers, deadline=deadline)
+
+    def delete(self, uniq_id, deadline=None):
+        self._request("DELETE", uniq_id, deadline=deadline)
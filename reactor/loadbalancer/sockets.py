@@ -0,0 +1,227 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+"""
+Counts open TCP connections to a set of backends.
+
+The kernel is asked via netlink (sock_diag), with a filter so that only
+connections to the given backends come back. Where that's not available,
+we scan /proc/net/tcp{,6} and, as a last resort, parse netstat output.
+"""
+
+import re
+import socket
+import struct
+import logging
+
+from . import netstat
+
+# Netlink constants (see linux/netlink.h and linux/sock_diag.h).
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 0x2
+NLMSG_DONE = 0x3
+
+# Filter bytecode (see linux/inet_diag.h).
+INET_DIAG_REQ_BYTECODE = 1
+INET_DIAG_BC_JMP = 1
+INET_DIAG_BC_D_COND = 8
+
+# The bytecode is a netlink attribute, so it has a 16-bit length.
+# (With more backends than fit, we filter the results ourselves).
+MAX_BYTECODE = 0xfff0
+
+# Every TCP state except for listening (i.e. what netstat -t shows).
+TCP_LISTEN = 10
+TCP_STATES = 0xffe & ~(1 << TCP_LISTEN)
+
+# The proc files, and how listening sockets appear there.
+PROC_PATHS = ["/proc/net/tcp", "/proc/net/tcp6"]
+PROC_LISTEN = "%02X" % TCP_LISTEN
+
+# Picks out the remote address and the state from a line in /proc.
+PROC_LINE = re.compile(r"^\s*\d+:\s+\S+\s+(\S+)\s+(\S+)", re.M)
+
+# The prefix of an IPv4-mapped IPv6 address.
+V4_MAPPED = "\0" * 10 + "\xff\xff"
+
+def _parse(backends):
+    # Returns (family, packed address, port, backend) for each
+    # backend that is a valid address. Anything else (e.g. a
+    # hostname) can't match a socket, so it's not counted.
+    parsed = []
+    for (ip, port) in backends:
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                addr = socket.inet_pton(family, ip)
+            except (socket.error, ValueError):
+                continue
+            parsed.append((family, addr, port, (ip, port)))
+            break
+    return parsed
+
+def _bytecode(parsed):
+    # Build a filter that matches any of the given backends. This is
+    # a chain of conditions (the same shape that ss generates): a match
+    # hits a jump to the end (accept), a miss falls through to the next
+    # condition, and a miss on the last one jumps past the end (reject).
+    # If there are too many backends for this, we return None.
+    size = sum([16 + len(addr) for (_, addr, _, _) in parsed]) - 4
+    if size > MAX_BYTECODE:
+        return None
+    program = ""
+    for (family, addr, port, _) in reversed(parsed):
+        hostcond = struct.pack("=BBxxi", family, len(addr) * 8, port) + addr
+        length = 4 + len(hostcond)
+        cond = struct.pack("=BBH", INET_DIAG_BC_D_COND, length, length + 4) + hostcond
+        if program:
+            cond += struct.pack("=BBH", INET_DIAG_BC_JMP, 4, len(program) + 4)
+        program = cond + program
+    return program
+
+def _dump(sock, family, parsed):
+    # Ask for all TCP sockets in the given family.
+    request = struct.pack("=BBBxI", family, socket.IPPROTO_TCP, 0, TCP_STATES)
+    request += "\0" * 48
+    bytecode = _bytecode(parsed)
+    if bytecode is not None:
+        request += struct.pack("=HH", 4 + len(bytecode), INET_DIAG_REQ_BYTECODE)
+        request += bytecode
+    header = struct.pack("=IHHII",
+        16 + len(request), SOCK_DIAG_BY_FAMILY, NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+    sock.sendto(header + request, (0, 0))
+
+    # Read back the remote end (address, port) of each one.
+    while True:
+        data = sock.recv(65536)
+        offset = 0
+        while offset < len(data):
+            (length, kind, _, _, _) = struct.unpack_from("=IHHII", data, offset)
+            if kind == NLMSG_DONE:
+                return
+            if kind == NLMSG_ERROR:
+                (error,) = struct.unpack_from("=i", data, offset + 16)
+                raise socket.error(-error, "sock_diag error")
+            (port,) = struct.unpack_from("!H", data, offset + 22)
+            yield (data[offset + 40:offset + 56], port)
+            offset += (length + 3) & ~3
+
+def sock_diag_count(backends):
+    parsed = _parse(backends)
+    wanted = {}
+    for (family, addr, port, backend) in parsed:
+        wanted[(addr, port)] = backend
+
+    # IPv4 backends may also show up in IPv6 sockets (as mapped
+    # addresses), which the kernel filter takes into account.
+    counts = {}
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_SOCK_DIAG)
+    try:
+        for family in (socket.AF_INET, socket.AF_INET6):
+            if family == socket.AF_INET:
+                these = [x for x in parsed if x[0] == socket.AF_INET]
+            else:
+                these = parsed
+            if not these:
+                continue
+            for (addr, port) in _dump(sock, family, these):
+                if addr.startswith(V4_MAPPED):
+                    addr = addr[12:]
+                elif family == socket.AF_INET:
+                    addr = addr[:4]
+                backend = wanted.get((addr, port))
+                if backend is not None:
+                    counts[backend] = counts.get(backend, 0) + 1
+    finally:
+        sock.close()
+    return counts
+
+def _proc_key(addr, port):
+    # Format an address the way /proc does: each 32-bit word of the
+    # address is printed as a native integer, then the port in hex.
+    words = struct.unpack("=%dI" % (len(addr) / 4), addr)
+    return "%s:%04X" % ("".join(["%08X" % word for word in words]), port)
+
+def proc_count(backends, paths=None):
+    if paths is None:
+        paths = PROC_PATHS
+
+    # Rather than decode every line, we encode the backends
+    # the way they will appear and look for those instead.
+    wanted = {}
+    for (family, addr, port, backend) in _parse(backends):
+        wanted[_proc_key(addr, port)] = backend
+        if family == socket.AF_INET:
+            wanted[_proc_key(V4_MAPPED + addr, port)] = backend
+
+    counts = {}
+    found = False
+    for path in paths:
+        try:
+            proc_file = open(path, "r")
+        except IOError:
+            continue
+        try:
+            data = proc_file.read()
+        finally:
+            proc_file.close()
+        found = True
+        for (remote, state) in PROC_LINE.findall(data):
+            backend = wanted.get(remote)
+            if backend is not None and state != PROC_LISTEN:
+                counts[backend] = counts.get(backend, 0) + 1
+    if not found:
+        return None
+    return counts
+
+def netstat_count(backends):
+    backends = set(backends)
+    counts = {}
+    for (backend, count) in netstat.connection_count().items():
+        if backend in backends:
+            counts[backend] = count
+    return counts
+
+# Whether the faster methods are available. These are
+# cleared the first time they fail, so we don't keep trying.
+_sock_diag = True
+_proc = True
+
+def connection_count(backends):
+    """
+    Returns { (ip, port) : count } for the given backends.
+    (Backends without any connections are left out).
+    """
+    global _sock_diag
+    global _proc
+
+    if not backends:
+        return {}
+    if _sock_diag:
+        try:
+            return sock_diag_count(backends)
+        except (socket.error, AttributeError), e:
+            logging.info("sock_diag unavailable (%s), using /proc.", e)
+            _sock_diag = False
+    if _proc:
+        counts = proc_count(backends)
+        if counts is not None:
+            return counts
+        logging.info("/proc/net/tcp unavailable, using netstat.")
+        _proc = False
+    return netstat_count(backends)
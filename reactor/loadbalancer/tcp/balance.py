@@ -0,0 +1,210 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Backend selection strategies for non-exclusive TCP endpoints.
+
+A strategy is built whenever the backends for a port change, and is then
+shared by all the consumers (shards) for that port. Every selection is
+O(1). Strategies also track the number of active connections for each
+backend, which the consumers update as connections come and go.
+"""
+
+import random
+
+from reactor.atomic import Atomic
+
+class AliasTable(object):
+
+    """
+    Walker's alias method (Vose's variant), for weighted selection in O(1).
+    """
+
+    def __init__(self, weights):
+        super(AliasTable, self).__init__()
+        n = len(weights)
+        total = float(sum(weights))
+        self._prob = [1.0] * n
+        self._alias = range(n)
+        if n == 0 or total <= 0:
+            return
+
+        # Scale so that the average weight is one.
+        scaled = [(w * n) / total for w in weights]
+        small = [i for (i, p) in enumerate(scaled) if p < 1.0]
+        large = [i for (i, p) in enumerate(scaled) if p >= 1.0]
+
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self._prob[s] = scaled[s]
+            self._alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+
+        # Anything left over is (up to rounding) exactly one.
+        for i in small + large:
+            self._prob[i] = 1.0
+
+    def __len__(self):
+        return len(self._prob)
+
+    def sample(self):
+        i = random.randint(0, len(self._prob) - 1)
+        if random.random() < self._prob[i]:
+            return i
+        return self._alias[i]
+
+class Strategy(Atomic):
+
+    name = None
+
+    def __init__(self, backends, weights=None, active=None):
+        super(Strategy, self).__init__()
+        if weights is None:
+            weights = [1] * len(backends)
+        if active is None:
+            active = {}
+        self.backends = list(backends)
+        self.weights = list(weights)
+
+        # Negative weights are nonsense, and if nothing has a
+        # weight we just treat all the backends the same.
+        clean = [max(w, 0) for w in self.weights]
+        if sum(clean) <= 0:
+            clean = [1] * len(self.backends)
+        self._table = AliasTable(clean)
+
+        # Carry over the active counts from the last strategy.
+        self._active = dict([
+            (backend, active.get(backend, 0))
+            for backend in self.backends
+        ])
+
+    def same(self, backends, weights):
+        return self.backends == list(backends) and \
+               self.weights == list(weights)
+
+    def _sample(self):
+        return self.backends[self._table.sample()]
+
+    def select(self):
+        raise NotImplementedError()
+
+    @Atomic.sync
+    def active(self):
+        return dict(self._active)
+
+    @Atomic.sync
+    def acquire(self, backend):
+        if backend in self._active:
+            self._active[backend] += 1
+            self._moved(backend, self._active[backend] - 1)
+
+    @Atomic.sync
+    def release(self, backend):
+        if self._active.get(backend, 0) > 0:
+            self._active[backend] -= 1
+            self._moved(backend, self._active[backend] + 1)
+
+    def _moved(self, backend, previous):
+        # Called (with the lock held) when a count changes.
+        pass
+
+class Weighted(Strategy):
+
+    """ Weighted random selection. """
+
+    name = "weighted"
+
+    @Atomic.sync
+    def select(self):
+        if not self.backends:
+            return None
+        return self._sample()
+
+class LeastConnections(Strategy):
+
+    """ Select the backend with the fewest active connections. """
+
+    name = "least"
+
+    def __init__(self, *args, **kwargs):
+        super(LeastConnections, self).__init__(*args, **kwargs)
+
+        # Backends bucketed by their active count. We keep track of
+        # the lowest non-empty bucket, which can only move by one
+        # each time a count changes (so everything stays O(1)).
+        self._buckets = {}
+        for (backend, count) in self._active.items():
+            self._buckets.setdefault(count, set()).add(backend)
+        self._min = self._buckets and min(self._buckets.keys()) or 0
+
+    @Atomic.sync
+    def select(self):
+        if not self.backends:
+            return None
+        return iter(self._buckets[self._min]).next()
+
+    def _moved(self, backend, previous):
+        current = self._active[backend]
+        bucket = self._buckets[previous]
+        bucket.discard(backend)
+        if not bucket:
+            del self._buckets[previous]
+        self._buckets.setdefault(current, set()).add(backend)
+        if current < self._min:
+            self._min = current
+        elif not previous in self._buckets and previous == self._min:
+            self._min = current
+
+class TwoChoices(Strategy):
+
+    """ Power of two choices: the less loaded of two (weighted) samples. """
+
+    name = "p2c"
+
+    @Atomic.sync
+    def select(self):
+        if not self.backends:
+            return None
+        first = self._sample()
+        second = self._sample()
+        if self._active[second] < self._active[first]:
+            return second
+        return first
+
+STRATEGIES = dict([
+    (clazz.name, clazz)
+    for clazz in (Weighted, LeastConnections, TwoChoices)
+])
+
+def build(name, backends, weights=None, previous=None):
+    """
+    Returns a strategy of the given name for the backends. If the previous
+    strategy is the same, it is simply returned. Otherwise the active counts
+    are carried over into the new strategy.
+    """
+    if weights is None:
+        weights = [1] * len(backends)
+    clazz = STRATEGIES.get(name, Weighted)
+    if previous is not None:
+        if previous.__class__ == clazz and previous.same(backends, weights):
+            return previous
+        return clazz(backends, weights, active=previous.active())
+    return clazz(backends, weights)
@@ -14,15 +14,15 @@
 #    under the License.
 
 import os
+import errno
 import socket
 import signal
 import time
-import threading
 import Queue
-import random
+import heapq
+import collections
 import select
 import logging
-import netaddr
 
 from reactor import utils
 from reactor.atomic import Atomic
@@ -30,7 +30,12 @@ from reactor.atomic import AtomicRunnable
 from reactor.config import Config
 from reactor.loadbalancer.connection import LoadBalancerConnection
 from reactor.ips import is_local
-from reactor.objects.ip_address import IPAddresses
+from reactor.objects.ip_address import IPLocks
+from reactor.loadbalancer.tcp import proxy
+from reactor.loadbalancer.tcp import reaper
+from reactor.loadbalancer.tcp import balance
+from reactor.loadbalancer.tcp import subnets
+from reactor.loadbalancer.tcp import stats
 
 def close_fds(except_fds=None):
     if except_fds is None:
@@ -58,6 +63,8 @@ def fork_and_exec(cmd, child_fds=None):
 
     # Close off all parent FDs.
     close_fds(except_fds=child_fds)
+    for fd in child_fds:
+        reaper.inherit(fd)
 
     # Create process group.
     os.setsid()
@@ -65,14 +72,40 @@ def fork_and_exec(cmd, child_fds=None):
     # Exec the given command.
     os.execvp(cmd[0], cmd)
 
+# Not all versions of the socket module expose this.
+# (The value is the one used by Linux, which is the only
+# platform where the kernel balances across listeners).
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+# The default listen backlog.
+DEFAULT_BACKLOG = 128
+
+# How often waiting connections are retried when nothing has changed.
+# (We're normally told when locks are released, by us or elsewhere, but
+# we check back now and again in case an update was missed).
+RETRY_INTERVAL = 1.0
+
+# The most connections accepted for one readiness event.
+# (So that one busy port can't starve the others).
+ACCEPT_BATCH = 256
+
 def _as_client(src_ip, src_port):
     return "%s:%d" % (src_ip, src_port)
 
+def _as_backend(backend):
+    (ip, port) = backend.split(":", 1)
+    return (ip, int(port))
+
 class Accept(object):
 
+    # When the connection was accepted.
+    accepted = None
+
     def __init__(self, sock):
         super(Accept, self).__init__()
+        self.fd = None
         (client, address) = sock.accept()
+        self.accepted = time.time()
         # Ensure that the underlying socket is closed.
         # It's probably crazy pills -- but I saw weird
         # issues with the socket object. This way we only
@@ -96,34 +129,96 @@ class Accept(object):
                     _as_client(*(self.src)), self.fd)
             self.fd = None
 
-    def redirect(self, host, port):
+    def redirect(self, host, port, reaper=None, exited=None):
         if self.fd is not None:
             cmd = [
                 "socat",
                 "fd:%d" % self.fd,
                 "tcp-connect:%s:%d" % (host, port)
             ]
-            child = fork_and_exec(cmd, child_fds=[self.fd])
+            if reaper is None:
+                child = fork_and_exec(cmd, child_fds=[self.fd])
+            else:
+                # The child holds the write end of this pipe,
+                # so the reaper will see it hang up on exit.
+                (rfd, wfd) = reaper.pipe()
+                try:
+                    child = fork_and_exec(cmd, child_fds=[self.fd, wfd])
+                finally:
+                    os.close(wfd)
+                if child:
+                    reaper.watch(child, rfd, exited=exited)
+                else:
+                    os.close(rfd)
             if child:
                 os.close(self.fd)
                 self.fd = None
             return child
 
+    def relay(self, proxy, host, port, closed=None):
+        if self.fd is not None:
+            relay = proxy.relay(self.fd, host, port, closed=closed,
+                                accepted=self.accepted)
+            if relay is not None:
+                os.close(self.fd)
+                self.fd = None
+            return relay
+
+def _child_kill(child):
+    if isinstance(child, proxy.Relay):
+        child.close()
+        return
+    try:
+        os.kill(child, signal.SIGTERM)
+    except OSError:
+        # The process no longer exists.
+        pass
+
 class ConnectionConsumer(AtomicRunnable):
 
-    def __init__(self, locks, error_notify, discard_notify, producer):
+    # The reaper used to collect socat children.
+    reaper = None
+
+    def __init__(self, locks, error_notify, discard_notify, producer,
+                 proxy=None, standby=None, reaper=None):
         super(ConnectionConsumer, self).__init__()
 
         self.locks = locks
         self.error_notify = utils.callback(error_notify)
         self.discard_notify = utils.callback(discard_notify)
         self.producer = producer
+        self.proxy = proxy
+        self.reaper = reaper
 
         self.portmap = {}
-        self.postponed = []
-        self.standby = {}
+        self.standby = standby if standby is not None else {}
         self.children = {}
 
+        # Connections that couldn't be handled yet wait in a FIFO queue
+        # for their port. The queues are only retried when something has
+        # happened that may let them through (ready is set): a lock was
+        # released, the backends changed or a standby entry expired.
+        self.waiting = {}
+        self.ready = False
+        self.retried = time.time()
+
+        # Children that have exited, but haven't yet been reaped.
+        # NOTE: This is appended to without our lock (see exited()).
+        self.dead = collections.deque()
+
+        # Live accounting for each backend (see metrics()).
+        # We track when each child started, and for relays
+        # the bytes that have already been accounted for.
+        self.stats = {}
+        self.started = {}
+        self.reported = {}
+        self.last_metrics = time.time()
+
+        # A heap of (deadline, ip, port) for standby entries.
+        # NOTE: Entries are not removed from the heap when a client
+        # reconnects, they are just skipped if they no longer match.
+        self.deadlines = []
+
         # Subscribe to events generated by the producer.
         # NOTE: These are cleaned up in stop().
         self.producer.subscribe(self.notify)
@@ -134,6 +229,7 @@ class ConnectionConsumer(AtomicRunnable):
     @Atomic.sync
     def set(self, portmap):
         self.portmap = portmap
+        self.ready = True
         self._notify()
 
     @Atomic.sync
@@ -158,6 +254,32 @@ class ConnectionConsumer(AtomicRunnable):
     def notify(self):
         self._notify()
 
+    def kick(self):
+        # Called when locks have been released (possibly elsewhere).
+        # NOTE: This may be called from a Zookeeper watch, so we can't
+        # block on our lock here (we may be holding it while waiting on
+        # Zookeeper). If we can't get it, the consumer is busy and will
+        # see the ready flag before it goes back to sleep.
+        self.ready = True
+        if self._cond.acquire(False):
+            try:
+                self._notify()
+            finally:
+                self._cond.release()
+
+    def exited(self, child):
+        # Called when a child exits (from the reaper or proxy loop).
+        # NOTE: We hold our lock while draining a batch of accepts, so
+        # we can't block on it here without stalling every relay on the
+        # proxy loop. The child is queued without the lock (unknown ones
+        # are skipped when reaped), and the consumer is woken as in kick().
+        self.dead.append(child)
+        if self._cond.acquire(False):
+            try:
+                self._notify()
+            finally:
+                self._cond.release()
+
     @Atomic.sync
     def handle(self, connection):
         # Index by the destination port.
@@ -167,19 +289,14 @@ class ConnectionConsumer(AtomicRunnable):
             return True
 
         # Grab the information for this port.
-        (_, exclusive, disposable, reconnect, backends, client_subnets) = self.portmap[port]
+        (_, exclusive, disposable, reconnect, backends, client_subnets, mode,
+         strategy) = self.portmap[port]
 
         # Check the subnet.
-        if client_subnets:
-            subnet_okay = False
-            for subnet in client_subnets:
-                if netaddr.ip.IPAddress(str(connection.src[0])) in \
-                   netaddr.ip.IPNetwork(str(subnet)):
-                    subnet_okay = True
-                    break
-            if not subnet_okay:
-                connection.drop()
-                return True
+        # (These are compiled when the portmap is built).
+        if client_subnets and not connection.src[0] in client_subnets:
+            connection.drop()
+            return True
 
         # Find a backend IP (exclusive or not).
         ip = None
@@ -188,14 +305,21 @@ class ConnectionConsumer(AtomicRunnable):
         if exclusive:
             # See if we have a VM to reconnect to.
             if reconnect > 0:
-                existing = self.locks.find(connection.src[0])
+                # NOTE: Backends that have been removed (i.e. are
+                # draining) may still be locked for this client, but
+                # they don't get new connections, even reconnects.
+                existing = [
+                    backend for backend in self.locks.find(connection.src[0])
+                    if _as_backend(backend) in backends
+                ]
                 if len(existing) > 0:
                     (ip, port) = existing[0].split(":", 1)
                     port = int(port)
-                    if (ip, port) in self.standby:
-                        # NOTE: We will have a lock representing
-                        # this connection, but is it already held.
-                        del self.standby[(ip, port)]
+                    # NOTE: We will have a lock representing
+                    # this connection, but is it already held.
+                    # (The standby table may be shared by shards,
+                    # so we rely on pop() being atomic here).
+                    self.standby.pop((ip, port), None)
             if not ip:
                 # Grab the grab the named lock (w/ ip and port).
                 candidates = ["%s:%d" % backend for backend in backends]
@@ -205,81 +329,145 @@ class ConnectionConsumer(AtomicRunnable):
                     (ip, port) = got.split(":", 1)
                     port = int(port)
         else:
-            # Select an IP at random.
-            (ip, port) = backends[random.randint(0, len(backends)-1)]
+            # Select an IP using the configured strategy.
+            (ip, port) = strategy.select()
 
         if ip and port:
-            # Either redirect or drop the connection.
-            child = connection.redirect(ip, port)
             standby_time = (exclusive and reconnect)
 
-            if child is not None:
-                # Start a notification thread. This will
-                # wake up the main consumer thread (so that
-                # the child can be reaped) when the child exits,
-                # but it will also mark the IP as failed if
-                # an error ultimately lead to the exit.
-                def closure(child_pid, error_fn, notify_fn):
-                    def fn():
-                        while True:
-                            try:
-                                (pid, status) = os.waitpid(child_pid, 0)
-                                if pid == child_pid:
-                                    break
-                            except (TypeError, OSError):
-                                (pid, status) = (child_pid, 0)
-                                break
-
-                        if os.WEXITSTATUS(status) > 0:
-                            # Notify the high-level manager about an error
-                            # found on this IP. This may ultimately result in
-                            # the instance being terminated, etc.
-                            error_fn()
-
-                        # Wait up the consumer that it may reap this
-                        # process and accept any new incoming connections.
-                        notify_fn()
+            def error_fn():
+                self.error_notify("%s:%d" % (ip, port))
 
+            if mode == "native" and self.proxy is not None and proxy.available():
+                # Relay the connection in-process. The relay will
+                # let us know when it's done (via the proxy loop),
+                # so there's no need for a thread to wait on it.
+                def closure(error_fn, exited_fn):
+                    def fn(relay, error):
+                        if error:
+                            error_fn()
+                        exited_fn(relay)
                     return fn
+                child = connection.relay(self.proxy, ip, port,
+                    closed=closure(error_fn, utils.callback(self.exited)))
+                if child is not None:
+                    self.children[child] = (
+                        ip,
+                        port,
+                        connection,
+                        standby_time,
+                        disposable)
+                    strategy.acquire((ip, port))
+                    self._opened(child, ip, port, connection.accepted)
+                    return True
+                return False
 
-                # Start threads that will wait for the child process.
-                # NOTE: Unlike most other threads in the system, these
-                # threads are *not* daemon threads. We want them to keep
-                # everything alive so that our Zookeeper locks are properly
-                # maintained while the socat processes are alive.
-                def error_fn():
-                    self.error_notify("%s:%d" % (ip, port))
-                t = threading.Thread(target=closure(
-                    child, error_fn, utils.callback(self.notify)))
-                t.start()
+            # Either redirect or drop the connection.
+            # The reaper will let us know when the child exits, and
+            # whether an error ultimately lead to the exit. In that
+            # case we notify the high-level manager about an error
+            # found on this IP. This may ultimately result in the
+            # instance being terminated, etc.
+            def closure(error_fn, exited_fn):
+                def fn(child, status):
+                    if os.WIFEXITED(status) and os.WEXITSTATUS(status) > 0:
+                        error_fn()
+                    exited_fn(child)
+                return fn
+            child = connection.redirect(ip, port, reaper=self.reaper,
+                exited=closure(error_fn, utils.callback(self.exited)))
 
+            if child is not None:
                 self.children[child] = (
                     ip,
                     port,
                     connection,
                     standby_time,
                     disposable)
+                strategy.acquire((ip, port))
+                self._opened(child, ip, port, connection.accepted)
 
                 return True
 
         return False
 
+    def _release(self, ip, port, disposable):
+        # If backends are disposable, discard this backend.
+        if disposable:
+            self.discard_notify(ip)
+        else:
+            # Remove the named lock (w/ port).
+            self.locks.remove("%s:%d" % (ip, port))
+
+        # Someone waiting may be able to use it now.
+        self.ready = True
+
     @Atomic.sync
     def clear_standby(self, force=False):
-        removed = []
+        removed = 0
+
+        if force:
+            for ((ip, port), (_, disposable)) in self.standby.items():
+                # Claim the entry. If another shard got
+                # to it first, then we leave it alone.
+                if self.standby.pop((ip, port), None) is None:
+                    continue
+                self._release(ip, port, disposable)
+                removed += 1
+            self.deadlines = []
+            return removed
+
+        # Only look at the entries that have expired.
         now = time.time()
-        for ((ip, port), timeout, disposable) in self.standby.items():
-            if force or timeout < now:
-                # If backends are disposable, discard this backend.
-                if disposable:
-                    self.discard_notify(ip)
-                else:
-                    # Remove the named lock (w/ port).
-                    self.locks.remove("%s:%d" % (ip, port))
-                removed.append((ip, port))
-        for (ip, port) in removed:
-            del self.standby[(ip, port)]
-        return len(removed)
+        while self.deadlines and self.deadlines[0][0] < now:
+            (deadline, ip, port) = heapq.heappop(self.deadlines)
+            entry = self.standby.pop((ip, port), None)
+            if entry is None:
+                # The client has reconnected (or another
+                # shard has already cleared this entry).
+                continue
+            (timeout, disposable) = entry
+            if timeout != deadline:
+                # This is a newer entry, put it back.
+                self.standby.setdefault((ip, port), entry)
+                continue
+            self._release(ip, port, disposable)
+            removed += 1
+        return removed
+
+    def service(self):
+        # Retry the waiting connections for each port, in order.
+        # We stop at the first connection that can't be handled,
+        # as the ones behind it would be competing for the same
+        # backends (this keeps things fair and the cost bounded).
+        handled = 0
+        for port in self.waiting.keys():
+            queue = self.waiting[port]
+            while queue:
+                if not self.handle(queue[0]):
+                    break
+                queue.popleft()
+                handled += 1
+            if not queue:
+                del self.waiting[port]
+        return handled
+
+    def _timeout(self):
+        # Figure out how long we can sleep for.
+        timeout = None
+        if self.dead or (self.waiting and self.ready):
+            return 0.0
+        if self.waiting:
+            timeout = max(self.retried + RETRY_INTERVAL - time.time(), 0.0)
+        if self.deadlines:
+            expiry = max(self.deadlines[0][0] - time.time(), 0.0)
+            if timeout is None or expiry < timeout:
+                timeout = expiry
+        if self.children and (timeout is None or timeout > RETRY_INTERVAL):
+            # We may miss a wakeup from exited() (if it raced with
+            # going to sleep), so don't leave exits for too long.
+            timeout = RETRY_INTERVAL
+        return timeout
 
     @Atomic.sync
     def run(self):
@@ -288,69 +476,75 @@ class ConnectionConsumer(AtomicRunnable):
 
             # Service connection, if any.
             if connection:
-                if not self.handle(connection):
-                    # now, we add it to the list of postponed
-                    # connections, which we will try again shortly.
-                    self.postponed.append(connection)
+                port = connection.dst[1]
+                if self.waiting.get(port) or not self.handle(connection):
+                    # Now, we add it to the queue of waiting connections
+                    # for this port, which will be retried when possible.
+                    # (If there are already connections waiting, then
+                    # this one has to go to the back of the line).
+                    if not port in self.waiting:
+                        self.waiting[port] = collections.deque()
+                    self.waiting[port].append(connection)
 
                 # Continue servicing connections while
                 # there is an active queue in the producer.
                 continue
 
-            # Try servicing postponed connections.
-            new_postponed = []
-            for connection in self.postponed:
-                if not self.handle(connection):
-                    # Arg, still not handled. We keep the connection
-                    # on our list of postponed connections and continue.
-                    new_postponed.append(connection)
-            self.postponed = new_postponed
-
-            # Clear any standby IPs.
-            if self.clear_standby():
+            # Reap children and clear any expired standby IPs.
+            # (Either of these may release locks, setting ready).
+            self.reap_children()
+            self.clear_standby()
+
+            # Try servicing waiting connections.
+            if self.waiting and \
+               (self.ready or time.time() >= self.retried + RETRY_INTERVAL):
+                self.ready = False
+                self.retried = time.time()
+                self.service()
                 continue
 
-            # Reap children.
-            if self.reap_children():
-                continue
-
-            # Wait for a second.
-            # This will be waken by either producer events,
-            # or by more backends appearing that may make
-            # available new backends for us to schedule.
-            # The only event that won't wake this is an
-            # existing connection expiring.
-            self._wait(1.0)
+            # Wait for something to happen.
+            # This will be woken by producer events, children exiting,
+            # or by more backends appearing that may make available new
+            # backends for us to schedule. The timeout covers standby
+            # entries expiring and locks released elsewhere.
+            self._wait(self._timeout())
 
     def reap_children(self):
         reaped = 0
 
         # Reap dead children.
-        for child in self.children.keys():
-            try:
-                # Check if child is alive.
-                os.kill(child, 0)
-            except OSError:
-                # Not alive - remove from children list.
-                (ip, port, _, standby_time, disposable) = self.children[child]
-                del self.children[child]
-                reaped += 1
-
-                # If reconnect and exclusive is on, then
-                # we add this connection to the standby list.
-                # NOTE: At this point, you only get on the standby
-                # list if the IP is exclusive and with reconnect.
-                # This means that it will *not* get selected again
-                # and the only necessary means of removing the IP
-                # is through the clear_standby() hook.
-                if standby_time:
-                    self.standby[(ip, port)] = \
-                        (time.time() + standby_time, disposable)
-                else:
-                    if disposable:
-                        self.discard_notify(ip)
-                    else:
-                        self.locks.remove("%s:%d" % (ip, port))
+        while self.dead:
+            child = self.dead.popleft()
+            if not child in self.children:
+                continue
+
+            # Remove from children list.
+            (ip, port, connection, standby_time, disposable) = \
+                self.children[child]
+            del self.children[child]
+            reaped += 1
+
+            # Update the active count for balancing.
+            # (The listen port may have been removed or changed).
+            listen = self.portmap.get(connection.dst[1])
+            if listen is not None:
+                listen[7].release((ip, port))
+            self._closed(child, ip, port)
+
+            # If reconnect and exclusive is on, then
+            # we add this connection to the standby list.
+            # NOTE: At this point, you only get on the standby
+            # list if the IP is exclusive and with reconnect.
+            # This means that it will *not* get selected again
+            # and the only necessary means of removing the IP
+            # is through the clear_standby() hook.
+            if standby_time:
+                deadline = time.time() + standby_time
+                self.standby[(ip, port)] = (deadline, disposable)
+                heapq.heappush(self.deadlines, (deadline, ip, port))
+            else:
+                self._release(ip, port, disposable)
 
         # Return the number of children reaped.
         # This means that callers can do if self.reap_children().
@@ -359,43 +553,73 @@ class ConnectionConsumer(AtomicRunnable):
     @Atomic.sync
     def pending(self):
         pending = {}
-        for connection in self.postponed:
-            # Index by the destination port.
-            port = connection.dst[1]
+        for (port, queue) in self.waiting.items():
             if not(self.portmap.has_key(port)):
                 continue
 
-            # Get the associated URL for the postponed connection.
-            (url, _, _, _, _, _) = self.portmap[port]
-            if not pending.has_key(url):
-                pending[url] = 1
-            else:
-                pending[url] += 1
+            # Get the associated URL for the waiting connections.
+            (url, _, _, _, _, _, _, _) = self.portmap[port]
+            pending[url] = pending.get(url, 0) + len(queue)
         return pending
 
+    def _backend_stats(self, ip, port):
+        backend = "%s:%d" % (ip, port)
+        if not backend in self.stats:
+            self.stats[backend] = stats.BackendStats()
+        return self.stats[backend]
+
+    def _opened(self, child, ip, port, accepted=None):
+        # Note how long the client waited for a backend
+        # (including any time spent in the waiting queue).
+        now = time.time()
+        self.started[child] = now
+        wait = None
+        if accepted is not None:
+            wait = max(now - accepted, 0.0)
+        self._backend_stats(ip, port).open(wait=wait)
+
+    def _transferred(self, child, backend_stats):
+        # Account for any bytes relayed since we last looked.
+        # (We can't see the traffic that goes through socat).
+        if not isinstance(child, proxy.Relay):
+            return
+        (bytes_in, bytes_out) = child.transferred()
+        (seen_in, seen_out) = self.reported.get(child, (0, 0))
+        backend_stats.transfer(bytes_in - seen_in, bytes_out - seen_out)
+        self.reported[child] = (bytes_in, bytes_out)
+
+    def _closed(self, child, ip, port):
+        backend_stats = self._backend_stats(ip, port)
+        self._transferred(child, backend_stats)
+        self.reported.pop(child, None)
+        started = self.started.pop(child, time.time())
+        latency = None
+        if isinstance(child, proxy.Relay):
+            latency = child.latency()
+        backend_stats.close(time.time() - started, latency=latency)
+
     @Atomic.sync
     def metrics(self):
-        metric_map = {}
+        # Pick up the traffic for live relays.
+        for (child, (ip, port, _, _, _)) in self.children.items():
+            self._transferred(child, self._backend_stats(ip, port))
 
-        # Set the active metric for all known backends to zero.
-        for (_, _, _, _, backends, _) in self.portmap.values():
+        # Report all known backends (even if unused).
+        for (_, _, _, _, backends, _, _, _) in self.portmap.values():
             for (ip, port) in backends:
-                metric_map[ip] = [{ "active" : (1, 0) }]
+                self._backend_stats(ip, port)
 
-        # Add 1 for every active connection we're tracking.
-        ports = ["%s:%d" % (ip, port) for (ip, port, _, _, _) in self.children.values()]
-        ports.extend(["%s:%d" % (ip, port) for (ip, port) in self.standby.keys()])
+        now = time.time()
+        elapsed = now - self.last_metrics
+        self.last_metrics = now
 
-        for port in ports:
-            if not port in metric_map:
-                # Set the current active count to one.
-                # NOTE: This must be an ip that is no longer
-                # in the portmap, but we can still report it.
-                metric_map[port] = [{ "active" : (1, 1) }]
-            else:
-                # Add one to our current active count.
-                cur_count = metric_map[ip]["active"][0][1]
-                metric_map[port]["active"][0] = (1, cur_count+1)
+        metric_map = {}
+        for (backend, backend_stats) in self.stats.items():
+            metric_map[backend] = [backend_stats.snapshot(elapsed)]
+            # Stop tracking backends that have gone away.
+            # (They are reported one last time above).
+            if backend_stats.idle():
+                del self.stats[backend]
 
         return metric_map
 
@@ -413,6 +637,18 @@ class ConnectionConsumer(AtomicRunnable):
             session_map[portinfo] = ip_sessions
         return session_map
 
+    @Atomic.sync
+    def drop_backend(self, ip, port):
+        # Cut off all connections to the given backend,
+        # and release it if it is held for a reconnect.
+        for (child, (child_ip, child_port, _, _, _)) in self.children.items():
+            if child_ip == ip and child_port == port:
+                _child_kill(child)
+        entry = self.standby.pop((ip, port), None)
+        if entry is not None:
+            (_, disposable) = entry
+            self._release(ip, port, disposable)
+
     @Atomic.sync
     def drop_session(self, client, backend):
         for child in self.children.keys():
@@ -420,11 +656,7 @@ class ConnectionConsumer(AtomicRunnable):
             (src_ip, src_port) = conn.src
             portinfo = "%s:%d" % (ip, port)
             if client == _as_client(src_ip, src_port) and backend == portinfo:
-                try:
-                    os.kill(child, signal.SIGTERM)
-                except OSError:
-                    # The process no longer exists.
-                    pass
+                _child_kill(child)
 
 class ConnectionProducer(AtomicRunnable):
 
@@ -436,17 +668,25 @@ class ConnectionProducer(AtomicRunnable):
     # above, and when these objects are deleted,
     # they will explicitly drop the connection.
 
-    def __init__(self):
+    # Whether listeners are opened with SO_REUSEPORT.
+    # This allows several producers to listen on the same
+    # ports, with the kernel balancing connections across them.
+    reuseport = False
+
+    def __init__(self, reuseport=False):
         super(ConnectionProducer, self).__init__()
 
+        self.reuseport = reuseport
         self.epoll = None
         self.queue = Queue.Queue()
         self.sockets = {}
         self.filemap = {}
+        self.backlogs = {}
+        self.counters = {}
         self.notifiers = []
-        self.set()
 
         self._update_epoll()
+        self.set()
 
         # Start the thread.
         super(ConnectionProducer, self).start()
@@ -464,29 +704,47 @@ class ConnectionProducer(AtomicRunnable):
         self.join()
 
     @Atomic.sync
-    def set(self, ports=None):
+    def set(self, ports=None, backlogs=None):
         if ports is None:
             ports = []
+        if backlogs is None:
+            backlogs = {}
 
         # Set the appropriate ports.
         for port in ports:
-            if not(self.sockets.has_key(port)):
+            backlog = backlogs.get(port, DEFAULT_BACKLOG)
+            if self.sockets.has_key(port):
+                # Adjust the backlog if it's changed.
+                # (Calling listen() again just updates it).
+                if self.backlogs.get(port, backlog) != backlog:
+                    self.sockets[port].listen(backlog)
+                    self.backlogs[port] = backlog
+            else:
                 sock = socket.socket()
                 sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if self.reuseport:
+                    try:
+                        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+                    except (socket.error, IOError) as e:
+                        logging.warning("Can't share port %d: %s", port, e)
                 try:
                     sock.bind(("", port))
                 except IOError as ioe:
                     # Can't bind this port (likely already in use), so skip it.
                     logging.warning("Can't bind port %d: %s", port, ioe.strerror)
                     continue
-                sock.listen(10)
+                sock.listen(backlog)
+                sock.setblocking(0)
                 self.sockets[port] = sock
                 self.filemap[sock.fileno()] = sock
+                self.backlogs[port] = backlog
+                self._register(sock.fileno())
 
         ports_to_delete = []
         for port in self.sockets:
             if not(port in ports):
                 sock = self.sockets[port]
+                self._unregister(sock.fileno())
                 del self.filemap[sock.fileno()]
                 sock.close()
                 ports_to_delete.append(port)
@@ -494,15 +752,44 @@ class ConnectionProducer(AtomicRunnable):
         # Clean old ports out after iterating.
         for port in ports_to_delete:
             del self.sockets[port]
-
-        self._update_epoll()
+            self.backlogs.pop(port, None)
 
     @Atomic.sync
     def _update_epoll(self):
+        # Rebuild the epoll object from scratch.
+        # NOTE: This is only needed on construction, as
+        # listeners are (un)registered as they come and go.
         self.epoll = select.epoll()
         for sock in self.sockets.values():
             self.epoll.register(sock.fileno(), select.EPOLLIN)
 
+    def _register(self, fileno):
+        self.epoll.register(fileno, select.EPOLLIN)
+
+    def _unregister(self, fileno):
+        try:
+            self.epoll.unregister(fileno)
+        except (IOError, OSError, ValueError):
+            # Not registered (or the epoll is closed).
+            pass
+
+    @Atomic.sync
+    def _count(self, port, accepted, saturated):
+        (total, overflows) = self.counters.get(port, (0, 0))
+        if saturated:
+            overflows += 1
+        self.counters[port] = (total + accepted, overflows)
+
+    @Atomic.sync
+    def stats(self):
+        """
+        Returns the accept counters for each port, as a map of
+        port -> (accepted, saturated), where saturated counts the
+        times that we found the accept queue full (i.e. the kernel
+        may have been dropping connections for this port).
+        """
+        return dict(self.counters)
+
     @Atomic.sync
     def subscribe(self, cb):
         self.notifiers.append(cb)
@@ -538,21 +825,43 @@ class ConnectionProducer(AtomicRunnable):
             # Scan the events and accept.
             for fileno, event in events:
                 if not(fileno in self.filemap):
-                    # Stale connection. Update epoll.
-                    self._update_epoll()
+                    # Stale connection. Drop it from epoll.
+                    self._unregister(fileno)
                     continue
 
                 # Check that it's a read event.
                 assert (event & select.EPOLLIN) == select.EPOLLIN
 
-                # Create a new connection object.
+                # Drain the accept queue.
+                # The listeners are non-blocking, so we simply
+                # accept until there's nothing left (or we've
+                # done a full batch and need to let others go).
                 sock = self.filemap[fileno]
-                connection = Accept(sock)
+                port = sock.getsockname()[1]
+                accepted = 0
+                while accepted < ACCEPT_BATCH:
+                    try:
+                        connection = Accept(sock)
+                    except (socket.error, IOError) as e:
+                        if e.errno == errno.EINTR or \
+                           e.errno == errno.ECONNABORTED:
+                            continue
+                        if e.errno != errno.EAGAIN and \
+                           e.errno != errno.EWOULDBLOCK:
+                            logging.warning("Accept failed on port %s: %s", port, e)
+                        break
+                    self.queue.put(connection)
+                    accepted += 1
+
+                # If we pulled a full backlog worth of connections
+                # out of the queue, it was likely overflowing.
+                backlog = self.backlogs.get(port, DEFAULT_BACKLOG)
+                self._count(port, accepted, accepted >= min(backlog, ACCEPT_BATCH))
 
                 # Notify all listens that there
                 # are new connections available.
-                self.queue.put(connection)
-                self.notify()
+                if accepted > 0:
+                    self.notify()
 
 class TcpEndpointConfig(Config):
 
@@ -565,46 +874,137 @@ class TcpEndpointConfig(Config):
         description="Discard backend instances on disconnect. Requires" \
                     + " 'One VM per connection'.")
 
+    backlog = Config.integer(label="Listen Backlog", default=DEFAULT_BACKLOG,
+        validate=lambda self: self.backlog > 0 or \
+            Config.error("The backlog must be positive."),
+        description="Depth of the queue for connections waiting to be accepted.")
+
     reconnect = Config.integer(label="Reconnect Timeout", default=60,
         validate=lambda self: self.reconnect >= 0 or \
             Config.error("The reconnect must be non-negative."),
         description="Amount of time a disconnected client has to reconnect before" \
                     + " the VM is returned to the pool.")
 
+    drain_timeout = Config.integer(label="Drain Timeout", default=0,
+        validate=lambda self: self.drain_timeout >= 0 or \
+            Config.error("The drain timeout must be non-negative."),
+        description="Amount of time connections to a removed backend have to" \
+                    + " finish before they are dropped (zero waits forever).")
+
     client_subnets = Config.list(label="Client Subnets", order=7,
         description="Only allow connections from these client subnets.")
 
+    balance = Config.select(label="Balancing", default="weighted",
+        options=[
+            ("Weighted random", "weighted"),
+            ("Least connections", "least"),
+            ("Power of two choices", "p2c")],
+        description="How backends are selected, when not using" \
+                    + " 'One VM per connection'.")
+
+    proxy = Config.select(label="Proxy Mode", default="socat",
+        options=[
+            ("In-process", "native"),
+            ("Socat", "socat")],
+        description="How connections are relayed to backends. In-process" \
+                    + " relaying falls back to socat where unavailable, and" \
+                    + " its connections do not outlive the manager.")
+
+class TcpManagerConfig(Config):
+
+    shards = Config.integer(label="Accept Shards", default=1,
+        validate=lambda self: self.shards > 0 or \
+            Config.error("Shards must be positive."),
+        description="Number of listeners per port (using SO_REUSEPORT)," \
+                    + " each with its own connection consumer.")
+
+    proxy_loops = Config.integer(label="Proxy Loops", default=1,
+        validate=lambda self: self.proxy_loops > 0 or \
+            Config.error("Proxy loops must be positive."),
+        description="Number of event loops used for in-process relaying.")
+
 class Connection(LoadBalancerConnection):
 
     """ Managed TCP """
 
+    _MANAGER_CONFIG_CLASS = TcpManagerConfig
     _ENDPOINT_CONFIG_CLASS = TcpEndpointConfig
     _SUPPORTED_URLS = {
         "tcp://([1-9][0-9]*)": lambda m: int(m.group(1))
     }
 
-    producer = None
-    consumer = None
+    shards = None
+    standby = None
+    locks = None
+    proxy = None
+    reaper = None
+    backlogs = None
+    draining = None
 
     def __init__(self, zkobj=None, error_notify=None,
                  discard_notify=None, **kwargs):
         super(Connection, self).__init__(**kwargs)
 
         self.portmap = {}
-        self.active = set()
-        self.locks = zkobj and zkobj._cast_as(IPAddresses)
+        self.backlogs = {}
 
-        self.producer = ConnectionProducer()
-        self.consumer = ConnectionConsumer(self.locks, error_notify,
-                                           discard_notify, self.producer)
+        # Backends that have been removed, but still have connections.
+        # These map (ip, port) => deadline (or None to wait forever).
+        self.draining = {}
+        self.active = set()
+        self.locks = zkobj and zkobj._cast_as(IPLocks)
+        self.proxy = proxy.Proxy(loops=self._manager_config().proxy_loops)
+        self.reaper = reaper.Reaper()
+
+        # Build our shards.
+        # Each shard has its own listeners and its own consumer, so
+        # they don't contend with each other when accepting. The only
+        # state they share is the lock table (and standby entries for
+        # those locks), the proxy and the reaper. Metrics are combined below.
+        num_shards = self._manager_config().shards
+        standby = {}
+        self.standby = standby
+        self._last_stats = {}
+        self._last_time = time.time()
+        self.shards = []
+        for _ in range(num_shards):
+            producer = ConnectionProducer(reuseport=(num_shards > 1))
+            consumer = ConnectionConsumer(self.locks, error_notify,
+                                          discard_notify, producer,
+                                          proxy=self.proxy,
+                                          standby=standby,
+                                          reaper=self.reaper)
+            self.shards.append((producer, consumer))
+
+        # Mirror the locks locally.
+        # (Consumers are kicked whenever locks are released,
+        # since their waiting connections may now be handled).
+        if self.locks:
+            self.locks.watch(released=self._released)
+
+    def _released(self):
+        for (_, consumer) in self.shards or []:
+            consumer.kick()
 
     def __del__(self):
-        if self.producer:
-            self.producer.set([])
-            self.producer.stop()
-        if self.consumer:
-            self.consumer.set([])
-            self.consumer.stop()
+        if self.locks:
+            self.locks.unwatch()
+
+        for (producer, consumer) in self.shards or []:
+            producer.set([])
+            producer.stop()
+            consumer.set([])
+            consumer.stop()
+
+        # Stop relaying connections.
+        # NOTE: This is done after the consumers have stopped,
+        # relays that are torn down will call back into them.
+        if self.proxy:
+            self.proxy.stop()
+
+        # The reaper keeps running until the last child exits.
+        if self.reaper:
+            self.reaper.stop()
 
     def dropped(self, ip):
         # Ensure the locks are gone.
@@ -619,23 +1019,49 @@ class Connection(LoadBalancerConnection):
             if backend.port == listen and
                is_local(backend.ip)]
 
+        config = self._endpoint_config(config)
+
         # Clear existing data.
+        # (We hang on to the strategy, so that it can be
+        # reused or its active counts carried over).
+        previous = None
+        removed = []
         if self.portmap.has_key(listen):
+            previous = self.portmap[listen][7]
+            removed = self.portmap[listen][4]
             del self.portmap[listen]
+        if self.backlogs.has_key(listen):
+            del self.backlogs[listen]
 
         if len(looping_ips) > 0:
             logging.error("Attempted TCP loop.")
             return
 
+        # Backends that are gone start draining. They won't
+        # be given any new connections, and are dropped once
+        # their connections finish (see _drain() below).
+        current = set([(backend.ip, backend.port) for backend in backends])
+        deadline = None
+        if config.drain_timeout > 0:
+            deadline = time.time() + config.drain_timeout
+        for backend in removed:
+            if not backend in current:
+                self.draining.setdefault(backend, deadline)
+        for backend in current:
+            self.draining.pop(backend, None)
+
         # If no backends, don't queue anything.
         if len(backends) == 0:
             return
 
         # Build our list of backends.
-        config = self._endpoint_config(config)
         portmap_backends = []
+        weights = []
         for backend in backends:
             portmap_backends.append((backend.ip, backend.port))
+            weights.append(backend.weight)
+        strategy = balance.build(config.balance, portmap_backends,
+                                 weights=weights, previous=previous)
 
         # Update the portmap (including exclusive info).
         # NOTE: The reconnect/exclusive/client_subnets parameters
@@ -648,20 +1074,106 @@ class Connection(LoadBalancerConnection):
             config.disposable,
             config.reconnect,
             portmap_backends,
-            config.client_subnets)
+            subnets.SubnetMatcher(config.client_subnets),
+            config.proxy,
+            strategy)
+        self.backlogs[listen] = config.backlog
 
     def save(self):
-        self.consumer.set(self.portmap)
-        self.producer.set(self.portmap.keys())
+        for (producer, consumer) in self.shards:
+            consumer.set(self.portmap)
+            producer.set(self.portmap.keys(), backlogs=self.backlogs)
+
+    def _listener_metrics(self):
+        # Sum the accept counters across all shards.
+        stats = {}
+        for (producer, _) in self.shards:
+            for (port, (accepted, saturated)) in producer.stats().items():
+                (total, overflows) = stats.get(port, (0, 0))
+                stats[port] = (total + accepted, overflows + saturated)
+
+        # Turn the counters into per-port deltas since the last call.
+        now = time.time()
+        elapsed = max(now - self._last_time, 0.001)
+        result = {}
+        for (port, (accepted, saturated)) in stats.items():
+            (last_accepted, last_saturated) = self._last_stats.get(port, (0, 0))
+            result[port] = (
+                float(max(accepted - last_accepted, 0)) / elapsed,
+                max(saturated - last_saturated, 0))
+        self._last_stats = stats
+        self._last_time = now
+        return result
 
     def metrics(self):
-        return self.consumer.metrics()
+        # Collect the metrics from all shards.
+        collected = {}
+        for (_, consumer) in self.shards:
+            for (backend, backend_metrics) in consumer.metrics().items():
+                collected.setdefault(backend, []).extend(backend_metrics)
+
+        # Backends held in standby are still in use.
+        # NOTE: The standby table is shared by the shards,
+        # so this is counted here rather than by each one.
+        for (ip, port) in (self.standby or {}).keys():
+            collected.setdefault("%s:%d" % (ip, port), []).append(
+                { "active" : (1, 1) })
+
+        # Report the listener stats alongside each backend.
+        # NOTE: Overflows count the times we found the accept queue
+        # full, which is a strong hint that connections were dropped.
+        for (port, (rate, overflows)) in self._listener_metrics().items():
+            if not port in self.portmap:
+                continue
+            for (ip, backend_port) in self.portmap[port][4]:
+                collected.setdefault("%s:%d" % (ip, backend_port), []).append({
+                    "active" : (1, 0),
+                    "accepts" : (1, rate),
+                    "overflows" : (1, overflows),
+                })
+
+        # Totals are summed, the rest are weighted averages.
+        metrics = dict([
+            (backend, [stats.merge(backend_metrics)])
+            for (backend, backend_metrics) in collected.items()
+        ])
+        self._drain(metrics)
+        return metrics
+
+    def _drain(self, metrics):
+        # Check on the backends that are draining. Those without
+        # connections are done, and those past their deadline are
+        # cut off. The rest are still reported as active, so the
+        # instances behind them are not deleted (see the manager).
+        # NOTE: This runs as metrics are collected, so the timeout
+        # is only as precise as the manager's update interval.
+        now = time.time()
+        for ((ip, port), deadline) in self.draining.items():
+            backend = "%s:%d" % (ip, port)
+            (_, active) = metrics.get(backend, [{}])[0].get("active", (1, 0))
+            if active == 0:
+                logging.info("Backend %s drained.", backend)
+                del self.draining[(ip, port)]
+                continue
+            if deadline is not None and now >= deadline:
+                logging.warn("Backend %s drain timeout (%d active).", backend, active)
+                for (_, consumer) in self.shards:
+                    consumer.drop_backend(ip, port)
 
     def sessions(self):
-        return self.consumer.sessions()
+        sessions = {}
+        for (_, consumer) in self.shards:
+            for (backend, clients) in consumer.sessions().items():
+                sessions.setdefault(backend, []).extend(clients)
+        return sessions
 
     def drop_session(self, client, backend):
-        self.consumer.drop_session(client, backend)
+        for (_, consumer) in self.shards:
+            consumer.drop_session(client, backend)
 
     def pending(self):
-        return self.consumer.pending()
+        pending = {}
+        for (_, consumer) in self.shards:
+            for (url, count) in consumer.pending().items():
+                pending[url] = pending.get(url, 0) + count
+        return pending
@@ -0,0 +1,395 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+"""
+An in-process TCP proxy.
+
+Rather than forking a socat process for every connection, connections are
+relayed by a small number of epoll loops. Each connection costs a pair of
+file descriptors (the client and the backend) and no additional threads or
+processes. Data is read into a single buffer per loop and written straight
+through, only the part that the destination can't take right away is kept.
+"""
+
+import os
+import time
+import errno
+import socket
+import select
+import logging
+
+from reactor.atomic import Atomic
+from reactor.atomic import AtomicRunnable
+
+# The size of the relay buffer (per loop).
+BUFFER_SIZE = 65536
+
+# Errors that just mean "try again later".
+_RETRY = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+def available():
+    return hasattr(select, "epoll")
+
+class Relay(object):
+
+    def __init__(self, loop, client, backend, closed=None, error=False,
+                 accepted=None):
+        super(Relay, self).__init__()
+        self.loop = loop
+        self.client = client
+        self.backend = backend
+        self.closed = closed
+        self.connecting = True
+        self.error = error
+        self.done = False
+
+        # Timestamps, for connection latency.
+        self.started = time.time()
+        self.accepted = accepted or self.started
+        self.connected = None
+
+        # Each direction is keyed by the source socket.
+        # We track data that has been read from the source, but
+        # not yet written to the destination, and whether the
+        # source has been closed (we've seen an EOF).
+        self._socks = {
+            client.fileno(): client,
+            backend.fileno(): backend,
+        }
+        self._peers = {
+            client.fileno(): backend,
+            backend.fileno(): client,
+        }
+        self._pending = {
+            client.fileno(): "",
+            backend.fileno(): "",
+        }
+        self._eof = {
+            client.fileno(): False,
+            backend.fileno(): False,
+        }
+        # Bytes written, by source socket.
+        # NOTE: These are only updated by the loop, but
+        # may be read from anywhere (see transferred()).
+        self._sent = {
+            client.fileno(): 0,
+            backend.fileno(): 0,
+        }
+        self._client_fd = client.fileno()
+        self._backend_fd = backend.fileno()
+
+    def fds(self):
+        return self._socks.keys()
+
+    def alive(self):
+        return not self.done
+
+    def transferred(self):
+        """ Returns (bytes in, bytes out) relative to the client. """
+        return (self._sent[self._client_fd], self._sent[self._backend_fd])
+
+    def latency(self):
+        """ Returns the time from accept to connect, if connected. """
+        if self.connected is None:
+            return None
+        return self.connected - self.accepted
+
+    def close(self):
+        # NOTE: This may be called from any thread,
+        # the relay is torn down by the loop itself.
+        self.loop.close(self)
+
+    def mask(self, fd):
+        if self.connecting:
+            if self._socks[fd] is self.backend:
+                return select.EPOLLOUT
+            return 0
+        mask = 0
+        peer_fd = self._peers[fd].fileno()
+        if not self._eof[fd] and not self._pending[fd]:
+            # Only read once we've written everything out.
+            # This applies back pressure to fast senders.
+            mask |= select.EPOLLIN
+        if self._pending[peer_fd]:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def finished(self):
+        if self.error:
+            return True
+        for fd in self._socks:
+            if not self._eof[fd] or self._pending[fd]:
+                return False
+        return True
+
+    def _send(self, fd, data):
+        # Write data read from the given source to its peer.
+        # Whatever doesn't go through now is kept for later.
+        peer = self._peers[fd]
+        try:
+            sent = peer.send(data)
+        except socket.error as e:
+            if e.errno in _RETRY:
+                sent = 0
+            else:
+                raise
+        self._sent[fd] += sent
+        self._pending[fd] = data[sent:].tobytes() \
+            if isinstance(data, memoryview) else data[sent:]
+        if not self._pending[fd] and self._eof[fd]:
+            self._shutdown(peer)
+
+    def _shutdown(self, sock):
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+
+    def handle(self, fd, event, buf):
+        """
+        Handle the given epoll event for one of our sockets.
+        Returns True when the relay is finished.
+        """
+        if self.connecting:
+            if fd != self._backend_fd:
+                # We aren't reading from the client yet, so this can
+                # only be a hangup or an error. Nothing to relay.
+                return bool(event & (select.EPOLLHUP | select.EPOLLERR))
+            if not event & (select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP):
+                return False
+            err = self.backend.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                logging.debug("Relay connect failed: %s", os.strerror(err))
+                self.error = True
+                return True
+            self.connecting = False
+            self.connected = time.time()
+            return False
+
+        sock = self._socks[fd]
+        try:
+            if event & select.EPOLLOUT:
+                # Flush whatever we have for this socket.
+                peer_fd = self._peers[fd].fileno()
+                if self._pending[peer_fd]:
+                    self._send(peer_fd, self._pending[peer_fd])
+
+            if event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                if self._eof[fd] or self._pending[fd]:
+                    # We're not interested in reading, this is a
+                    # hangup or an error on the socket. Give up.
+                    if event & (select.EPOLLHUP | select.EPOLLERR):
+                        return True
+                else:
+                    try:
+                        n = sock.recv_into(buf)
+                    except socket.error as e:
+                        if e.errno in _RETRY:
+                            return False
+                        raise
+                    if n == 0:
+                        self._eof[fd] = True
+                        self._shutdown(self._peers[fd])
+                    else:
+                        self._send(fd, memoryview(buf)[:n])
+
+        except socket.error:
+            # Connection reset, etc.
+            return True
+
+        return self.finished()
+
+class ProxyLoop(AtomicRunnable):
+
+    def __init__(self):
+        super(ProxyLoop, self).__init__()
+        self.daemon = True
+        self.epoll = select.epoll()
+        self._buffer = bytearray(BUFFER_SIZE)
+        self._relays = {}
+        self._masks = {}
+        self._closing = []
+
+        # A pipe used to wake up the loop.
+        (self._wake_r, self._wake_w) = os.pipe()
+        self.epoll.register(self._wake_r, select.EPOLLIN)
+
+        # Start the thread.
+        super(ProxyLoop, self).start()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wake_w, "x")
+        except OSError:
+            pass
+
+    @Atomic.sync
+    def add(self, relay):
+        if relay.error:
+            # Already failed, let the loop clean it up.
+            self._closing.append(relay)
+            self._wakeup()
+            return
+        for fd in relay.fds():
+            mask = relay.mask(fd)
+            self.epoll.register(fd, mask)
+            self._masks[fd] = mask
+            self._relays[fd] = relay
+
+    @Atomic.sync
+    def close(self, relay):
+        self._closing.append(relay)
+        self._wakeup()
+
+    @Atomic.sync
+    def count(self):
+        return len(set(self._relays.values()))
+
+    def stop(self):
+        super(ProxyLoop, self).stop()
+        self._wakeup()
+
+    def _finish(self, relay, closed):
+        if relay.done:
+            return
+        relay.done = True
+        for fd in relay.fds():
+            if fd in self._relays:
+                try:
+                    self.epoll.unregister(fd)
+                except (IOError, OSError):
+                    pass
+                del self._relays[fd]
+                del self._masks[fd]
+        relay.client.close()
+        relay.backend.close()
+        if relay.closed is not None:
+            closed.append(relay)
+
+    @Atomic.sync
+    def _dispatch(self, events):
+        closed = []
+
+        for (fd, event) in events:
+            if fd == self._wake_r:
+                try:
+                    os.read(self._wake_r, 4096)
+                except OSError:
+                    pass
+                continue
+
+            relay = self._relays.get(fd)
+            if relay is None:
+                # Already finished.
+                continue
+            if relay.handle(fd, event, self._buffer):
+                self._finish(relay, closed)
+                continue
+
+            # Update the interest for both sides.
+            for relay_fd in relay.fds():
+                mask = relay.mask(relay_fd)
+                if mask != self._masks[relay_fd]:
+                    self.epoll.modify(relay_fd, mask)
+                    self._masks[relay_fd] = mask
+
+        # Tear down anything that was closed elsewhere.
+        for relay in self._closing:
+            self._finish(relay, closed)
+        self._closing = []
+
+        return closed
+
+    @Atomic.sync
+    def _close_all(self):
+        closed = []
+        for relay in set(self._relays.values()):
+            self._finish(relay, closed)
+        for relay in self._closing:
+            self._finish(relay, closed)
+        self._closing = []
+        self.epoll.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        return closed
+
+    def _notify_closed(self, closed):
+        # NOTE: The callbacks are made without our lock held,
+        # since they will generally call back into the consumer.
+        for relay in closed:
+            try:
+                relay.closed(relay, relay.error)
+            except Exception:
+                logging.exception("Error in relay callback.")
+
+    def run(self):
+        while self.is_running():
+            try:
+                events = self.epoll.poll(1.0)
+            except IOError:
+                # Interrupted system call, etc.
+                continue
+            self._notify_closed(self._dispatch(events))
+        self._notify_closed(self._close_all())
+
+class Proxy(Atomic):
+
+    def __init__(self, loops=1):
+        super(Proxy, self).__init__()
+        self._size = max(loops, 1)
+        self._loops = []
+        self._next = 0
+
+    @Atomic.sync
+    def relay(self, fd, host, port, closed=None, accepted=None):
+        """
+        Relay the connection on the given file descriptor to host:port. The
+        descriptor is duplicated, so the caller should close its own copy.
+        The callback closed(relay, error) is called when the relay is done.
+        """
+        # Start the loops on first use.
+        if not self._loops:
+            self._loops = [ProxyLoop() for _ in range(self._size)]
+        loop = self._loops[self._next % len(self._loops)]
+        self._next += 1
+
+        client = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        client.setblocking(0)
+        if ":" in host:
+            backend = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        else:
+            backend = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        backend.setblocking(0)
+
+        # Start connecting (this generally completes asynchronously).
+        err = backend.connect_ex((host, port))
+        relay = Relay(loop, client, backend, closed=closed,
+                      error=(err not in (0, errno.EINPROGRESS)),
+                      accepted=accepted)
+        loop.add(relay)
+        return relay
+
+    @Atomic.sync
+    def count(self):
+        return sum([loop.count() for loop in self._loops])
+
+    @Atomic.sync
+    def stop(self):
+        for loop in self._loops:
+            loop.stop()
+        for loop in self._loops:
+            loop.join()
+        self._loops = []
@@ -0,0 +1,167 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A single reaper for forked children.
+
+Rather than having a thread block in waitpid() for every child, each child
+inherits the write end of a pipe when it is forked. The kernel closes that
+descriptor when the child exits, so the read end hangs up and the reaper
+(which polls all the read ends at once) knows that it can collect the
+child. This works from any thread, unlike a SIGCHLD handler, and doesn't
+interfere with other users of waitpid() in the process.
+"""
+
+import os
+import fcntl
+import errno
+import select
+import logging
+
+from reactor.atomic import Atomic
+from reactor.atomic import AtomicRunnable
+
+# How long to wait for a child that has hung up to become a zombie.
+LINGER_INTERVAL = 0.05
+
+def inherit(fd):
+    # Called in the child, so that fd survives exec().
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+
+class Reaper(AtomicRunnable):
+
+    def __init__(self):
+        super(Reaper, self).__init__()
+        self.epoll = select.epoll()
+        self._children = {}
+        self._lingering = set()
+
+        # A pipe used to wake up the loop.
+        (self._wake_r, self._wake_w) = os.pipe()
+        self.epoll.register(self._wake_r, select.EPOLLIN)
+
+        # Start the thread.
+        # NOTE: Like the old per-child threads, this is *not* a daemon
+        # thread. It keeps running after stop() until all children have
+        # exited, so that our Zookeeper locks are properly maintained
+        # while the socat processes are alive.
+        super(Reaper, self).start()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wake_w, "x")
+        except OSError:
+            pass
+
+    def pipe(self):
+        """
+        Returns (read_fd, write_fd). The write end should be passed to the
+        child, and the read end to watch(). Both are close-on-exec, so they
+        won't leak into unrelated children (see inherit()).
+        """
+        (rfd, wfd) = os.pipe()
+        for fd in (rfd, wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        return (rfd, wfd)
+
+    @Atomic.sync
+    def watch(self, pid, fd, exited=None):
+        """
+        Watch the child with the given pid, which holds the write end of
+        the pipe for fd. The callback exited(pid, status) is made from the
+        reaper thread once the child has been collected.
+        """
+        self._children[fd] = (pid, exited)
+        self.epoll.register(fd, select.EPOLLIN)
+
+    @Atomic.sync
+    def count(self):
+        return len(self._children)
+
+    def stop(self):
+        super(Reaper, self).stop()
+        self._wakeup()
+
+    @Atomic.sync
+    def _done(self):
+        return not self._running and not self._children
+
+    @Atomic.sync
+    def _timeout(self):
+        if self._lingering:
+            return LINGER_INTERVAL
+        return -1
+
+    def _collect(self, fd, exited):
+        (pid, callback) = self._children[fd]
+        try:
+            (wpid, status) = os.waitpid(pid, os.WNOHANG)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            # Already collected elsewhere.
+            (wpid, status) = (pid, 0)
+        if wpid == 0:
+            # The child has closed the pipe, but
+            # hasn't exited yet. Check back shortly.
+            self._lingering.add(fd)
+            return
+        self._lingering.discard(fd)
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError):
+            pass
+        os.close(fd)
+        del self._children[fd]
+        if callback is not None:
+            exited.append((callback, pid, status))
+
+    @Atomic.sync
+    def _dispatch(self, events):
+        exited = []
+        for (fd, _) in events:
+            if fd == self._wake_r:
+                try:
+                    os.read(self._wake_r, 4096)
+                except OSError:
+                    pass
+                continue
+            if fd in self._children:
+                self._collect(fd, exited)
+        for fd in list(self._lingering):
+            self._collect(fd, exited)
+        return exited
+
+    def run(self):
+        while not self._done():
+            try:
+                events = self.epoll.poll(self._timeout())
+            except IOError:
+                # Interrupted system call, etc.
+                continue
+
+            # NOTE: The callbacks are made without our lock held,
+            # since they will generally call back into the consumer.
+            for (callback, pid, status) in self._dispatch(events):
+                try:
+                    callback(pid, status)
+                except Exception:
+                    logging.exception("Error in reaper callback.")
+
+        self.epoll.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
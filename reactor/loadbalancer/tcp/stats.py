@@ -0,0 +1,129 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Live connection accounting for TCP backends.
+
+Counters are updated as connections are opened and closed (so they are
+always current), and snapshot() turns whatever has accumulated since the
+last snapshot into metrics. Distributions are published as histogram
+buckets, which are only turned into percentiles once they have been
+merged across shards and managers (see histogram.summarize()).
+"""
+
+from reactor.metrics.histogram import Histogram
+
+# Metrics that are totals (summed across shards),
+# rather than averages (weighted across shards).
+ADDITIVE = set([
+    "active",
+    "rate",
+    "bytes",
+    "bytes_in",
+    "bytes_out",
+    "accepts",
+    "overflows",
+])
+
+class BackendStats(object):
+
+    def __init__(self):
+        super(BackendStats, self).__init__()
+        self.active = 0
+        self.opened = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.durations = Histogram()
+        self.waits = Histogram()
+        self.connect_total = 0.0
+        self.connect_count = 0
+
+    def open(self, wait=None):
+        self.active += 1
+        self.opened += 1
+        if wait is not None:
+            self.waits.add(wait)
+
+    def transfer(self, bytes_in, bytes_out):
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+
+    def close(self, duration, latency=None):
+        self.active = max(self.active - 1, 0)
+        self.durations.add(duration)
+        if latency is not None:
+            self.connect_total += latency
+            self.connect_count += 1
+
+    def idle(self):
+        return self.active == 0 and self.opened == 0 and \
+            self.durations.count == 0
+
+    def snapshot(self, elapsed):
+        """
+        Returns the metrics since the last snapshot, and resets
+        everything except for the active count.
+        """
+        elapsed = max(elapsed, 0.001)
+        metrics = {
+            "active" : (1, self.active),
+            "rate" : (1, self.opened / elapsed),
+            "bytes" : (1, (self.bytes_in + self.bytes_out) / elapsed),
+            "bytes_in" : (1, self.bytes_in / elapsed),
+            "bytes_out" : (1, self.bytes_out / elapsed),
+        }
+        if self.durations.count > 0:
+            metrics["duration"] = \
+                (self.durations.count, self.durations.mean())
+            metrics.update(self.durations.as_metrics("duration"))
+        if self.waits.count > 0:
+            # The time from accept to a backend being assigned.
+            # (This is what the hot spare pool should keep low).
+            metrics["wait"] = \
+                (self.waits.count, self.waits.mean())
+            metrics.update(self.waits.as_metrics("wait"))
+        if self.connect_count > 0:
+            metrics["connect"] = \
+                (self.connect_count, self.connect_total / self.connect_count)
+
+        self.opened = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.durations.clear()
+        self.waits.clear()
+        self.connect_total = 0.0
+        self.connect_count = 0
+        return metrics
+
+def merge(metrics):
+    """
+    Merges a list of metric dictionaries (e.g. one from each shard) into
+    one. Totals are summed, and everything else is a weighted average.
+    """
+    sums = {}
+    for metric in metrics:
+        for (key, (weight, value)) in metric.items():
+            (total_weight, total) = sums.get(key, (0, 0))
+            if key in ADDITIVE:
+                sums[key] = (1, total + value)
+            else:
+                sums[key] = (total_weight + weight, total + weight * value)
+    result = {}
+    for (key, (weight, total)) in sums.items():
+        if key in ADDITIVE:
+            result[key] = (1, total)
+        else:
+            result[key] = (weight, weight and float(total) / weight or 0.0)
+    return result
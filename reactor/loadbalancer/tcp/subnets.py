@@ -0,0 +1,105 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Client subnet matching.
+
+The configured subnets are compiled (once, when the portmap changes) into
+a sorted table of disjoint integer ranges for each address family. Checking
+a client is then a parse of its address and a binary search.
+"""
+
+import socket
+import struct
+import bisect
+import logging
+import netaddr
+
+# IPv4-mapped IPv6 addresses (::ffff:a.b.c.d).
+_V4_MAPPED = 0xffff
+
+def _merge(ranges):
+    # Sort and merge overlapping (or adjacent) ranges.
+    merged = []
+    for (first, last) in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+def _parse(ip):
+    """ Returns (version, value) for the given address, or None. """
+    try:
+        return (4, struct.unpack("!I", socket.inet_pton(socket.AF_INET, ip))[0])
+    except (socket.error, TypeError, ValueError):
+        pass
+    try:
+        (high, low) = struct.unpack("!QQ", socket.inet_pton(socket.AF_INET6, ip))
+        return (6, (high << 64) | low)
+    except (socket.error, TypeError, ValueError):
+        return None
+
+class SubnetMatcher(object):
+
+    def __init__(self, subnets=None):
+        super(SubnetMatcher, self).__init__()
+        if subnets is None:
+            subnets = []
+        self.subnets = list(subnets)
+
+        ranges = { 4 : [], 6 : [] }
+        for subnet in self.subnets:
+            try:
+                network = netaddr.IPNetwork(str(subnet))
+            except (netaddr.AddrFormatError, ValueError, TypeError):
+                # NOTE: We just skip this subnet. That is, we'll
+                # be more restrictive rather than less restrictive.
+                logging.warning("Invalid client subnet: %s", subnet)
+                continue
+            ranges[network.version].append((network.first, network.last))
+
+        self._starts = {}
+        self._ends = {}
+        for (version, version_ranges) in ranges.items():
+            merged = _merge(version_ranges)
+            self._starts[version] = [first for (first, _) in merged]
+            self._ends[version] = [last for (_, last) in merged]
+
+    def __nonzero__(self):
+        # NOTE: If subnets are configured but none are valid,
+        # then we still want to filter (and match nothing).
+        return len(self.subnets) > 0
+
+    def __len__(self):
+        return len(self._starts[4]) + len(self._starts[6])
+
+    def _lookup(self, version, value):
+        starts = self._starts[version]
+        index = bisect.bisect_right(starts, value) - 1
+        return index >= 0 and value <= self._ends[version][index]
+
+    def __contains__(self, ip):
+        parsed = _parse(str(ip))
+        if parsed is None:
+            return False
+        (version, value) = parsed
+        if self._lookup(version, value):
+            return True
+        if version == 6 and (value >> 32) == _V4_MAPPED:
+            # Match IPv4 clients on dual-stack sockets.
+            return self._lookup(4, value & 0xffffffff)
+        return False
@@ -15,7 +15,6 @@
 
 import sys
 import time
-import bisect
 import traceback
 import logging
 import uuid
@@ -26,6 +25,7 @@ from . import defaults
 from . import server
 from . import ips as ips_mod
 from . import submodules
+from . import scheduler
 from . atomic import Atomic
 from . atomic import AtomicRunnable
 from . config import Config
@@ -33,11 +33,19 @@ from . eventlog import EventLog, Event
 from . zookeeper.client import ZookeeperClient
 from . zookeeper.connection import ZookeeperException
 from . zookeeper.cache import Cache
+from . zookeeper.cache import Mirror
 from . objects.root import Reactor
 from . objects.endpoint import EndpointNotFound
 from . threadpool import Threadpool
+from . scheduler import UpdateScheduler
+from . hashring import HashRing
 from . endpoint import Endpoint
 from . metrics.calculator import calculate_weighted_averages
+from . metrics.calculator import calculate_weighted_sums
+from . metrics.calculator import metrics_changed
+from . metrics import wire
+from . metrics.aggregate import MetricsIndex
+from . metrics import histogram
 from . loadbalancer import connection as lb_connection
 from . cloud import connection as cloud_connection
 
@@ -63,11 +71,28 @@ class ManagerConfig(Config):
         alternates=["health_check"],
         description="Period for decomissioning and timing out instances.")
 
+    sweep = Config.integer(label="Full Update Interval (seconds)",
+        default=60, order=1,
+        validate=lambda self: self.sweep > 0 or \
+            Config.error("Sweep interval must be positive."),
+        description="Maximum period between updates for an endpoint.")
+
+    threshold = Config.integer(label="Metrics Change Threshold (%)",
+        default=10, order=2,
+        validate=lambda self: self.threshold >= 0 or \
+            Config.error("Threshold must be non-negative."),
+        description="Change in metrics that triggers an immediate update.")
+
     keys = Config.integer(label="Keys per Manager", default=64, order=2,
         validate=lambda self: self.keys >= 0 or \
             Config.error("Keys must be non-negative."),
         description="Key count for managing services on the ring.")
 
+    workers = Config.integer(label="Update Workers", default=16, order=2,
+        validate=lambda self: self.workers > 0 or \
+            Config.error("Workers must be positive."),
+        description="Maximum number of concurrent endpoint updates.")
+
     def spec(self):
         for name in submodules.loadbalancer_submodules():
             lb_connection.get_connection(name, config=self)._manager_config()
@@ -95,6 +120,10 @@ class ManagerLog(EventLog):
         lambda args: "No manager avilable for endpoint %s!" % args[0])
     ENDPOINT_MANAGED = Event(
         lambda args: "Endpoint %s is managed (owned: %s)." % (args[0], args[1]))
+    ENDPOINT_LEASE_WAIT = Event(
+        lambda args: "Waiting for the lease on endpoint %s." % args[0])
+    ENDPOINTS_MOVED = Event(
+        lambda args: "Endpoints moved on the ring: %d" % args[0])
     ENDPOINTS_CHANGED = Event(
         lambda args: "Endpoints have changed: %s" % args[0])
     MANAGERS_CHANGED = Event(
@@ -138,12 +167,10 @@ class ScaleManager(AtomicRunnable):
 
         # Our thread pool.
         # The threadpool is used to do endpoint updates.
-        # This pool will scale automatically to accomodate as
-        # many endpoints as we have. Unfortunately, each endpoint
-        # will likely require add a thread to the size of the pool,
-        # so that will only scale to a few hundred endpoints per
-        # manager. At some point, we may have to revisit this and
-        # see how we could improve scalability for endpoints.
+        # This pool is bounded by the configured number of workers
+        # (see ManagerConfig.workers), so the thread count no longer
+        # grows with the number of endpoints. Updates for the same
+        # endpoint are coalesced while they are waiting in the queue.
         self._threadpool = Threadpool()
 
         # Manager uuid (generated).
@@ -188,6 +215,12 @@ class ScaleManager(AtomicRunnable):
         self._drop_ips_zkobj = self.zkobj.drop_ips()
         self.endpoint_ips = Cache(self.zkobj.endpoint_ips())
 
+        # Mirrors of what all managers have published.
+        # These are (re)built on each connection in serve().
+        self._metrics_mirror = None
+        self._pending_mirror = None
+        self._metrics_publisher = None
+
         # Our configuration.
         self.config = ManagerConfig()
 
@@ -202,12 +235,33 @@ class ScaleManager(AtomicRunnable):
         # manager is response for "owning" a service.
 
         self._keys = []         # Our local manager keys.
-        self._key_to_uuid = {}  # Map of manager key -> uuid.
-        self._uuid_to_info = {} # Map of manager uuid -> info.
+        self._ring = HashRing() # The ring of all managers.
 
         # Endpoint to ownership cache.
         self._uuid_to_owned = {}
 
+        # Endpoint leases.
+        # Owning an endpoint on the ring is not enough to start
+        # scaling it, we must also hold its lease (see managed()
+        # in endpoint.py). This ensures that two managers with
+        # different views of the ring never both act on it.
+        self._leased = set()     # Endpoint leases we hold.
+        self._to_release = {}    # Leases to give up (uuid -> endpoint).
+        self._updating = False   # Whether an update pass is running.
+        self._in_flight = {}     # Unfinished updates (uuid -> [(names, job)]).
+
+        # Handoff counters (see stats()).
+        self._moved = 0          # Endpoints moved on the ring.
+        self._lease_waits = 0    # Times we waited on a previous owner.
+
+        # Update scheduling.
+        # Endpoints are only updated when something has changed
+        # (see scheduler.py), or when the slow sweep comes around.
+        # We keep the metrics used for the last update of each
+        # endpoint in order to detect when they've moved.
+        self._scheduler = UpdateScheduler()
+        self._last_metrics = {}
+
         # The connections.
         # Each scale manager will auto-discover available
         # connections and attempt to use whatever validates.
@@ -231,12 +285,27 @@ class ScaleManager(AtomicRunnable):
         # watches firing, etc.
         self.client.reconnect()
 
+        # Our leases were tied to the old session.
+        self._uuid_to_owned = {}
+        self._leased = set()
+        self._to_release = {}
+
     def serve(self):
         self._reconnect()
 
         # Load our configuration and register ourselves.
         self._register()
 
+        # Mirror all published metrics and pending counts.
+        # Rather than re-reading every manager's node each time
+        # through update(), we hold a local copy that is kept fresh
+        # by watches and only changed nodes are ever fetched.
+        self._metrics_publisher = wire.Publisher()
+        self._metrics_mirror = Mirror(
+            self._managers_zkobj.metrics(),
+            merge=wire.merge)
+        self._pending_mirror = Mirror(self._managers_zkobj.pending())
+
         # Watch all managers and endpoints.
         self.manager_change(self._managers_zkobj.list_active(watch=self.manager_change))
         self.endpoint_change(self._endpoints_zkobj.list(watch=self.endpoint_change))
@@ -251,6 +320,7 @@ class ScaleManager(AtomicRunnable):
 
     def unserve(self):
         self._managers_zkobj.unregister(self._uuid)
+        self._release_all()
         self._setup_cloud_connections()
         self._setup_loadbalancer_connections()
         self._threadpool.clear()
@@ -263,34 +333,10 @@ class ScaleManager(AtomicRunnable):
         # this endpoint (for whatever reason). This could
         # also happen if they are trying to use a particular
         # loadbalancer or cloud which is no supported etc.
-        manager_key = None
-        keys = self._key_to_uuid.keys()
-        if len(keys) == 0:
+        manager_key = self._ring.owner(
+            key, cloud=cloud, loadbalancer=loadbalancer)
+        if manager_key is None:
             self.logging.error(self.logging.NO_MANAGER_AVAILABLE, key)
-        else:
-            keys.sort()
-            index = bisect.bisect(keys, key)
-            orig_index = index
-
-            while True:
-                # If this manager can satisfy this endpoint,
-                # then it will get the privilenge of owning it.
-                key = keys[index % len(keys)]
-                this_uuid = self._key_to_uuid[key]
-                (clouds, loadbalancers) = self._uuid_to_info[this_uuid]
-
-                if (not cloud or cloud in clouds) and \
-                   (not loadbalancer or loadbalancer in loadbalancers):
-                    manager_key = this_uuid
-                    break
-
-                # Continue on to the next manager.
-                # It's quite possible that we are unable to find any
-                # manager that is capable of managing this object.
-                index = (index+1) % len(keys)
-                if index == orig_index:
-                    self.logging.error(self.logging.NO_MANAGER_AVAILABLE, key)
-                    break
 
         # Return the found key.
         return (manager_key == self._uuid)
@@ -300,24 +346,71 @@ class ScaleManager(AtomicRunnable):
         # Is it in the cache?
         endpoint_uuid = endpoint.uuid()
         if endpoint_uuid in self._uuid_to_owned:
-            return self._uuid_to_owned[endpoint_uuid]
+            is_owned = self._uuid_to_owned[endpoint_uuid]
+        else:
+            # Cache whether or not this endpoint is owned by us.
+            is_owned = self._is_owned(
+                endpoint_uuid,
+                cloud=endpoint.config.cloud,
+                loadbalancer=endpoint.config.loadbalancer)
+            self._uuid_to_owned[endpoint_uuid] = is_owned
+            self.logging.info(
+                self.logging.ENDPOINT_MANAGED,
+                endpoint_uuid,
+                is_owned)
+
+        if not is_owned:
+            return False
+        if endpoint_uuid in self._leased:
+            return True
+
+        # Try to take the lease. If the previous owner hasn't
+        # yet released it, we will simply try again next time.
+        if endpoint.managed(self._uuid):
+            self._leased.add(endpoint_uuid)
+            return True
+        else:
+            self._lease_waits += 1
+            self.logging.info(self.logging.ENDPOINT_LEASE_WAIT, endpoint_uuid)
+            return False
 
-        # Cache whether or not this endpoint is owned by us.
-        is_owned = self._is_owned(
-            endpoint_uuid,
-            cloud=endpoint.config.cloud,
-            loadbalancer=endpoint.config.loadbalancer)
-        self._uuid_to_owned[endpoint_uuid] = is_owned
-        self.logging.info(
-            self.logging.ENDPOINT_MANAGED,
-            endpoint_uuid,
-            is_owned)
+    @Atomic.sync
+    def _release_leases(self, force=False):
+        # Give up any leases for endpoints that have moved.
+        # NOTE: We don't do this while updates are in flight,
+        # otherwise the new owner could start acting on the
+        # endpoint before we are finished with it.
+        if self._updating and not force:
+            return
+        for (endpoint_uuid, endpoint) in self._to_release.items():
+            if endpoint_uuid in self._in_flight and not force:
+                continue
+            try:
+                endpoint.unmanaged(self._uuid)
+            except ZookeeperException:
+                traceback.print_exc()
+            del self._to_release[endpoint_uuid]
 
-        if is_owned:
-            # Mark the endpoint as our own.
-            endpoint.managed(self._uuid)
+    @Atomic.sync
+    def _release_all(self):
+        # Hand off everything we hold (we're going away).
+        for endpoint_uuid in list(self._leased):
+            self._disown(endpoint_uuid)
+        self._uuid_to_owned = {}
+        self._release_leases(force=True)
 
-        return is_owned
+    @Atomic.sync
+    def _disown(self, endpoint_uuid, release=True):
+        # Forget our ownership and lease for the endpoint.
+        # (Optionally giving up the lease if we hold it).
+        self._uuid_to_owned.pop(endpoint_uuid, None)
+        self._scheduler.forget(endpoint_uuid)
+        self._last_metrics.pop(endpoint_uuid, None)
+        if endpoint_uuid in self._leased:
+            self._leased.remove(endpoint_uuid)
+            endpoint = self._endpoint_data.get(endpoint_uuid)
+            if release and endpoint is not None:
+                self._to_release[endpoint_uuid] = endpoint
 
     @Atomic.sync
     def _endpoint_change(self, endpoints):
@@ -331,9 +424,6 @@ class ScaleManager(AtomicRunnable):
         current_endpoints = self._endpoint_names.keys()
         current_endpoints.sort()
 
-        # Clear out the ownership cache.
-        self._uuid_to_owned = {}
-
         to_add = []
         for endpoint_name in endpoints:
             if endpoint_name not in self._endpoint_names:
@@ -364,6 +454,9 @@ class ScaleManager(AtomicRunnable):
                 self._endpoint_names.values())) == 0:
 
                 # Remove from the loadbalancer.
+                # NOTE: Only the ownership for this endpoint needs
+                # to be dropped, everything else remains as it was.
+                self._disown(endpoint_uuid)
                 self._endpoint_data[endpoint_uuid].reload(exclude=True)
                 del self._endpoint_data[endpoint_uuid]
 
@@ -375,7 +468,8 @@ class ScaleManager(AtomicRunnable):
                         zkobj,
                         collect=self.collect,
                         find_cloud_connection=self._find_cloud_connection,
-                        find_loadbalancer_connection=self._find_loadbalancer_connection)
+                        find_loadbalancer_connection=self._find_loadbalancer_connection,
+                        changed=self.endpoint_changed)
                 else:
                     # See below, we don't need to access this
                     # underlying endpoint because it already exists.
@@ -409,6 +503,12 @@ class ScaleManager(AtomicRunnable):
         # right at this point.
         self.check_endpoint_ips()
 
+    def endpoint_changed(self, endpoint_uuid, reason):
+        # NOTE: This is called from the endpoint's watches, so
+        # we don't grab our own lock. The scheduler will wake up
+        # the main loop to get this endpoint updated promptly.
+        self._scheduler.mark(endpoint_uuid, reason)
+
     def endpoint_change(self, endpoints):
         if endpoints is None:
             endpoints = []
@@ -453,6 +553,8 @@ class ScaleManager(AtomicRunnable):
 
         # Save our configuration.
         self.config = config
+        self._threadpool.resize(config.workers)
+        self._scheduler.set_sweep(config.sweep)
 
         return (loadbalancers, clouds)
 
@@ -573,17 +675,13 @@ class ScaleManager(AtomicRunnable):
 
     @Atomic.sync
     def _manager_change(self, managers):
-        # Clear out the ownership cache.
-        self._key_to_uuid = {}
-        self._uuid_to_info = {}
-        self._uuid_to_owned = {}
-
         # Rebuild our manager info.
         # NOTE: We should be included in this list ourselves. If
         # we're not -- something is definitely up and the system
         # should catch up shortly.
-        # NOTE: We allow the uuid_to_owned cache above to repopulate
-        # lazily -- there's no rush to get it all done immediately.
+        # NOTE: We only invalidate the ownership of endpoints that
+        # have actually moved, the rest of the cache remains valid.
+        ring_info = {}
         info_map = self._managers_zkobj.info_map()
         for (manager, info) in info_map.items():
             try:
@@ -595,12 +693,38 @@ class ScaleManager(AtomicRunnable):
                 continue
 
             # Save the info for this manager.
-            self._uuid_to_info[manager] = (clouds, loadbalancers)
-            for key in keys:
-                self._key_to_uuid[key] = manager
+            ring_info[manager] = (keys, clouds, loadbalancers)
+
+        # Rebuild the ring (once), and figure out what moved.
+        new_ring = HashRing(ring_info)
+        moved = self._ring.moved(new_ring, dict([
+            (endpoint_uuid, (
+                endpoint_uuid,
+                endpoint.config.cloud,
+                endpoint.config.loadbalancer))
+            for (endpoint_uuid, endpoint) in self._endpoint_data.items()
+        ]))
+        self._ring = new_ring
+
+        # Hand off the endpoints that have moved.
+        for endpoint_uuid in moved:
+            self._disown(endpoint_uuid)
+        for endpoint_uuid in self._uuid_to_owned.keys():
+            if not endpoint_uuid in self._endpoint_data:
+                # Not an endpoint that we track (we can't tell
+                # whether it moved), so it is just recomputed.
+                self._disown(endpoint_uuid)
+        self._release_leases()
+        self._moved += len(moved)
+        self.logging.info(self.logging.ENDPOINTS_MOVED, len(moved))
+
+        # Any new manager will be missing the base for our
+        # metric deltas, so make sure we publish everything.
+        if self._metrics_publisher is not None:
+            self._metrics_publisher.reset()
 
         # Print our the new managers (with clouds and loadbalancers).
-        self.logging.info(self.logging.MANAGERS_CHANGED, self._uuid_to_info)
+        self.logging.info(self.logging.MANAGERS_CHANGED, self._ring.info())
 
     def manager_change(self, managers=None):
         if managers is None:
@@ -754,31 +878,38 @@ class ScaleManager(AtomicRunnable):
         Collects the metrics from the loadbalancer, updates zookeeper and
         then collects the metrics posted by other managers.
 
-        Returns a collection of metrics, which is indexed by the endpoint key.
-        This is further indexed by the metric IP, which points to a list of
-        collected metrics (from any number of different loadbalancers).
+        Returns a MetricsIndex, which holds the metrics for every IP:port,
+        combined across all of the different loadbalancers and managers.
         """
         our_metrics = self._collect_metrics()
         self.logging.info(self.logging.LOCAL_METRICS, our_metrics)
 
         # Stuff all the metrics into Zookeeper.
-        self._managers_zkobj.set_metrics(self._uuid, our_metrics)
+        # We reduce these to sums per port, which combine trivially
+        # with the sums from other managers (see calculator.py).
+        our_table = dict([
+            (port, calculate_weighted_sums(port_metrics))
+            for (port, port_metrics) in our_metrics.items()
+        ])
+        # Nothing is written if the table hasn't changed.
+        data = self._metrics_publisher.encode(our_table)
+        if data is not None:
+            self._managers_zkobj.set_metrics(self._uuid, data)
 
         # Load all metrics (from other managers).
-        all_metrics = {}
-        metrics_map = self._managers_zkobj.metrics_map()
-
-        # Read the keys for all managers.
-        for (_, manager_metrics) in metrics_map.items():
-            if not manager_metrics:
-                continue
-            for (port, port_metrics) in manager_metrics.items():
-                if not port in all_metrics:
-                    all_metrics[port] = port_metrics[:]
-                else:
-                    all_metrics[port].extend(port_metrics)
-
-        self.logging.info(self.logging.ALL_METRICS, all_metrics)
+        # NOTE: Our own entry may not have round-tripped through
+        # the watch yet, so we always use our freshest copy.
+        metrics_map = self._metrics_mirror.as_map()
+        metrics_map[self._uuid] = (None, None, our_table)
+
+        # Ingest the tables for all managers.
+        all_metrics = MetricsIndex()
+        for (_, _, manager_table) in metrics_map.values():
+            for (port, port_sums) in manager_table.iteritems():
+                all_metrics.add(port, port_sums)
+        all_metrics.freeze()
+
+        self.logging.info(self.logging.ALL_METRICS, all_metrics.as_map())
         return all_metrics
 
     @Atomic.sync
@@ -794,7 +925,8 @@ class ScaleManager(AtomicRunnable):
 
         # Load all pending (from other managers).
         all_pending = {}
-        pending_map = self._managers_zkobj.pending_map()
+        pending_map = self._pending_mirror.as_map()
+        pending_map[self._uuid] = our_pending
 
         # Read the keys for all managers.
         for (_, manager_pending) in pending_map.items():
@@ -841,10 +973,10 @@ class ScaleManager(AtomicRunnable):
         endpoint_inactive_ips = endpoint.inactive_ips()
         endpoint_active_ports = _ips_to_ports(endpoint_active_ips)
         endpoint_inactive_ports = _ips_to_ports(endpoint_inactive_ips)
+        endpoint_ports = set(endpoint_active_ports + endpoint_inactive_ports)
 
         def _extract_metrics(port, these_metrics):
-            if not port in endpoint_active_ports and \
-               not port in endpoint_inactive_ports:
+            if not port in endpoint_ports:
                 return
             metrics.extend(these_metrics)
             metric_ports.add(port)
@@ -868,7 +1000,25 @@ class ScaleManager(AtomicRunnable):
             ip_metrics.items())
 
         # Read from all metrics.
-        map(lambda (x, y): _extract_metrics(x, y), all_metrics.items())
+        # We only look up the rows for our own ports, and these are
+        # summed together into a single entry for the averages.
+        indices = []
+        for port in endpoint_ports:
+            index = all_metrics.index(port)
+            if index is None:
+                continue
+            indices.append(index)
+            metric_ports.add(port)
+            if all_metrics.is_active(index):
+                active_ports.add(port)
+        # NOTE: Any histograms are only turned into percentiles here,
+        # once the buckets for all ports (and managers) are summed.
+        if indices:
+            sums = histogram.summarize(all_metrics.sums(indices))
+            metrics.append(dict([
+                (key, (weight, weight and total / weight))
+                for (key, (weight, total)) in sums.items()
+            ]))
 
         # Return the metrics.
         return metrics, list(metric_ports), list(active_ports)
@@ -969,7 +1119,7 @@ class ScaleManager(AtomicRunnable):
                 if not endpoint_ips.get(ip) == endpoint_uuid:
                     self.endpoint_ips.add(ip, endpoint_uuid)
 
-    def update(self, elapsed=None):
+    def update(self):
         # Update the list of sessions.
         self.update_sessions()
 
@@ -982,14 +1132,96 @@ class ScaleManager(AtomicRunnable):
         all_pending = self.update_pending()
 
         # Run endpoint updates.
-        active = self.update_endpoints(all_metrics, all_pending, elapsed=elapsed)
+        active = self.update_endpoints(all_metrics, all_pending)
         self._managers_zkobj.set_active(self._uuid, active)
 
-    def update_endpoints(self, all_metrics, all_pending, elapsed=None):
-        # List of updates.
-        update_jobs = {}
+    @Atomic.sync
+    def stats(self):
+        """
+        Returns running counters for this manager, including endpoint
+        handoffs (since we started) and the threadpool statistics.
+        """
+        return {
+            "endpoints_moved": self._moved,
+            "leases_held": len(self._leased),
+            "lease_waits": self._lease_waits,
+            "updates_in_flight": len(self._in_flight),
+            "threadpool": self._threadpool.stats(),
+        }
+
+    @Atomic.sync
+    def _track_update(self, endpoint_uuid, endpoint_names, job):
+        # NOTE: If an update for this endpoint was still queued, the
+        # threadpool hands back that same job (with the new arguments).
+        jobs = self._in_flight.setdefault(endpoint_uuid, [])
+        if not job in [other for (_, other) in jobs]:
+            jobs.append((endpoint_names, job))
+
+    @Atomic.sync
+    def _update_running(self, endpoint_uuid):
+        return any([
+            not job.done()
+            for (_, job) in self._in_flight.get(endpoint_uuid, [])
+        ])
+
+    @Atomic.sync
+    def _updates(self):
+        return [
+            job
+            for jobs in self._in_flight.values()
+            for (_, job) in jobs
+        ]
+
+    @Atomic.sync
+    def _finished_updates(self):
+        finished = []
+        for (endpoint_uuid, jobs) in self._in_flight.items():
+            for (endpoint_names, job) in jobs:
+                if job.done():
+                    finished.append((endpoint_uuid, endpoint_names, job))
+            jobs = [(names, job) for (names, job) in jobs if not job.done()]
+            if jobs:
+                self._in_flight[endpoint_uuid] = jobs
+            else:
+                del self._in_flight[endpoint_uuid]
+        return finished
+
+    def _reap_updates(self):
+        for (endpoint_uuid, endpoint_names, job) in self._finished_updates():
+            try:
+                job.join()
+                self.logging.info(self.logging.ENDPOINT_UPDATED, endpoint_names)
+            except Exception:
+                error = traceback.format_exc()
+                self.logging.warn(self.logging.ENDPOINT_ERROR, endpoint_names, error)
+
+            # Endpoints with instances in transition have timeouts
+            # running, so we keep them on the next pass until settled.
+            endpoint = self._endpoint_data.get(endpoint_uuid)
+            if endpoint is not None and endpoint.settling():
+                self._scheduler.mark(endpoint_uuid, scheduler.SETTLING, wake=False)
+
+    @Atomic.sync
+    def _set_updating(self, updating):
+        self._updating = updating
+
+    def update_endpoints(self, all_metrics, all_pending):
+        self._set_updating(True)
+        try:
+            return self._update_endpoints(all_metrics, all_pending)
+        finally:
+            self._set_updating(False)
+            self._release_leases()
+
+    def _update_endpoints(self, all_metrics, all_pending):
         total_active = 0
 
+        # Figure out which endpoints are due for an update.
+        # Everything else is only updated if the metrics move.
+        now = time.time()
+        due = self._scheduler.due(self._endpoint_data.keys(), now=now)
+        threshold = self.config.threshold / 100.0
+
         # Does a health check on all the endpoints that are being managed.
         for (endpoint_uuid, endpoint) in self._endpoint_data.items():
 
@@ -1029,23 +1261,65 @@ class ScaleManager(AtomicRunnable):
                     # has to treat pending with undue care and attention.
                     metrics["pending"] = metrics["pending"] / len(metric_ports)
 
+            # Check whether there's any reason to do the update.
+            # NOTE: Pending connections appearing is simply a change
+            # in the pending metric, so it is caught here as well.
+            reason = due.get(endpoint_uuid)
+            last = self._last_metrics.get(endpoint_uuid)
+            if reason is None and (last is None or \
+                last[1] != len(metric_ports) or \
+                last[2] != active_ports or \
+                metrics_changed(last[0], metrics, threshold)):
+                reason = scheduler.METRICS
+            if reason is None:
+                continue
+
+            # Endpoint updates are not reentrant, so an endpoint with an
+            # update still queued or running is kept for the next pass.
+            # NOTE: Since it isn't marked done, the next update interval
+            # still covers all the time since the previous update.
+            if self._update_running(endpoint_uuid):
+                logging.debug("Deferring endpoint %s (%s).", endpoint_names, reason)
+                self._scheduler.mark(endpoint_uuid, reason, wake=False)
+                continue
+            logging.debug("Updating endpoint %s (%s).", endpoint_names, reason)
+            self._last_metrics[endpoint_uuid] = \
+                (metrics, len(metric_ports), active_ports)
+
+            # Schedule the next update for the endpoint.
+            # NOTE: The update interval is the time since this
+            # endpoint was last updated, which is what the marks
+            # for timeouts are based on (see _mark_instance()).
+            update_interval = self._scheduler.done(
+                endpoint_uuid,
+                reason=reason,
+                now=now,
+                interval=endpoint.config.interval,
+                minimum=self.config.interval)
+
             # Do the endpoint update.
-            job = self._threadpool.submit(
+            job = self._threadpool.submit_keyed(
+                endpoint_uuid,
                 endpoint.update,
                 metrics=metrics,
                 metric_instances=len(metric_ports),
                 active_ports=active_ports,
-                update_interval=elapsed)
-            update_jobs[endpoint_uuid] = (endpoint_names, job)
+                update_interval=update_interval,
+                schedule=self._scheduler.info(endpoint_uuid),
+                pending=all_pending.get(endpoint.config.url, 0))
+            self._track_update(endpoint_uuid, endpoint_names, job)
+
+        # Wait for the updates to finish, but only until the interval
+        # is up. A slow endpoint is picked up on a later pass (once its
+        # update has finished, see above).
+        deadline = now + self.config.interval
+        for job in self._updates():
+            if not job.wait(max(deadline - time.time(), 0)):
+                break
+        self._reap_updates()
 
-        # Wait for all updates to finish.
-        for (endpoint_uuid, (endpoint_names, job)) in update_jobs.items():
-            try:
-                job.join()
-                self.logging.info(self.logging.ENDPOINT_UPDATED, endpoint_names)
-            except Exception:
-                error = traceback.format_exc()
-                self.logging.warn(self.logging.ENDPOINT_ERROR, endpoint_names, error)
+        # Note how the pool is keeping up.
+        logging.debug("Manager stats: %s", self.stats())
 
         # Return the total active connections.
         return total_active
@@ -1059,6 +1333,10 @@ class ScaleManager(AtomicRunnable):
             else:
                 self._wait(until-cur_time)
 
+    def stop(self):
+        super(ScaleManager, self).stop()
+        self._scheduler.poke()
+
     def run(self):
         while self.is_running():
             try:
@@ -1072,12 +1350,21 @@ class ScaleManager(AtomicRunnable):
                 self._endpoints_zkobj.clean()
 
                 # Perform continuous health checks.
-                elapsed = None
+                last_sweep = None
                 while self.is_running():
                     start_time = time.time()
-                    self.check_endpoint_ips()
-                    self.update(elapsed=elapsed)
-                    self._endpoints_zkobj.clean()
+
+                    # The housekeeping is only done on the slow sweep,
+                    # the endpoint changes that matter are caught by
+                    # watches in the meantime.
+                    sweep = last_sweep is None or \
+                        start_time - last_sweep >= self.config.sweep
+                    if sweep:
+                        self.check_endpoint_ips()
+                        last_sweep = start_time
+                    self.update()
+                    if sweep:
+                        self._endpoints_zkobj.clean()
 
                     # We only sleep for the part of the interval that
                     # we were not active for. This allows us to actually
@@ -1085,9 +1372,10 @@ class ScaleManager(AtomicRunnable):
                     # I.e., if the health_check interval is 10 seconds,
                     # and we have a few dozens endpoints we could do a
                     # decent job of calling in to each endpoint every ten
-                    # seconds.
-                    self.sleep_until(start_time + self.config.interval)
-                    elapsed = (time.time() - start_time)
+                    # seconds. If an endpoint is marked dirty while we
+                    # are waiting, or some endpoint is due sooner than
+                    # that, we wake up immediately to update it.
+                    self._scheduler.wait(start_time + self.config.interval)
 
             except ZookeeperException:
                 # Sleep on ZooKeeper exception and retry.
@@ -0,0 +1,158 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+An aggregation engine for the metrics posted by all managers.
+
+All metric sums (see calculate_weighted_sums()) for a given interval are
+ingested once into columns (one pair of weight / total columns per metric key,
+with one row per ip:port). Weighted averages for an endpoint are then computed
+by looking up the rows for its ports, rather than scanning every port posted.
+
+NumPy is used for the columns when it is available. Otherwise, we fall back
+to the standard array module, which is slower but has identical results.
+"""
+
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class MetricsIndex(object):
+
+    def __init__(self, use_numpy=None):
+        super(MetricsIndex, self).__init__()
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        self._numpy = use_numpy and numpy
+        self._ports = {}
+        self._names = []
+
+        # Rows that are pending ingestion (by key).
+        self._pending = {}
+
+        # Dense columns (by key), built by freeze().
+        self._columns = {}
+        self._frozen = False
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, port):
+        return port in self._ports
+
+    def ports(self):
+        return self._names[:]
+
+    def add(self, port, sums):
+        """ Add the given map of key -> (weight, total) for the port. """
+        assert not self._frozen
+        index = self._ports.get(port)
+        if index is None:
+            index = len(self._names)
+            self._ports[port] = index
+            self._names.append(port)
+        for (key, (weight, total)) in sums.iteritems():
+            rows = self._pending.get(key)
+            if rows is None:
+                rows = (array.array('i'), array.array('d'), array.array('d'))
+                self._pending[key] = rows
+            rows[0].append(index)
+            rows[1].append(weight)
+            rows[2].append(total)
+
+    def freeze(self):
+        """ Build the dense columns. No more rows may be added. """
+        assert not self._frozen
+        count = len(self._names)
+        for (key, (indices, weights, totals)) in self._pending.iteritems():
+            if self._numpy:
+                indices = numpy.frombuffer(indices, dtype=numpy.intc)
+                present = numpy.bincount(indices, minlength=count) > 0
+                weights = numpy.bincount(indices,
+                    weights=numpy.frombuffer(weights, dtype=numpy.float64),
+                    minlength=count)
+                totals = numpy.bincount(indices,
+                    weights=numpy.frombuffer(totals, dtype=numpy.float64),
+                    minlength=count)
+            else:
+                present = array.array('b', [0]) * count
+                dense_weights = array.array('d', [0.0]) * count
+                dense_totals = array.array('d', [0.0]) * count
+                for i in xrange(len(indices)):
+                    index = indices[i]
+                    present[index] = 1
+                    dense_weights[index] += weights[i]
+                    dense_totals[index] += totals[i]
+                weights = dense_weights
+                totals = dense_totals
+            self._columns[key] = (present, weights, totals)
+        self._pending = {}
+        self._frozen = True
+        return self
+
+    def index(self, port):
+        """ Returns the row index for the given port (or None). """
+        return self._ports.get(port)
+
+    def sums(self, indices):
+        """ Returns a map of key -> (weight, total) over the given rows. """
+        assert self._frozen
+        result = {}
+        if not indices:
+            return result
+        if self._numpy:
+            rows = numpy.array(indices, dtype=numpy.intp)
+            for (key, (present, weights, totals)) in self._columns.iteritems():
+                if present[rows].any():
+                    result[key] = (
+                        float(weights[rows].sum()),
+                        float(totals[rows].sum()))
+        else:
+            for (key, (present, weights, totals)) in self._columns.iteritems():
+                if any(present[index] for index in indices):
+                    result[key] = (
+                        sum(weights[index] for index in indices),
+                        sum(totals[index] for index in indices))
+        return result
+
+    def get(self, port):
+        """ Returns the map of key -> (weight, total) for a single port. """
+        index = self._ports.get(port)
+        if index is None:
+            return None
+        return self.sums([index])
+
+    def is_active(self, index, key="active"):
+        """ Returns true if the given row indicates active connections. """
+        assert self._frozen
+        column = self._columns.get(key)
+        if column is None:
+            return False
+        (present, weights, totals) = column
+        return bool(present[index]) and weights[index] != 0 and \
+               totals[index] / weights[index] > 0
+
+    def as_map(self):
+        """ Returns a (slow) map of port -> key -> (weight, value). """
+        result = {}
+        for (port, index) in self._ports.iteritems():
+            result[port] = dict([
+                (key, (weight, weight and total / weight))
+                for (key, (weight, total)) in self.sums([index]).items()
+            ])
+        return result
@@ -23,10 +23,14 @@ import re
 import math
 import sys
 
-def calculate_weighted_averages(metrics):
-    """ Calculates the weighted average for each metric. """
-    totals = {}
-    total_weights = {}
+def calculate_weighted_sums(metrics):
+    """
+    Calculates the total weight and the weighted total for each metric.
+
+    The result is a map of key -> (weight, total). These sums can be combined
+    across sources by simple addition, unlike the averages themselves.
+    """
+    sums = {}
     for metric in metrics:
         for key, info in metric.iteritems():
             # Try to be generous with our parsing of metrics, but interpret
@@ -46,15 +50,36 @@ def calculate_weighted_averages(metrics):
             except ValueError:
                 # weight / value are not numbers?
                 continue
-            totals[key] = totals.get(key, 0) + weight * value
-            total_weights[key] = total_weights.get(key, 0) + weight
-    for key in totals:
-        if total_weights[key] != 0:
-            totals[key] = (float(totals[key]) / total_weights[key])
+            (total_weight, total) = sums.get(key, (0.0, 0.0))
+            sums[key] = (total_weight + weight, total + weight * value)
+    return sums
+
+def calculate_weighted_averages(metrics):
+    """ Calculates the weighted average for each metric. """
+    totals = {}
+    for (key, (total_weight, total)) in calculate_weighted_sums(metrics).items():
+        if total_weight != 0:
+            totals[key] = (float(total) / total_weight)
         else:
             totals[key] = 0.0
     return totals
 
+def metrics_changed(old, new, threshold):
+    """
+    Returns True if any of the given metric averages has moved by more than
+    the given fraction (e.g. 0.1 for 10%) relative to its old value. A metric
+    that appears or disappears is always considered to be a change.
+    """
+    if old is None:
+        return True
+    for key in set(old.keys()).union(new.keys()):
+        if not key in old or not key in new:
+            return True
+        delta = abs(new[key] - old[key])
+        if delta > threshold * abs(old[key]) or (old[key] == 0 and delta > 0):
+            return True
+    return False
+
 def calculate_num_servers_uniform(total, bound, bump_up=False, bump_down=False):
     """
     Determines the number of servers required to spread the 'total' load uniformly
@@ -125,6 +150,7 @@ def calculate_ideal_uniform(endpoint_spec, metric_averages, num_instances):
             e.g. ['20<=rate<=50','100<=response<800']
         (The hits per second should be between 20 - 50 for each instance and
         the response rate should be between 100ms - 800ms.)
+        This may also be a precompiled RuleProgram.
 
     metrics_averages:
         A set of metrics computed with calculate_weighted_averages.
@@ -132,16 +158,38 @@ def calculate_ideal_uniform(endpoint_spec, metric_averages, num_instances):
     num_instances:
         The number of instances that produced these metrics.
     """
+    if not isinstance(endpoint_spec, RuleProgram):
+        endpoint_spec = RuleProgram(endpoint_spec)
+    return endpoint_spec.evaluate(metric_averages, num_instances)
+
+class RuleProgram(object):
+
+    """
+    A compiled (and immutable) list of scaling rules.
+
+    The rules are parsed once, when the endpoint configuration is loaded, and
+    the program can then be evaluated against any number of metric vectors.
+    Any rules that could not be parsed are available via errors(); they are
+    treated as unconstrained, exactly as they always have been.
+    """
+
+    __slots__ = ("_rules", "_errors")
 
-    logging.debug("Metric totals: %s", metric_averages)
-    ideal_instances = (-1, -1)
-    for criteria in endpoint_spec:
-        if criteria != '':
+    def __init__(self, rules):
+        compiled = []
+        errors = []
+        for criteria in rules or []:
+            if criteria == '':
+                continue
             c = EndpointCriteria(criteria)
-            logging.debug("Endpoint criteria found: (%s, %s, %s)",
-                          c.metric_key, c.lower_bound, c.upper_bound)
+            if c.metric_key is None:
+                # Unconstrained (this is what the range would be).
+                errors.append(criteria)
+                compiled.append((None, (0, sys.maxint)))
+                continue
 
             if c.metric_key == 'instances':
+                # These bounds are constant, so compute them now.
                 if c.lower_exact or c.lower_bound is None:
                     metric_min = c.lower_bound
                 else:
@@ -150,17 +198,46 @@ def calculate_ideal_uniform(endpoint_spec, metric_averages, num_instances):
                     metric_max = c.upper_bound
                 else:
                     metric_max = c.upper_bound - 1
+                compiled.append((None, (metric_min, metric_max)))
             else:
-                avg = metric_averages.get(c.metric_key, 0)
+                compiled.append((c.metric_key, (
+                    c.lower_bound, c.upper_bound,
+                    c.lower_exact, c.upper_exact)))
+
+        object.__setattr__(self, "_rules", tuple(compiled))
+        object.__setattr__(self, "_errors", tuple(errors))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RuleProgram is immutable.")
+
+    def __len__(self):
+        return len(self._rules)
+
+    def errors(self):
+        return list(self._errors)
+
+    def keys(self):
+        """ The metric keys used by this program. """
+        return [key for (key, _) in self._rules if key is not None]
+
+    def evaluate(self, metric_averages, num_instances):
+        """
+        Returns the ideal (min_servers, max_servers) for the given metrics.
+        See calculate_ideal_uniform() above.
+        """
+        ideal_instances = (-1, -1)
+        for (key, bounds) in self._rules:
+            if key is None:
+                (metric_min, metric_max) = bounds
+            else:
+                (lower, upper, lower_exact, upper_exact) = bounds
+                avg = metric_averages.get(key, 0)
                 (metric_min, metric_max) = \
                     calculate_server_range(avg * num_instances,
-                                           c.lower_bound,
-                                           c.upper_bound,
-                                           lower_exact=c.lower_exact,
-                                           upper_exact=c.upper_exact)
-
-            logging.debug("Ideal instances for metric %s: [%s,%s]",
-                          c.metric_key, metric_min, metric_max)
+                                           lower,
+                                           upper,
+                                           lower_exact=lower_exact,
+                                           upper_exact=upper_exact)
 
             if ideal_instances == (-1, -1):
                 # First time through the loop so we just set it to the first ideal values.
@@ -180,9 +257,34 @@ def calculate_ideal_uniform(endpoint_spec, metric_averages, num_instances):
                 elif metric_min > ideal_instances[1]:
                     ideal_instances = (ideal_instances[1], ideal_instances[1])
 
-            logging.debug("Returning ideal instances: %s", ideal_instances)
+        logging.debug("Ideal instances for %s: %s", metric_averages, ideal_instances)
+        return ideal_instances
 
-    return ideal_instances
+    def evaluate_batch(self, vectors):
+        """
+        Evaluates a batch of (metric_averages, num_instances) pairs,
+        returning the list of ideal (min_servers, max_servers).
+        """
+        return [self.evaluate(metric_averages, num_instances)
+                for (metric_averages, num_instances) in vectors]
+
+def calculate_ideal_batch(batch):
+    """
+    Evaluates a batch of (program, metric_averages, num_instances) for
+    many endpoints at once. Endpoints sharing a program are grouped.
+    """
+    groups = {}
+    for (i, (program, metric_averages, num_instances)) in enumerate(batch):
+        groups.setdefault(id(program), (program, [], []))
+        (_, indices, vectors) = groups[id(program)]
+        indices.append(i)
+        vectors.append((metric_averages, num_instances))
+
+    results = [None] * len(batch)
+    for (program, indices, vectors) in groups.values():
+        for (i, result) in zip(indices, program.evaluate_batch(vectors)):
+            results[i] = result
+    return results
 
 class EndpointCriteria(object):
 
@@ -194,6 +296,8 @@ class EndpointCriteria(object):
               METRIC_NAME_PATTERN + \
               "(" + OP_PATTERN + NUMBER_PATTERN + ")?$"
 
+    REGEX = re.compile(PATTERN)
+
     def __init__(self, criteria_str):
         super(EndpointCriteria, self).__init__()
         self.lower_bound = None
@@ -205,7 +309,7 @@ class EndpointCriteria(object):
 
     @staticmethod
     def validate(criteria_str):
-        m = re.match(EndpointCriteria.PATTERN, criteria_str)
+        m = EndpointCriteria.REGEX.match(criteria_str)
         if not m:
             raise Exception("Rules must match: %s" % EndpointCriteria.PATTERN)
 
@@ -214,7 +318,7 @@ class EndpointCriteria(object):
         The criteria string is of the form:
         x [<=?] metric_key [<=?] y
         """
-        m = re.match(EndpointCriteria.PATTERN, criteria_str)
+        m = EndpointCriteria.REGEX.match(criteria_str)
         if m != None:
             try:
                 self.lower_bound = float(m.group(2))
@@ -0,0 +1,141 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+"""
+Compact log-linear histograms (in the style of HdrHistogram).
+
+Each power of two is split into a fixed number of linear sub-buckets, so
+values are kept within a fixed relative error using fixed memory. Bucket
+counts are additive, so histograms from different sources merge exactly.
+
+Histograms are published as ordinary metrics, one key per bucket (see
+as_metrics()). As these are summed like every other metric, the buckets
+for an endpoint can then be turned back into percentiles (see summarize()).
+"""
+
+import math
+
+# The default layout. Histograms that are published as metrics
+# must all use this, so that the buckets line up when they are merged.
+BASE = 0.001
+OCTAVES = 32
+SUB_BUCKETS = 8
+
+# Published buckets are named "<metric>_hist_<index>".
+HIST = "_hist_"
+
+# The percentiles reported for published histograms.
+PERCENTILES = ((0.50, "_p50"), (0.95, "_p95"), (0.99, "_p99"))
+
+class Histogram(object):
+
+    def __init__(self, base=BASE, octaves=OCTAVES, sub_buckets=SUB_BUCKETS):
+        super(Histogram, self).__init__()
+        self.base = base
+        self.sub_buckets = sub_buckets
+        self.size = 1 + octaves * sub_buckets
+        self.clear()
+
+    def clear(self):
+        self.counts = [0] * self.size
+        self.count = 0
+        self.total = 0.0
+
+    def index(self, value):
+        # Everything below the base goes in the first bucket.
+        if value < self.base:
+            return 0
+        # We have value / base = mantissa * 2 ** exponent,
+        # where the mantissa is in [0.5, 1). So the octave
+        # is exponent - 1, and the mantissa picks the sub-bucket.
+        (mantissa, exponent) = math.frexp(float(value) / self.base)
+        sub = int((mantissa * 2 - 1) * self.sub_buckets)
+        return min(1 + (exponent - 1) * self.sub_buckets + sub, self.size - 1)
+
+    def upper(self, index):
+        # The upper bound of the given bucket.
+        if index == 0:
+            return self.base
+        (octave, sub) = divmod(index - 1, self.sub_buckets)
+        return self.base * (2 ** octave) * (1 + float(sub + 1) / self.sub_buckets)
+
+    def add(self, value, count=1):
+        self.counts[self.index(value)] += count
+        self.count += count
+        self.total += value * count
+
+    def merge(self, other):
+        for (index, count) in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+
+    def mean(self):
+        return self.count and self.total / self.count or 0.0
+
+    def percentile(self, fraction):
+        # Returns the upper bound of the bucket
+        # where the given fraction is reached.
+        if self.count == 0:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for (index, count) in enumerate(self.counts):
+            seen += count
+            if seen >= target and count > 0:
+                return self.upper(index)
+        return self.upper(self.size - 1)
+
+    def as_metrics(self, name):
+        # Each bucket is given as (count, 1.0), so that the
+        # weighted sums (see calculator.py) carry the counts.
+        return dict([
+            ("%s%s%d" % (name, HIST, index), (count, 1.0))
+            for (index, count) in enumerate(self.counts)
+            if count > 0
+        ])
+
+def summarize(sums):
+    """
+    Given a map of key -> (weight, total), as summed over any number of
+    sources, replaces the published histogram buckets with percentiles.
+    """
+    result = {}
+    histograms = {}
+    for (key, (weight, total)) in sums.items():
+        if not HIST in key:
+            result[key] = (weight, total)
+            continue
+        (name, index) = key.rsplit(HIST, 1)
+        try:
+            index = int(index)
+        except ValueError:
+            continue
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = Histogram()
+            histograms[name] = histogram
+        if 0 <= index < histogram.size and weight > 0:
+            histogram.counts[index] += int(round(weight))
+            histogram.count += int(round(weight))
+
+    for (name, histogram) in histograms.items():
+        if histogram.count == 0:
+            continue
+        for (fraction, suffix) in PERCENTILES:
+            value = histogram.percentile(fraction)
+            result[name + suffix] = (histogram.count, histogram.count * value)
+    return result
@@ -0,0 +1,226 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+The wire format used to publish metrics between managers.
+
+Each manager publishes a table of port -> {key: (weight, total)}, where the
+sums are as computed by calculate_weighted_sums(). Rather than writing this
+table out as JSON on every interval, it is encoded column-wise (one set of
+packed arrays per metric key) and compressed. Ports that are unchanged since
+the last publish are skipped entirely, with a full table (a keyframe) written
+out periodically.
+
+Each delta names the sequence number it is relative to. A reader that
+misses an intermediate publish (watches may coalesce updates) keeps the
+last table it was able to build and ignores further deltas until the next
+keyframe, rather than folding them onto a stale base. Since nothing is
+published while the table is unchanged, a keyframe is still written out
+every KEYFRAME_INTERVAL encodes, so readers never wait longer than that.
+
+Data written by older managers (plain JSON, {port: [metrics]}) is still read.
+"""
+
+import sys
+import json
+import zlib
+import uuid
+import array
+import logging
+
+from . calculator import calculate_weighted_sums
+
+# The format header. JSON can never begin with a nul.
+MAGIC = "\x00rm"
+VERSION = 1
+
+# How often to write out a full table.
+KEYFRAME_INTERVAL = 10
+
+def _pack(arr):
+    if sys.byteorder == "big":
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tostring()
+
+def _unpack(typecode, data, offset, count):
+    arr = array.array(typecode)
+    end = offset + count * arr.itemsize
+    arr.fromstring(data[offset:end])
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return (arr, end)
+
+def encode(table, epoch=None, seq=0, base=None, removed=None):
+    """
+    Encode the given table. If base is given, then this is a delta
+    relative to the publish with that sequence number.
+    """
+    ports = table.keys()
+    keys = {}
+    for (index, port) in enumerate(ports):
+        for (key, (weight, total)) in table[port].iteritems():
+            if not key in keys:
+                keys[key] = (array.array('i'), array.array('d'), array.array('d'))
+            (indices, weights, totals) = keys[key]
+            indices.append(index)
+            weights.append(weight)
+            totals.append(total)
+
+    header = {
+        "epoch": epoch,
+        "seq": seq,
+        "base": base,
+        "ports": ports,
+        "removed": removed or [],
+        "keys": [(key, len(columns[0])) for (key, columns) in keys.items()],
+    }
+    columns = []
+    for (key, (indices, weights, totals)) in keys.items():
+        columns.append(_pack(indices))
+        columns.append(_pack(weights))
+        columns.append(_pack(totals))
+
+    return MAGIC + chr(VERSION) + zlib.compress(
+        json.dumps(header) + "\n" + "".join(columns))
+
+def decode(data):
+    """
+    Decode the given data. This returns (header, table) where the
+    header is a map including epoch, seq, base and removed.
+    """
+    if not data:
+        return ({}, {})
+
+    if not data.startswith(MAGIC):
+        # The old format, a plain map of port -> [metrics].
+        metrics = json.loads(data) or {}
+        table = dict([
+            (port, calculate_weighted_sums(port_metrics))
+            for (port, port_metrics) in metrics.items()
+        ])
+        return ({}, table)
+
+    version = ord(data[len(MAGIC)])
+    if version != VERSION:
+        raise ValueError("Unknown metrics version: %d" % version)
+
+    body = zlib.decompress(data[len(MAGIC) + 1:])
+    (header, columns) = body.split("\n", 1)
+    header = json.loads(header)
+
+    ports = header["ports"]
+    table = dict([(port, {}) for port in ports])
+    offset = 0
+    for (key, count) in header["keys"]:
+        (indices, offset) = _unpack('i', columns, offset, count)
+        (weights, offset) = _unpack('d', columns, offset, count)
+        (totals, offset) = _unpack('d', columns, offset, count)
+        for i in xrange(count):
+            table[ports[indices[i]]][key] = (weights[i], totals[i])
+
+    return (header, table)
+
+class Publisher(object):
+
+    """ Produces the (delta-encoded) data to publish for a table. """
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL):
+        super(Publisher, self).__init__()
+        self._epoch = str(uuid.uuid4())
+        self._keyframe_interval = keyframe_interval
+        self._seq = 0
+        self._since_keyframe = 0
+        self._last = None
+
+    def reset(self):
+        # Ensure that the next publish is a keyframe.
+        # This is done whenever a new reader may have appeared.
+        self._last = None
+
+    def encode(self, table):
+        """
+        Returns the data to publish, or None if nothing has changed
+        since the last publish (in which case nothing should be written).
+        """
+        full = self._last is None or \
+            self._since_keyframe + 1 >= self._keyframe_interval
+
+        if full:
+            data = encode(table, epoch=self._epoch, seq=self._seq)
+            self._since_keyframe = 0
+        else:
+            self._since_keyframe += 1
+            changed = dict([
+                (port, sums)
+                for (port, sums) in table.iteritems()
+                if self._last.get(port) != sums
+            ])
+            removed = [port for port in self._last if not port in table]
+            if not changed and not removed:
+                return None
+            data = encode(
+                changed,
+                epoch=self._epoch,
+                seq=self._seq,
+                base=self._seq - 1,
+                removed=removed)
+
+        self._last = table
+        self._seq += 1
+        return data
+
+def merge(name, current, data):
+    """
+    Fold newly published data into the current (epoch, seq, table) state
+    for a given manager. This is suitable for use with a Mirror.
+
+    A seq of None means that we are missing some delta, and are holding
+    on to the last good table until the next keyframe arrives.
+    """
+    try:
+        (header, table) = decode(data)
+    except Exception:
+        logging.warn("Malformed metrics from %s.", name)
+        return current
+
+    epoch = header.get("epoch")
+    seq = header.get("seq")
+    base = header.get("base")
+    if base is None:
+        # A keyframe (or the old format).
+        return (epoch, seq, table)
+
+    if current is None:
+        # We've never seen a keyframe for this manager.
+        logging.debug("Waiting for a keyframe from %s.", name)
+        return (epoch, None, {})
+
+    (current_epoch, current_seq, current_table) = current
+    if current_epoch != epoch or current_seq is None or current_seq != base:
+        # We don't have the base for this delta (we missed a publish,
+        # or the manager has restarted its publisher). Keep what we
+        # have, and wait for the next keyframe to catch up.
+        logging.debug("Missed metrics from %s (at %s, delta from %s).",
+                      name, current_seq, base)
+        return (current_epoch, None, current_table)
+
+    # NOTE: We never modify the current table, since others
+    # may be holding a reference to it (via Mirror.as_map()).
+    merged = current_table.copy()
+    merged.update(table)
+    for port in header.get("removed", []):
+        merged.pop(port, None)
+    return (epoch, seq, merged)
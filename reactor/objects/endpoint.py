@@ -55,6 +55,9 @@ LIVE_METRICS = "live_metrics"
 # The updated connections for a particular endpoint (posted by the manager).
 LIVE_ACTIVE = "live_active"
 
+# The update schedule for a particular endpoint (posted by the manager).
+LIVE_SCHEDULE = "live_schedule"
+
 # The ips that have been confirmed by the system for a particular endpoint.
 CONFIRMED_IPS = "confirmed_ips"
 
@@ -205,6 +208,7 @@ class Endpoint(ConfigObject):
     manager = attr(MANAGER, clazz=RawObject, ephemeral=True)
     metrics = attr(LIVE_METRICS, clazz=JSONObject, ephemeral=True)
     active = attr(LIVE_ACTIVE, clazz=JSONObject, ephemeral=True)
+    schedule = attr(LIVE_SCHEDULE, clazz=JSONObject, ephemeral=True)
     custom_metrics = attr(CUSTOM_METRICS, clazz=JSONObject)
 
     def __init__(self, *args, **kwargs):
@@ -284,3 +288,36 @@ class Endpoint(ConfigObject):
 
     def sessions(self):
         return self._get_child(SESSIONS, clazz=Sessions)
+
+    def acquire(self, uuid):
+        # Take the lease on this endpoint for the given manager.
+        # The lease is an exclusive ephemeral node, so it is held
+        # until it is released or the manager's session expires.
+        child = self._get_child(MANAGER, clazz=RawObject)
+        if child._set_data(uuid, ephemeral=True, exclusive=True):
+            return True
+        (data, stat) = child._get_data_stat()
+        if stat is None:
+            # Gone already, try again on the next pass.
+            return False
+        if data != uuid:
+            return False
+        if child._owned(stat=stat):
+            return True
+
+        # This is our lease, but from a previous session. It will
+        # vanish when that session expires, so we take it over now.
+        # NOTE: The delete is conditional on the version that we read,
+        # so we only remove the node that we looked at. If it is gone
+        # (or someone else beats us to it), the create decides.
+        child._delete(version=stat["version"])
+        return bool(child._set_data(uuid, ephemeral=True, exclusive=True))
+
+    def release(self, uuid):
+        # Give up the lease (only if we actually hold it).
+        # As above, we only delete the node that we read.
+        child = self._get_child(MANAGER, clazz=RawObject)
+        (data, stat) = child._get_data_stat()
+        if stat is not None and data == uuid:
+            return child._delete(version=stat["version"])
+        return False
@@ -13,7 +13,135 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import random
+import threading
+
+from reactor import utils
 from reactor.zookeeper.objects import Collection
+from reactor.zookeeper.objects import JSONObject
 
 class IPAddresses(Collection):
     pass
+
+class IPLocks(IPAddresses):
+
+    """
+    A collection of exclusive locks, mirrored in memory.
+
+    The lock nodes are watched, and the table of item -> value (along with
+    the reverse index of value -> items) is kept up to date locally. This
+    means that find() and the candidate selection in lock() don't need to
+    go to Zookeeper at all, and taking a lock is a single conditional
+    create. Zookeeper is still the authority, if the local table is stale
+    then the create simply fails and the caller tries again later.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(IPLocks, self).__init__(*args, **kwargs)
+        self._table_lock = threading.Lock()
+        self._table = {}
+        self._index = {}
+        self._released = utils.callback(None)
+
+    def watch(self, released=None):
+        # Start mirroring the locks. The released callback
+        # is made whenever locks go away (with no arguments).
+        self._released = utils.callback(released)
+        children = self._list_children(watch=self._update)
+        self._load(self.as_map(), children)
+
+    def unwatch(self):
+        self._unwatch()
+
+    def _set(self, item, value):
+        # NOTE: Must be called with the table lock held.
+        self._unset(item)
+        self._table[item] = value
+        if value is not None:
+            self._index.setdefault(value, set()).add(item)
+
+    def _unset(self, item):
+        # NOTE: Must be called with the table lock held.
+        if not item in self._table:
+            return
+        value = self._table.pop(item)
+        items = self._index.get(value)
+        if items is not None:
+            items.discard(item)
+            if not items:
+                del self._index[value]
+
+    def _load(self, values, children):
+        with self._table_lock:
+            for item in children:
+                if item in values:
+                    self._set(item, values[item])
+
+    def _update(self, children):
+        children = set(children)
+        with self._table_lock:
+            removed = [item for item in self._table if not item in children]
+            for item in removed:
+                self._unset(item)
+            added = [item for item in children
+                     if self._table.get(item) is None]
+
+        # Read the values for new locks (outside the lock).
+        # NOTE: Values are set when the lock is created and never
+        # change, so we only need to read each one once.
+        values = {}
+        for item in added:
+            value = self.get(item)
+            if value is not None:
+                values[item] = value
+        self._load(values, added)
+
+        if removed:
+            self._released()
+
+    def lock(self, items, value=None):
+        # NOTE: We shuffle the list of available items, for two
+        # reasons. First, to avoid obviously colliding with other
+        # threads / managers that are trying to grab an item.
+        # Second, if a VM is broken we can end up with the same
+        # one over and over again. This is less than ideal and
+        # it's better to have a random assignment.
+        with self._table_lock:
+            candidates = [item for item in items if not item in self._table]
+        random.shuffle(candidates)
+
+        for item in candidates:
+            with self._table_lock:
+                if item in self._table:
+                    # Taken since we started (per the watch).
+                    continue
+                # Reserve the item while we create the node.
+                self._set(item, value)
+
+            if self._get_child(item, clazz=JSONObject)._set_data(
+                value, ephemeral=True, exclusive=True):
+                return item
+
+            # Someone else got there first. The watch may already have
+            # fired while our reservation was in the table (in which case
+            # it skipped this item), so we read the winner's value here
+            # and move on to the next candidate.
+            winner = self.get(item)
+            with self._table_lock:
+                if self._table.get(item) == value:
+                    if winner is not None:
+                        self._set(item, winner)
+                    else:
+                        # Already gone again.
+                        self._unset(item)
+        return None
+
+    def remove(self, name):
+        super(IPLocks, self).remove(name)
+        with self._table_lock:
+            self._unset(name)
+        self._released()
+
+    def find(self, value):
+        with self._table_lock:
+            return list(self._index.get(value, ()))
@@ -16,6 +16,8 @@
 from reactor.atomic import Atomic
 from reactor.zookeeper.objects import DatalessObject
 from reactor.zookeeper.objects import JSONObject
+from reactor.zookeeper.objects import RawObject
+from reactor.metrics import wire
 
 from . config import ConfigObject
 from . ring import Ring
@@ -69,17 +71,37 @@ class Managers(DatalessObject, Atomic):
         # Get the associated log object.
         return self._get_child(LOGS)._get_child(name, clazz=Ring)
 
+    def _set_published(self, kind, uuid, value, clazz=JSONObject):
+        # NOTE: A plain ephemeral write deletes and recreates
+        # the node, which looks like a membership change to anyone
+        # watching. So we update the node in place if it belongs to
+        # our session, and only (re)create it otherwise (a node left
+        # from a previous session will vanish when that expires).
+        child = self._get_child(kind)._get_child(uuid, clazz=clazz)
+        return child._set_data(value, ephemeral=True, inplace=True)
+
     def set_metrics(self, uuid, value):
-        return self._get_child(METRICS)._get_child(
-                uuid, clazz=JSONObject)._set_data(value, ephemeral=True)
+        # NOTE: The metrics are published pre-encoded
+        # (see reactor.metrics.wire), so they are written raw.
+        return self._set_published(METRICS, uuid, value, clazz=RawObject)
 
     def set_pending(self, uuid, value):
-        return self._get_child(PENDING)._get_child(
-                uuid, clazz=JSONObject)._set_data(value, ephemeral=True)
+        return self._set_published(PENDING, uuid, value)
 
     def set_active(self, uuid, value):
-        return self._get_child(ACTIVE)._get_child(
-                uuid, clazz=JSONObject)._set_data(value, ephemeral=True)
+        return self._set_published(ACTIVE, uuid, value)
+
+    def metrics(self):
+        # The raw metrics subtree (for watching).
+        return self._get_child(METRICS, clazz=RawObject)
+
+    def pending(self):
+        # The raw pending subtree (for watching).
+        return self._get_child(PENDING, clazz=JSONObject)
+
+    def active(self):
+        # The raw active subtree (for watching).
+        return self._get_child(ACTIVE, clazz=JSONObject)
 
     def register(self, uuid, info):
         """
@@ -109,27 +131,21 @@ class Managers(DatalessObject, Atomic):
         # This is a utility function used by the manager. It shouldn't be used
         # frequently, but can be called when the manager set changes and you
         # need to reload and recompute the ring.
-        return dict(map(
-            lambda x: (x, self.info(x)),
-            self.list_active()))
+        return self._info._get_children_data()
 
     def metrics_map(self):
-        # This function will be called more frequently than info_map() above,
-        # but there's not much that can be done to minimize this cost (it's
-        # necessary for information sharing across managers).
-        return dict(map(
-            lambda x: (x, self._get_child(
-                METRICS, clazz=JSONObject)._get_child(x)._get_data()),
-            self._get_child(
-                METRICS, clazz=JSONObject)._list_children()))
+        # This is a one-shot snapshot of the published metrics tables. Note
+        # that each manager publishes deltas between keyframes, so this will
+        # only have the ports that have changed recently. The manager itself
+        # mirrors the metrics with a watch (see wire.merge()) to keep whole.
+        return dict([
+            (uuid, wire.decode(data)[1])
+            for (uuid, data) in self.metrics()._get_children_data().items()
+        ])
 
     def pending_map(self):
         # Same as metric_map().
-        return dict(map(
-            lambda x: (x, self._get_child(
-                PENDING, clazz=JSONObject)._get_child(x)._get_data()),
-            self._get_child(
-                PENDING, clazz=JSONObject)._list_children()))
+        return self._get_child(PENDING, clazz=JSONObject)._get_children_data()
 
     def active_count(self):
         # Sums across all active managers to return
@@ -138,7 +154,6 @@ class Managers(DatalessObject, Atomic):
         # than for a big global metric for the entire
         # system (which is exactly what it is used for).
         return sum(map(
-            lambda x: self._get_child(
-                ACTIVE, clazz=JSONObject)._get_child(x)._get_data() or 0,
+            lambda x: x or 0,
             self._get_child(
-                ACTIVE, clazz=JSONObject)._list_children()))
+                ACTIVE, clazz=JSONObject)._get_children_data().values()))
@@ -46,13 +46,7 @@ class Sessions(DatalessObject):
             self._get_child(DROP)._get_child(client, clazz=RawObject)._set_data(backend)
 
     def drop_map(self):
-        return dict(map(
-            lambda x: (x, self._get_child(DROP)._get_child(
-                x, clazz=RawObject)._get_data()),
-            self._get_child(DROP)._list_children()))
+        return self._get_child(DROP)._get_children_data(clazz=RawObject)
 
     def active_map(self):
-        return dict(map(
-            lambda x: (x, self._get_child(ACTIVE)._get_child(
-                x, clazz=RawObject)._get_data()),
-            self._get_child(ACTIVE)._list_children()))
+        return self._get_child(ACTIVE)._get_children_data(clazz=RawObject)
@@ -0,0 +1,205 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+"""
+Scheduling of endpoint updates.
+
+Rather than updating every endpoint on every pass, the manager tracks which
+endpoints are dirty (their configuration or state changed, their confirmed
+IPs changed, their metrics moved, etc.). Dirty endpoints are updated promptly
+and everything else is updated on its own cadence.
+
+Each endpoint has a delay until its next update. This is either declared by
+the endpoint (see EndpointConfig.interval) or learned: it is halved each time
+the endpoint is found to be busy, and doubled each time it was idle, within
+the bounds given by the manager. The due times are kept in a heap, so finding
+the endpoints that are due doesn't require looking at all of them.
+"""
+
+import time
+import heapq
+
+from . atomic import Atomic
+
+# Reasons for an update.
+NEW = "new"
+SWEEP = "sweep"
+CONFIG = "config"
+STATE = "state"
+CONFIRMED = "confirmed"
+METRICS = "metrics"
+SETTLING = "settling"
+
+# Reasons that don't indicate any activity.
+IDLE = (NEW, SWEEP, SETTLING)
+
+class UpdateScheduler(Atomic):
+
+    def __init__(self, sweep=60):
+        super(UpdateScheduler, self).__init__()
+        self._sweep = sweep
+
+        # Endpoints that need an update (uuid -> reason).
+        # The deferred ones are due on the next pass, but
+        # don't justify waking up the manager early.
+        self._dirty = {}
+        self._deferred = {}
+
+        # Time of the last update for each endpoint,
+        # the current delay and the time of the next.
+        self._last = {}
+        self._delay = {}
+        self._next = {}
+
+        # Heap of (time, uuid) for the next updates.
+        # NOTE: Entries are not removed when rescheduled, they
+        # are simply ignored if they don't match self._next.
+        self._heap = []
+
+        # Whether someone has asked us to wake up.
+        self._poked = False
+
+    @Atomic.sync
+    def set_sweep(self, sweep):
+        self._sweep = sweep
+
+    @Atomic.sync
+    def mark(self, uuid, reason, wake=True):
+        # NOTE: We keep the first reason given, it's
+        # generally the most informative for logging.
+        if wake:
+            if not uuid in self._dirty:
+                self._dirty[uuid] = reason
+            self._notify()
+        elif not uuid in self._deferred:
+            self._deferred[uuid] = reason
+
+    @Atomic.sync
+    def forget(self, uuid):
+        # Forget everything about this endpoint, it will be
+        # treated as new the next time that it's considered.
+        self._dirty.pop(uuid, None)
+        self._deferred.pop(uuid, None)
+        self._last.pop(uuid, None)
+        self._delay.pop(uuid, None)
+        self._next.pop(uuid, None)
+
+    @Atomic.sync
+    def poke(self):
+        self._poked = True
+        self._notify()
+
+    def _top(self):
+        # Drop any stale entries from the heap.
+        while self._heap:
+            (when, uuid) = self._heap[0]
+            if self._next.get(uuid) == when:
+                return when
+            heapq.heappop(self._heap)
+        return None
+
+    @Atomic.sync
+    def next_wakeup(self):
+        """ Returns the earliest time that any endpoint is due (or None). """
+        return self._top()
+
+    @Atomic.sync
+    def wait(self, until):
+        # Wait until the given time, or until there is work.
+        next_due = self._top()
+        if next_due is not None:
+            until = min(until, next_due)
+        while not self._dirty and not self._poked:
+            cur_time = time.time()
+            if cur_time >= until:
+                break
+            self._wait(until - cur_time)
+        self._poked = False
+
+    @Atomic.sync
+    def due(self, uuids, now=None):
+        """
+        Returns the map of uuid -> reason for the given endpoints that
+        should be updated now. The dirty state for those is consumed, any
+        endpoint marked after this point will be due on the next pass.
+        """
+        if now is None:
+            now = time.time()
+        result = {}
+        for uuid in uuids:
+            if uuid in self._dirty:
+                result[uuid] = self._dirty[uuid]
+            elif uuid in self._deferred:
+                result[uuid] = self._deferred[uuid]
+            elif not uuid in self._last:
+                result[uuid] = NEW
+
+        # Pull everything that's expired off the heap.
+        while self._heap and self._heap[0][0] <= now:
+            (when, uuid) = heapq.heappop(self._heap)
+            if self._next.get(uuid) == when and not uuid in result:
+                result[uuid] = SWEEP
+
+        # Anything else that is marked is not an endpoint
+        # that we are currently tracking, so it is dropped.
+        self._dirty.clear()
+        self._deferred.clear()
+        return result
+
+    @Atomic.sync
+    def done(self, uuid, reason=None, now=None, interval=None, minimum=None):
+        """
+        Records an update of the given endpoint and schedules the next one.
+
+        If an interval is given, the endpoint is updated on that fixed
+        cadence. Otherwise, the delay is learned between the minimum given
+        and the sweep interval. Returns the time elapsed since the previous
+        update (or None if it hasn't been updated before).
+        """
+        if now is None:
+            now = time.time()
+        if interval:
+            delay = interval
+        else:
+            if minimum is None:
+                minimum = self._sweep
+            delay = self._delay.get(uuid, self._sweep)
+            if reason in IDLE:
+                delay = delay * 2
+            else:
+                delay = delay / 2.0
+            delay = max(min(delay, self._sweep), minimum)
+
+        last = self._last.get(uuid)
+        self._last[uuid] = now
+        self._delay[uuid] = delay
+        self._next[uuid] = now + delay
+        heapq.heappush(self._heap, (now + delay, uuid))
+
+        if last is None:
+            return None
+        return now - last
+
+    @Atomic.sync
+    def info(self, uuid):
+        """ Returns the schedule for the given endpoint (or None). """
+        if not uuid in self._last:
+            return None
+        return {
+            "last": self._last[uuid],
+            "next": self._next[uuid],
+            "interval": self._delay[uuid],
+        }
@@ -0,0 +1,138 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import reactor.loadbalancer.nginx.logs as logs
+from reactor.metrics import histogram
+from reactor.metrics.calculator import calculate_weighted_sums
+
+def _line(host, body, response):
+    return "reactor> [18/Oct/2026:10:00:00 +0000] 1.2.3.4 <%s> <%s> <%s>\n" % \
+        (host, body, response)
+
+class NginxLogReaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.filename = os.path.join(self.path, "access.log")
+        self._append("old\n")
+        self.reader = logs.NginxLogReader(self.filename, chunk_size=16)
+        self.addCleanup(self.reader.close)
+
+    def _append(self, data, filename=None):
+        log = open(filename or self.filename, "ab")
+        log.write(data)
+        log.close()
+
+    def _read_all(self):
+        result = ""
+        while True:
+            data = self.reader.read()
+            if not data:
+                return result
+            result += data
+
+    def test_starts_at_end(self):
+        self.assertEquals(self._read_all(), "")
+        self._append("a\nb\n")
+        self.assertEquals(self._read_all(), "a\nb\n")
+
+    def test_partial(self):
+        self._read_all()
+        self._append("a\nb")
+        self.assertEquals(self._read_all(), "a\n")
+        self._append("c\n")
+        self.assertEquals(self._read_all(), "bc\n")
+
+    def test_chunks(self):
+        self._read_all()
+        data = "".join(["line %d\n" % i for i in range(100)])
+        self._append(data)
+        self.assertEquals(self.reader.read(), "line 0\nline 1\n")
+        self.assertEquals(self.reader.read(), "line 2\nline 3\n")
+        self.assertEquals(self._read_all(), data[len("line 0\nline 1\nline 2\nline 3\n"):])
+
+    def test_rotate(self):
+        self._read_all()
+        self._append("a\n")
+        rotated = self.filename + ".1"
+        os.rename(self.filename, rotated)
+        self._append("b\n", filename=rotated)
+        self.assertEquals(self._read_all(), "a\nb\n")
+
+        # The new file is read from the start.
+        self._append("c\n")
+        self.assertEquals(self._read_all(), "c\n")
+        self._append("d\n", filename=rotated)
+        self._append("e\n")
+        self.assertEquals(self._read_all(), "e\n")
+
+    def test_truncate(self):
+        self._read_all()
+        self._append("a\nb\n")
+        self._read_all()
+        open(self.filename, "wb").close()
+        self._append("c\n")
+        self.assertEquals(self._read_all(), "c\n")
+
+    def test_missing(self):
+        reader = logs.NginxLogReader(os.path.join(self.path, "missing.log"))
+        self.assertEquals(reader.read(), "")
+
+class NginxLogWatcherTests(unittest.TestCase):
+
+    def test_aggregate(self):
+        watcher = logs.NginxLogWatcher("/nonexistent")
+        data = _line("10.0.0.1:80", 100, 0.5) + \
+               _line("10.0.0.1:80", 300, 1.5) + \
+               _line("10.0.0.2:80", 50, 0.25) + \
+               _line("-", 0, "-") + \
+               "something else\n"
+        record = watcher.aggregate(data)
+        self.assertEquals(sorted(record.keys()), ["10.0.0.1:80", "10.0.0.2:80"])
+        self.assertEquals(record["10.0.0.1:80"][:3], [2, 400, 2.0])
+        self.assertEquals(record["10.0.0.2:80"][:3], [1, 50, 0.25])
+        self.assertEquals(record["10.0.0.1:80"][3].count, 2)
+        self.assertEquals(record["10.0.0.2:80"][3].count, 1)
+
+    def test_merge_pull(self):
+        watcher = logs.NginxLogWatcher("/nonexistent")
+        watcher.merge(watcher.aggregate(
+            _line("10.0.0.1:80", 100, 0.5) + _line("10.0.0.1:80", 300, 1.5)))
+        watcher.merge(watcher.aggregate(
+            _line("10.0.0.1:80", 400, 1.0) + _line("10.0.0.2:80", 50, 0.25)))
+        watcher.last_update -= 2.0
+        record = watcher.pull()
+        metrics = record["10.0.0.1:80"][0]
+        (hits, rate) = metrics["rate"]
+        self.assertEquals(hits, 3)
+        self.assertTrue(1.4 < rate <= 1.5)
+        self.assertEquals(metrics["response"], (3, 1.0))
+        self.assertEquals(record["10.0.0.2:80"][0]["response"], (1, 0.25))
+
+        # The histogram is published, for percentiles after merging.
+        sums = histogram.summarize(calculate_weighted_sums([metrics]))
+        (weight, total) = sums["response_p50"]
+        self.assertEquals(weight, 3)
+        self.assertTrue(1.0 <= total / weight < 1.125)
+        (weight, total) = sums["response_p99"]
+        self.assertTrue(1.5 <= total / weight < 1.7)
+        self.assertEquals(watcher.pull(), {})
@@ -0,0 +1,139 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import reactor.loadbalancer.nginx.reload as reload
+
+class WriteFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.filename = os.path.join(self.path, "reactor.conf")
+
+    def _read(self):
+        f = open(self.filename, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_write_new(self):
+        assert reload.write_file(self.filename, "a")
+        assert self._read() == "a"
+        assert os.listdir(self.path) == ["reactor.conf"]
+
+    def test_write_unchanged(self):
+        reload.write_file(self.filename, "a")
+        inode = os.stat(self.filename).st_ino
+        assert not reload.write_file(self.filename, "a")
+        assert os.stat(self.filename).st_ino == inode
+
+    def test_write_changed(self):
+        reload.write_file(self.filename, "a")
+        inode = os.stat(self.filename).st_ino
+        f = open(self.filename, 'rb')
+        try:
+            assert reload.write_file(self.filename, "b")
+            # The old file was replaced, not rewritten in place.
+            assert f.read() == "a"
+        finally:
+            f.close()
+        assert self._read() == "b"
+        assert os.stat(self.filename).st_ino != inode
+        assert os.listdir(self.path) == ["reactor.conf"]
+
+    def test_remove(self):
+        assert not reload.remove_file(self.filename)
+        reload.write_file(self.filename, "a")
+        assert reload.remove_file(self.filename)
+        assert not os.path.exists(self.filename)
+
+class NginxReloaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.pushes = []
+        self.reloader = reload.NginxReloader(
+            lambda: self.calls.append(1),
+            lambda: self.pushes.append(len(self.calls)))
+
+    def _stop(self):
+        self.reloader.stop()
+        self.reloader.join()
+
+    def test_next_dirty(self):
+        self.reloader.mark()
+        self.reloader.request()
+        self.reloader.request()
+        assert self.reloader._next()
+        assert self.reloader.reloads == 1
+
+    def test_next_clean(self):
+        self.reloader.request()
+        assert not self.reloader._next()
+        assert self.reloader.skipped == 1
+
+    def test_next_stopped(self):
+        self.reloader.stop()
+        assert self.reloader._next() is None
+
+    def test_coalesce(self):
+        self.reloader.start()
+        self.addCleanup(self._stop)
+        for _ in range(10):
+            self.reloader.mark()
+            self.reloader.request(0.2)
+        deadline = time.time() + 5.0
+        while not self.calls and time.time() < deadline:
+            time.sleep(0.01)
+        assert self.calls == [1]
+        assert self.reloader.reloads == 1
+        # The push happens before the reload.
+        assert self.pushes == [0]
+        while not self.reloader.completed and time.time() < deadline:
+            time.sleep(0.01)
+        assert self.reloader.completed == 1
+
+    def test_window_reopens(self):
+        self.reloader.start()
+        self.addCleanup(self._stop)
+        self.reloader.mark()
+        self.reloader.request()
+        deadline = time.time() + 5.0
+        while not self.calls and time.time() < deadline:
+            time.sleep(0.01)
+        self.reloader.mark()
+        self.reloader.request()
+        while len(self.calls) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert len(self.calls) == 2
+
+    def test_push_clean(self):
+        self.reloader.start()
+        self.addCleanup(self._stop)
+        self.reloader.request()
+        deadline = time.time() + 5.0
+        while not self.pushes and time.time() < deadline:
+            time.sleep(0.01)
+        assert self.pushes == [0]
+        assert self.calls == []
+        assert self.reloader.completed == 0
@@ -0,0 +1,125 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import os
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import SocketServer
+import BaseHTTPServer
+
+import reactor.loadbalancer.nginx.upstreams as upstreams
+from reactor.loadbalancer.backend import Backend
+
+class ControlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Keep the connection open, as nginx does.
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_PUT(self):
+        length = int(self.headers.getheader("Content-Length", 0))
+        body = self.rfile.read(length)
+        self.server.requests.append(("PUT", self.path, body))
+        self._reply(self.server.status)
+
+    def do_DELETE(self):
+        self.server.requests.append(("DELETE", self.path, None))
+        self._reply(self.server.status)
+
+    def address_string(self):
+        return "local"
+
+    def log_message(self, *args):
+        pass
+
+class ControlServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path):
+        SocketServer.UnixStreamServer.__init__(self, path, ControlHandler)
+        self.requests = []
+        self.status = 204
+
+class UpstreamControlTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.socket_path = os.path.join(self.path, "control.sock")
+        self.server = ControlServer(self.socket_path)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={"poll_interval": 0.05})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.control = upstreams.UpstreamControl(self.socket_path)
+        self.addCleanup(self.control.close)
+
+    def test_format_servers(self):
+        backends = [
+            Backend("10.0.0.1", 8080, 1),
+            Backend("fe80::1", 80, 5),
+        ]
+        assert upstreams.format_servers(backends) == \
+            "10.0.0.1 8080 1\nfe80::1 80 5\n"
+        assert upstreams.format_servers([]) == ""
+
+    def test_set(self):
+        self.control.set("abc", "10.0.0.1 8080 1\n")
+        assert self.server.requests == \
+            [("PUT", "/upstreams/abc", "10.0.0.1 8080 1\n")]
+
+    def test_delete(self):
+        self.control.delete("abc")
+        assert self.server.requests == [("DELETE", "/upstreams/abc", None)]
+
+    def test_reuse(self):
+        self.control.set("abc", "")
+        conn = self.control.conn
+        self.control.set("def", "")
+        self.control.delete("abc")
+        assert self.control.conn is conn
+        assert len(self.server.requests) == 3
+
+    def test_error_status(self):
+        self.server.status = 500
+        self.assertRaises(Exception, self.control.set, "abc", "")
+        assert self.control.conn is None
+        self.server.status = 204
+        self.control.set("abc", "")
+        assert len(self.server.requests) == 2
+
+    def test_not_listening(self):
+        control = upstreams.UpstreamControl(
+            os.path.join(self.path, "missing.sock"))
+        self.assertRaises(socket.error, control.set, "abc", "")
+        assert control.conn is None
+
+    def test_deadline(self):
+        self.control.set("abc", "", deadline=time.time() + 5.0)
+        self.assertRaises(socket.timeout, self.control.set,
+                          "def", "", deadline=time.time() - 1.0)
+        assert len(self.server.requests) == 1
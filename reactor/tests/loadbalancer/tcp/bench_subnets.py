@@ -0,0 +1,88 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmark for client subnet matching.
+
+This compares the original check (building netaddr objects for every subnet
+on every connection) with the compiled SubnetMatcher. It is not run as part
+of the test suite, run it directly with:
+
+    PYTHONPATH=. python reactor/tests/loadbalancer/tcp/bench_subnets.py [subnets] [clients]
+"""
+
+import sys
+import time
+import random
+import netaddr
+
+from reactor.loadbalancer.tcp.subnets import SubnetMatcher
+
+def generate(count, clients):
+    subnets = []
+    for i in xrange(count):
+        if i % 4 == 0:
+            subnets.append("2001:db8:%x::/48" % i)
+        else:
+            subnets.append("10.%d.%d.0/24" % ((i >> 8) & 0xff, i & 0xff))
+    addresses = []
+    for _ in xrange(clients):
+        if random.random() < 0.25:
+            addresses.append("2001:db8:%x::%x" % (
+                random.randint(0, count), random.randint(1, 0xffff)))
+        else:
+            addresses.append("10.%d.%d.%d" % (
+                random.randint(0, 8), random.randint(0, 255),
+                random.randint(1, 254)))
+    return (subnets, addresses)
+
+def original(subnets, addresses):
+    results = []
+    for address in addresses:
+        subnet_okay = False
+        for subnet in subnets:
+            if netaddr.ip.IPAddress(str(address)) in \
+               netaddr.ip.IPNetwork(str(subnet)):
+                subnet_okay = True
+                break
+        results.append(subnet_okay)
+    return results
+
+def compiled(matcher, addresses):
+    return [address in matcher for address in addresses]
+
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return (time.time() - start, result)
+
+def main(count=1000, clients=1000):
+    (subnets, addresses) = generate(count, clients)
+
+    print "subnets=%d clients=%d" % (count, clients)
+    (base_time, expected) = timed(original, subnets, addresses)
+    print "original:  %10.2fus per accept" % (base_time * 1e6 / clients)
+
+    (build_time, matcher) = timed(SubnetMatcher, subnets)
+    print "compile:   %10.2fms (once per portmap update)" % (build_time * 1e3)
+
+    (match_time, result) = timed(compiled, matcher, addresses * 100)
+    assert result[:clients] == expected
+    print "compiled:  %10.2fus per accept (%.0fx)" % (
+        match_time * 1e6 / (clients * 100),
+        (base_time / clients) / max(match_time / (clients * 100), 1e-12))
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,103 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import random
+import unittest
+
+import reactor.loadbalancer.tcp.balance as balance
+
+A = ("10.0.0.1", 80)
+B = ("10.0.0.2", 80)
+C = ("10.0.0.3", 80)
+
+class AliasTableTests(unittest.TestCase):
+
+    def test_distribution(self):
+        random.seed(1)
+        table = balance.AliasTable([1, 2, 7])
+        counts = [0, 0, 0]
+        for _ in range(20000):
+            counts[table.sample()] += 1
+        self.assertTrue(1500 < counts[0] < 2500)
+        self.assertTrue(3500 < counts[1] < 4500)
+        self.assertTrue(13000 < counts[2] < 15000)
+
+    def test_zero_weight(self):
+        table = balance.AliasTable([0, 1])
+        for _ in range(100):
+            self.assertEquals(table.sample(), 1)
+
+class StrategyTests(unittest.TestCase):
+
+    def test_weighted(self):
+        strategy = balance.Weighted([A, B], [0, 1])
+        for _ in range(100):
+            self.assertEquals(strategy.select(), B)
+
+    def test_weighted_all_zero(self):
+        strategy = balance.Weighted([A, B], [0, 0])
+        selected = set([strategy.select() for _ in range(100)])
+        self.assertEquals(selected, set([A, B]))
+
+    def test_empty(self):
+        for clazz in balance.STRATEGIES.values():
+            self.assertIsNone(clazz([]).select())
+
+    def test_least(self):
+        strategy = balance.LeastConnections([A, B, C])
+        selected = []
+        for _ in range(3):
+            backend = strategy.select()
+            strategy.acquire(backend)
+            selected.append(backend)
+        self.assertEquals(sorted(selected), [A, B, C])
+        strategy.release(B)
+        self.assertEquals(strategy.select(), B)
+        strategy.acquire(B)
+        strategy.acquire(B)
+        self.assertNotEquals(strategy.select(), B)
+
+    def test_least_release_unknown(self):
+        strategy = balance.LeastConnections([A])
+        strategy.release(A)
+        strategy.release(B)
+        strategy.acquire(B)
+        self.assertEquals(strategy.active(), { A : 0 })
+        self.assertEquals(strategy.select(), A)
+
+    def test_two_choices(self):
+        strategy = balance.TwoChoices([A, B])
+        for _ in range(10):
+            strategy.acquire(A)
+        # B will be picked unless both samples are A.
+        selected = [strategy.select() for _ in range(1000)]
+        self.assertTrue(selected.count(B) > 600)
+
+    def test_build(self):
+        strategy = balance.build("least", [A, B])
+        self.assertIsInstance(strategy, balance.LeastConnections)
+        strategy.acquire(A)
+        self.assertIs(balance.build("least", [A, B], previous=strategy), strategy)
+        rebuilt = balance.build("least", [A, C], previous=strategy)
+        self.assertIsNot(rebuilt, strategy)
+        self.assertEquals(rebuilt.active(), { A : 1, C : 0 })
+        self.assertEquals(rebuilt.select(), C)
+        other = balance.build("p2c", [A, C], previous=rebuilt)
+        self.assertIsInstance(other, balance.TwoChoices)
+        self.assertEquals(other.active(), { A : 1, C : 0 })
+
+    def test_build_unknown(self):
+        self.assertIsInstance(balance.build("bogus", [A]), balance.Weighted)
@@ -17,6 +17,10 @@ import unittest
 import mock
 import os
 import Queue
+import time
+import errno
+import socket
+import collections
 
 # Fake data
 FAKE_CMD = ["ls"]
@@ -53,6 +57,8 @@ class OsExit(Exception):
     pass
 
 import reactor.loadbalancer.tcp.connection as connection
+import reactor.loadbalancer.tcp.balance as balance
+import reactor.loadbalancer.tcp.subnets as subnets
 
 class GlobalTests(unittest.TestCase):
     def test_close_fd_all_excepted(self):
@@ -184,6 +190,23 @@ class AcceptTests(unittest.TestCase):
             self.assertEquals(mock_close.call_count, 1)
             self.assertEquals(mock_close.call_args_list[0][0], (FAKE_CLIENT_FD,))
 
+    def test_redirect_reaper(self):
+        with mock.patch('os.close') as mock_close,\
+                mock.patch(connection.__name__ + '.fork_and_exec') as mock_fe:
+            mock_accept = mock.Mock(spec=connection.Accept)
+            mock_accept.fd = FAKE_CLIENT_FD
+            mock_reaper = mock.Mock()
+            mock_reaper.pipe.return_value = (100, 101)
+            mock_fe.return_value = FAKE_GRANDCHILD_PID
+            exited = mock.Mock()
+            child = connection.Accept.redirect(mock_accept, FAKE_BACKEND_IP, FAKE_BACKEND_PORT,
+                                               reaper=mock_reaper, exited=exited)
+            self.assertEquals(child, FAKE_GRANDCHILD_PID)
+            self.assertEquals(mock_fe.call_args[1]["child_fds"], [FAKE_CLIENT_FD, 101])
+            mock_reaper.watch.assert_called_once_with(FAKE_GRANDCHILD_PID, 100, exited=exited)
+            closed = [args[0][0] for args in mock_close.call_args_list]
+            self.assertEquals(sorted(closed), sorted([101, FAKE_CLIENT_FD]))
+
 class ConnectionConsumerTests(unittest.TestCase):
     def test_constructor(self):
         # There's no logic in the constructor
@@ -204,17 +227,17 @@ class ConnectionConsumerTests(unittest.TestCase):
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
         mock_consumer._cond = mock.Mock()
         mock_consumer.locks = mock.Mock()
-        mock_consumer.locks.find.return_value = ["%s:%d" % (FAKE_BACKEND_IP, FAKE_PORT)]
+        mock_consumer.locks.find.return_value = [FAKE_BACKEND_ID]
         mock_consumer.error_notify = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], [])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], [], "socat", balance.Weighted([FAKE_BACKEND]))
         mock_consumer.children = {}
         mock_consumer.standby = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
         self.assertTrue(handled)
         self.assertEquals(mock_accept.redirect.call_count, 1)
         self.assertIn(FAKE_GRANDCHILD_PID, mock_consumer.children)
-        self.assertEquals(mock_consumer.children[FAKE_GRANDCHILD_PID], (FAKE_BACKEND_IP, FAKE_PORT, mock_accept, FAKE_RECONNECT, False))
+        self.assertEquals(mock_consumer.children[FAKE_GRANDCHILD_PID], (FAKE_BACKEND_IP, FAKE_BACKEND_PORT, mock_accept, FAKE_RECONNECT, False))
 
     def test_handle_exclusive_unlocked(self):
         mock_accept = mock.Mock(spec=connection.Accept)
@@ -229,7 +252,7 @@ class ConnectionConsumerTests(unittest.TestCase):
         mock_consumer.locks.lock.return_value = FAKE_BACKEND_ID
         mock_consumer.error_notify = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], [])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], [], "socat", balance.Weighted([FAKE_BACKEND]))
         mock_consumer.children = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
         self.assertTrue(handled)
@@ -249,7 +272,7 @@ class ConnectionConsumerTests(unittest.TestCase):
         mock_consumer.locks.lock.return_value = None
         mock_consumer.error_notify = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], [])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], [], "socat", balance.Weighted([FAKE_BACKEND]))
         mock_consumer.children = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
         self.assertFalse(handled)
@@ -264,7 +287,7 @@ class ConnectionConsumerTests(unittest.TestCase):
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
         mock_consumer._cond = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, False, False, 0, [FAKE_BACKEND], [])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, False, False, 0, [FAKE_BACKEND], [], "socat", balance.Weighted([FAKE_BACKEND]))
         mock_consumer.children = {}
         mock_consumer.error_notify = mock.Mock()
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
@@ -296,13 +319,33 @@ class ConnectionConsumerTests(unittest.TestCase):
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
         mock_consumer._cond = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, False, False, 0, [FAKE_BACKEND], [])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, False, False, 0, [FAKE_BACKEND], [], "socat", balance.Weighted([FAKE_BACKEND]))
         mock_consumer.children = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
         self.assertFalse(handled)
         self.assertEquals(mock_accept.redirect.call_count, 1)
         self.assertNotIn(FAKE_GRANDCHILD_PID, mock_consumer.children)
 
+    def test_handle_native(self):
+        mock_relay = mock.Mock()
+        mock_accept = mock.Mock(spec=connection.Accept)
+        mock_accept.fd = FAKE_CLIENT_FD
+        mock_accept.src = FAKE_CLIENT_SOCKNAME
+        mock_accept.dst = FAKE_SOCKNAME
+        mock_accept.relay.return_value = mock_relay
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.proxy = mock.Mock()
+        mock_consumer.portmap = {}
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, False, False, 0, [FAKE_BACKEND], [], "native", balance.Weighted([FAKE_BACKEND]))
+        mock_consumer.children = {}
+        mock_consumer.error_notify = mock.Mock()
+        handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
+        self.assertTrue(handled)
+        self.assertEquals(mock_accept.redirect.call_count, 0)
+        self.assertEquals(mock_accept.relay.call_count, 1)
+        self.assertEquals(mock_consumer.children[mock_relay], (FAKE_BACKEND_IP, FAKE_BACKEND_PORT, mock_accept, 0, False))
+
     def test_wait(self):
         # No logic in wait
         pass
@@ -322,7 +365,7 @@ class ConnectionConsumerTests(unittest.TestCase):
             mock_consumer.handle.return_value = True
             mock_consumer.producer = mock.Mock()
             mock_consumer.producer.next.side_effect = [ mock_accept, None ]
-            mock_consumer.postponed = []
+            mock_consumer.waiting = {}
             mock_consumer._cond = mock.Mock()
             mock_consumer.locks = mock.Mock()
             mock_consumer.error_notify = mock.Mock()
@@ -330,9 +373,10 @@ class ConnectionConsumerTests(unittest.TestCase):
             mock_consumer.children = {}
             connection.ConnectionConsumer.run(mock_consumer)
             self.assertEquals(mock_consumer.handle.call_count, 1)
-            self.assertEquals(mock_consumer.reap_children.call_count, 0)
+            self.assertEquals(mock_consumer.reap_children.call_count, 1)
+            self.assertEquals(mock_consumer.service.call_count, 0)
             self.assertEquals(mock_consumer.producer.next.call_count, 2)
-            self.assertEquals(len(mock_consumer.postponed), 0)
+            self.assertEquals(mock_consumer.waiting, {})
 
     def test_run_push_one(self):
         with mock.patch('os.kill') as mock_kill:
@@ -346,12 +390,12 @@ class ConnectionConsumerTests(unittest.TestCase):
             mock_consumer.producer = mock.Mock()
             mock_consumer.producer.next.side_effect = [ mock_accept, None ]
             mock_consumer.children = {}
-            mock_consumer.postponed = []
+            mock_consumer.waiting = {}
             mock_consumer._cond = mock.Mock()
             connection.ConnectionConsumer.run(mock_consumer)
             self.assertEquals(mock_consumer.handle.call_count, 1)
             self.assertEquals(mock_consumer.producer.next.call_count, 1)
-            self.assertEquals(len(mock_consumer.postponed), 1)
+            self.assertEquals(len(mock_consumer.waiting[FAKE_SOCKNAME[1]]), 1)
 
     def test_reap_children(self):
         with mock.patch('os.kill') as mock_kill:
@@ -365,7 +409,10 @@ class ConnectionConsumerTests(unittest.TestCase):
             mock_consumer.error_notify = mock.Mock()
             mock_consumer.discard_notify = mock.Mock()
             mock_consumer.children = { FAKE_GRANDCHILD_PID : ( FAKE_BACKEND_IP, FAKE_BACKEND_PORT, mock_accept, 0, False ) }
-            mock_kill.side_effect = OSError()
+            mock_consumer.dead = collections.deque([FAKE_GRANDCHILD_PID])
+            mock_consumer.portmap = {}
+            mock_consumer._release.side_effect = lambda *args: \
+                connection.ConnectionConsumer._release(mock_consumer, *args)
             connection.ConnectionConsumer.reap_children(mock_consumer)
             self.assertNotIn(FAKE_GRANDCHILD_PID, mock_consumer.children)
             self.assertEquals(mock_consumer.discard_notify.call_count, 0)
@@ -382,7 +429,10 @@ class ConnectionConsumerTests(unittest.TestCase):
             mock_consumer.error_notify = mock.Mock()
             mock_consumer.discard_notify = mock.Mock()
             mock_consumer.children = { FAKE_GRANDCHILD_PID : ( FAKE_BACKEND_IP, FAKE_BACKEND_PORT, mock_accept, 0, True ) }
-            mock_kill.side_effect = OSError()
+            mock_consumer.dead = collections.deque([FAKE_GRANDCHILD_PID])
+            mock_consumer.portmap = {}
+            mock_consumer._release.side_effect = lambda *args: \
+                connection.ConnectionConsumer._release(mock_consumer, *args)
             connection.ConnectionConsumer.reap_children(mock_consumer)
             self.assertNotIn(FAKE_GRANDCHILD_PID, mock_consumer.children)
             self.assertEquals(mock_consumer.discard_notify.call_count, 1)
@@ -395,9 +445,252 @@ class ConnectionConsumerTests(unittest.TestCase):
             mock_consumer.locks = mock.Mock()
             mock_consumer.error_notify = mock.Mock()
             mock_consumer.children = {}
+            mock_consumer.dead = collections.deque()
             connection.ConnectionConsumer.reap_children(mock_consumer)
             self.assertEquals(mock_kill.call_count, 0)
 
+    def test_reap_children_standby(self):
+        mock_accept = mock.Mock(spec=connection.Accept)
+        mock_accept.dst = FAKE_SOCKNAME
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.standby = {}
+        mock_consumer.deadlines = []
+        mock_consumer.children = {
+            FAKE_GRANDCHILD_PID : ( FAKE_BACKEND_IP, FAKE_BACKEND_PORT, mock_accept, FAKE_RECONNECT, False ),
+            FAKE_GRANDCHILD_PID + 1 : ( FAKE_BACKEND_IP, FAKE_BACKEND_PORT + 1, mock.Mock(), FAKE_RECONNECT, False ),
+        }
+        mock_consumer.dead = collections.deque([FAKE_GRANDCHILD_PID])
+        mock_consumer.portmap = {}
+        reaped = connection.ConnectionConsumer.reap_children(mock_consumer)
+        self.assertEquals(reaped, 1)
+        self.assertIn(FAKE_GRANDCHILD_PID + 1, mock_consumer.children)
+        self.assertIn(FAKE_BACKEND, mock_consumer.standby)
+        (deadline, _) = mock_consumer.standby[FAKE_BACKEND]
+        self.assertEquals(mock_consumer.deadlines, [(deadline, FAKE_BACKEND_IP, FAKE_BACKEND_PORT)])
+        self.assertEquals(mock_consumer._release.call_count, 0)
+
+    def test_reap_children_balance(self):
+        mock_accept = mock.Mock(spec=connection.Accept)
+        mock_accept.dst = FAKE_SOCKNAME
+        strategy = balance.LeastConnections([FAKE_BACKEND])
+        strategy.acquire(FAKE_BACKEND)
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.portmap = { FAKE_SOCKNAME[1] : (FAKE_URL, False, False, 0, [FAKE_BACKEND], [], "socat", strategy) }
+        mock_consumer.children = { FAKE_GRANDCHILD_PID : ( FAKE_BACKEND_IP, FAKE_BACKEND_PORT, mock_accept, 0, False ) }
+        mock_consumer.dead = collections.deque([FAKE_GRANDCHILD_PID])
+        connection.ConnectionConsumer.reap_children(mock_consumer)
+        self.assertEquals(strategy.active(), { FAKE_BACKEND : 0 })
+
+    def test_metrics(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.portmap = { FAKE_PORT : (FAKE_URL, False, False, 0, [FAKE_BACKEND], [], "socat", balance.Weighted([FAKE_BACKEND])) }
+        mock_consumer.children = {}
+        mock_consumer.started = {}
+        mock_consumer.reported = {}
+        mock_consumer.stats = {}
+        mock_consumer.last_metrics = time.time() - 1.0
+        for name in ("_backend_stats", "_opened", "_closed", "_transferred"):
+            getattr(mock_consumer, name).side_effect = (lambda fn: lambda *args: \
+                fn(mock_consumer, *args))(getattr(connection.ConnectionConsumer, name))
+
+        # One connection opened, another opened and closed.
+        mock_consumer._opened(FAKE_GRANDCHILD_PID, FAKE_BACKEND_IP, FAKE_BACKEND_PORT)
+        mock_consumer._opened(FAKE_GRANDCHILD_PID + 1, FAKE_BACKEND_IP, FAKE_BACKEND_PORT)
+        mock_consumer._closed(FAKE_GRANDCHILD_PID + 1, FAKE_BACKEND_IP, FAKE_BACKEND_PORT)
+        metric_map = connection.ConnectionConsumer.metrics(mock_consumer)
+        self.assertEquals(metric_map.keys(), [FAKE_BACKEND_ID])
+        [metrics] = metric_map[FAKE_BACKEND_ID]
+        self.assertEquals(metrics["active"], (1, 1))
+        self.assertEquals(metrics["duration"][0], 1)
+        self.assertTrue(metrics["rate"][1] > 0)
+        self.assertEquals(mock_consumer.started.keys(), [FAKE_GRANDCHILD_PID])
+
+    def test_metrics_relay(self):
+        mock_relay = mock.Mock(spec=connection.proxy.Relay)
+        mock_relay.transferred.return_value = (100, 200)
+        mock_relay.latency.return_value = 0.25
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.portmap = {}
+        mock_consumer.children = { mock_relay : (FAKE_BACKEND_IP, FAKE_BACKEND_PORT, None, 0, False) }
+        mock_consumer.started = { mock_relay : time.time() }
+        mock_consumer.reported = {}
+        mock_consumer.stats = {}
+        mock_consumer.last_metrics = time.time() - 1.0
+        for name in ("_backend_stats", "_closed", "_transferred"):
+            getattr(mock_consumer, name).side_effect = (lambda fn: lambda *args: \
+                fn(mock_consumer, *args))(getattr(connection.ConnectionConsumer, name))
+        mock_consumer._backend_stats(FAKE_BACKEND_IP, FAKE_BACKEND_PORT).open()
+
+        # Live traffic is picked up once.
+        connection.ConnectionConsumer.metrics(mock_consumer)
+        self.assertEquals(mock_consumer.reported[mock_relay], (100, 200))
+        mock_relay.transferred.return_value = (150, 200)
+        del mock_consumer.children[mock_relay]
+        mock_consumer._closed(mock_relay, FAKE_BACKEND_IP, FAKE_BACKEND_PORT)
+        backend_stats = mock_consumer.stats[FAKE_BACKEND_ID]
+        self.assertEquals(backend_stats.bytes_in, 50)
+        self.assertEquals(backend_stats.bytes_out, 0)
+        self.assertEquals(backend_stats.connect_count, 1)
+        self.assertEquals(mock_consumer.reported, {})
+
+    def test_kick(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer._cond.acquire.return_value = True
+        mock_consumer.ready = False
+        connection.ConnectionConsumer.kick(mock_consumer)
+        self.assertTrue(mock_consumer.ready)
+        self.assertEquals(mock_consumer._notify.call_count, 1)
+
+    def test_kick_busy(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer._cond.acquire.return_value = False
+        mock_consumer.ready = False
+        connection.ConnectionConsumer.kick(mock_consumer)
+        self.assertTrue(mock_consumer.ready)
+        self.assertEquals(mock_consumer._notify.call_count, 0)
+        self.assertEquals(mock_consumer._cond.release.call_count, 0)
+
+    def test_exited(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer._cond.acquire.return_value = True
+        mock_consumer.children = { FAKE_GRANDCHILD_PID : None }
+        mock_consumer.dead = collections.deque()
+        connection.ConnectionConsumer.exited(mock_consumer, FAKE_GRANDCHILD_PID)
+        self.assertEquals(list(mock_consumer.dead), [FAKE_GRANDCHILD_PID])
+        self.assertEquals(mock_consumer._notify.call_count, 1)
+        mock_consumer._cond.acquire.assert_called_with(False)
+
+    def test_exited_busy(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer._cond.acquire.return_value = False
+        mock_consumer.children = { FAKE_GRANDCHILD_PID : None }
+        mock_consumer.dead = collections.deque()
+        connection.ConnectionConsumer.exited(mock_consumer, FAKE_GRANDCHILD_PID)
+        self.assertEquals(list(mock_consumer.dead), [FAKE_GRANDCHILD_PID])
+        self.assertEquals(mock_consumer._notify.call_count, 0)
+
+    def test_reap_children_unknown(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.children = {}
+        mock_consumer.dead = collections.deque([FAKE_GRANDCHILD_PID])
+        self.assertEquals(connection.ConnectionConsumer.reap_children(mock_consumer), 0)
+        self.assertEquals(len(mock_consumer.dead), 0)
+
+    def _standby_consumer(self, standby, deadlines):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.standby = standby
+        mock_consumer.deadlines = deadlines
+        return mock_consumer
+
+    def test_clear_standby_expired(self):
+        past = time.time() - 1.0
+        future = time.time() + 60.0
+        other = (FAKE_BACKEND_IP, FAKE_BACKEND_PORT + 1)
+        mock_consumer = self._standby_consumer(
+            { FAKE_BACKEND : (past, False), other : (future, False) },
+            [(past, FAKE_BACKEND_IP, FAKE_BACKEND_PORT), (future,) + other])
+        removed = connection.ConnectionConsumer.clear_standby(mock_consumer)
+        self.assertEquals(removed, 1)
+        self.assertEquals(mock_consumer.standby, { other : (future, False) })
+        mock_consumer._release.assert_called_once_with(FAKE_BACKEND_IP, FAKE_BACKEND_PORT, False)
+        self.assertEquals(mock_consumer.deadlines, [(future,) + other])
+
+    def test_clear_standby_stale(self):
+        past = time.time() - 1.0
+        newer = time.time() + 60.0
+        # The first entry was taken by a reconnect, the second was
+        # replaced by a newer entry after its deadline was pushed.
+        mock_consumer = self._standby_consumer(
+            { FAKE_BACKEND : (newer, False) },
+            [(past - 1.0, FAKE_BACKEND_IP, FAKE_BACKEND_PORT + 1),
+             (past, FAKE_BACKEND_IP, FAKE_BACKEND_PORT)])
+        removed = connection.ConnectionConsumer.clear_standby(mock_consumer)
+        self.assertEquals(removed, 0)
+        self.assertEquals(mock_consumer.standby, { FAKE_BACKEND : (newer, False) })
+        self.assertEquals(mock_consumer._release.call_count, 0)
+
+    def test_clear_standby_force(self):
+        future = time.time() + 60.0
+        mock_consumer = self._standby_consumer(
+            { FAKE_BACKEND : (future, True) },
+            [(future, FAKE_BACKEND_IP, FAKE_BACKEND_PORT)])
+        removed = connection.ConnectionConsumer.clear_standby(mock_consumer, force=True)
+        self.assertEquals(removed, 1)
+        self.assertEquals(mock_consumer.standby, {})
+        self.assertEquals(mock_consumer.deadlines, [])
+        mock_consumer._release.assert_called_once_with(FAKE_BACKEND_IP, FAKE_BACKEND_PORT, True)
+
+    def test_service_fifo(self):
+        first = mock.Mock()
+        second = mock.Mock()
+        third = mock.Mock()
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.waiting = { FAKE_PORT : collections.deque([first, second, third]) }
+        mock_consumer.handle.side_effect = [True, False]
+        handled = connection.ConnectionConsumer.service(mock_consumer)
+        self.assertEquals(handled, 1)
+        self.assertEquals([c[0][0] for c in mock_consumer.handle.call_args_list], [first, second])
+        self.assertEquals(list(mock_consumer.waiting[FAKE_PORT]), [second, third])
+
+    def test_service_empty(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.waiting = { FAKE_PORT : collections.deque([mock.Mock()]) }
+        mock_consumer.handle.return_value = True
+        connection.ConnectionConsumer.service(mock_consumer)
+        self.assertEquals(mock_consumer.waiting, {})
+
+    def test_run_queue_behind_waiting(self):
+        mock_accept = mock.Mock(spec=connection.Accept)
+        mock_accept.dst = FAKE_SOCKNAME
+        waiting = mock.Mock(spec=connection.Accept)
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.is_running.side_effect = [True, False]
+        mock_consumer.producer = mock.Mock()
+        mock_consumer.producer.next.return_value = mock_accept
+        mock_consumer.waiting = { FAKE_SOCKNAME[1] : collections.deque([waiting]) }
+        connection.ConnectionConsumer.run(mock_consumer)
+        self.assertEquals(mock_consumer.handle.call_count, 0)
+        self.assertEquals(list(mock_consumer.waiting[FAKE_SOCKNAME[1]]), [waiting, mock_accept])
+
+    def test_run_service_ready(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.is_running.side_effect = [True, True, False]
+        mock_consumer.producer = mock.Mock()
+        mock_consumer.producer.next.return_value = None
+        mock_consumer.waiting = { FAKE_PORT : collections.deque([mock.Mock()]) }
+        mock_consumer.ready = True
+        mock_consumer.retried = time.time()
+        mock_consumer._timeout.return_value = 1.0
+        connection.ConnectionConsumer.run(mock_consumer)
+        # Serviced once (when ready), then waits for the retry interval.
+        self.assertEquals(mock_consumer.service.call_count, 1)
+        mock_consumer._wait.assert_called_once_with(1.0)
+
+    def test_pending(self):
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.portmap = { FAKE_PORT : (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], [], "socat", balance.Weighted([FAKE_BACKEND])) }
+        mock_consumer.waiting = {
+            FAKE_PORT : collections.deque([mock.Mock(), mock.Mock()]),
+            FAKE_PORT_2 : collections.deque([mock.Mock()]),
+        }
+        pending = connection.ConnectionConsumer.pending(mock_consumer)
+        self.assertEquals(pending, { FAKE_URL : 2 })
+
     def test_sessions(self):
         with mock.patch(connection.__name__ + '._as_client') as mock_ac:
             mock_accept = mock.Mock(spec=connection.Accept)
@@ -449,6 +742,44 @@ class ConnectionConsumerTests(unittest.TestCase):
             self.assertEquals(mock_kill.call_count, 0)
             self.assertIn(FAKE_GRANDCHILD_PID, mock_consumer.children)
 
+    def test_drop_backend(self):
+        with mock.patch('os.kill') as mock_kill:
+            mock_accept = mock.Mock(spec=connection.Accept)
+            mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+            mock_consumer._cond = mock.Mock()
+            mock_consumer.children = {
+                FAKE_GRANDCHILD_PID : ( FAKE_BACKEND_IP, FAKE_BACKEND_PORT, mock_accept, 0, False ),
+                FAKE_GRANDCHILD_PID + 1 : ( "10.0.0.1", FAKE_BACKEND_PORT, mock_accept, 0, False ),
+            }
+            mock_consumer.standby = { FAKE_BACKEND : (time.time(), False) }
+            connection.ConnectionConsumer.drop_backend(mock_consumer, FAKE_BACKEND_IP, FAKE_BACKEND_PORT)
+            self.assertEquals(mock_kill.call_count, 1)
+            self.assertEquals(mock_kill.call_args_list[0][0][0], FAKE_GRANDCHILD_PID)
+            self.assertEquals(mock_consumer.standby, {})
+            mock_consumer._release.assert_called_once_with(FAKE_BACKEND_IP, FAKE_BACKEND_PORT, False)
+
+    def test_handle_reconnect_draining(self):
+        # The client's old backend is draining, so it gets a new one.
+        mock_accept = mock.Mock(spec=connection.Accept)
+        mock_accept.fd = FAKE_CLIENT_FD
+        mock_accept.src = FAKE_CLIENT_SOCKNAME
+        mock_accept.dst = FAKE_SOCKNAME
+        mock_accept.redirect.return_value = FAKE_GRANDCHILD_PID
+        mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
+        mock_consumer._cond = mock.Mock()
+        mock_consumer.locks = mock.Mock()
+        mock_consumer.locks.find.return_value = ["10.0.0.1:%d" % FAKE_BACKEND_PORT]
+        mock_consumer.locks.lock.return_value = FAKE_BACKEND_ID
+        mock_consumer.portmap = {}
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], [], "socat", balance.Weighted([FAKE_BACKEND]))
+        mock_consumer.children = {}
+        mock_consumer.standby = { ("10.0.0.1", FAKE_BACKEND_PORT) : (time.time(), False) }
+        handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
+        self.assertTrue(handled)
+        self.assertEquals(mock_consumer.locks.lock.call_count, 1)
+        self.assertEquals(mock_consumer.children[FAKE_GRANDCHILD_PID][:2], FAKE_BACKEND)
+        self.assertIn(("10.0.0.1", FAKE_BACKEND_PORT), mock_consumer.standby)
+
 class ConnectionProducerTests(unittest.TestCase):
     def test_constructor(self):
         # No logic in the ConnectionProducer constructor
@@ -460,6 +791,7 @@ class ConnectionProducerTests(unittest.TestCase):
             mock_producer._cond = mock.Mock()
             mock_producer.sockets = {}
             mock_producer.filemap = {}
+            mock_producer.backlogs = {}
             mock_socket_obj = mock.Mock()
             mock_socket_obj.fileno.return_value = FAKE_SOCK_FD
             mock_socket.return_value = mock_socket_obj
@@ -471,12 +803,29 @@ class ConnectionProducerTests(unittest.TestCase):
             self.assertEquals(mock_socket_obj.bind.call_count, 1)
             self.assertEquals(mock_socket_obj.listen.call_count, 1)
 
+    def test_set_add_one_reuseport(self):
+        with mock.patch('socket.socket') as mock_socket:
+            mock_producer = mock.Mock(spec=connection.ConnectionProducer)
+            mock_producer._cond = mock.Mock()
+            mock_producer.reuseport = True
+            mock_producer.sockets = {}
+            mock_producer.filemap = {}
+            mock_producer.backlogs = {}
+            mock_socket_obj = mock.Mock()
+            mock_socket_obj.fileno.return_value = FAKE_SOCK_FD
+            mock_socket.return_value = mock_socket_obj
+            connection.ConnectionProducer.set(mock_producer, FAKE_PORTS)
+            self.assertIn(FAKE_PORT, mock_producer.sockets)
+            options = [args[0][1] for args in mock_socket_obj.setsockopt.call_args_list]
+            self.assertIn(connection.SO_REUSEPORT, options)
+
     def test_set_add_one_cant_bind(self):
         with mock.patch('socket.socket') as mock_socket:
             mock_producer = mock.Mock(spec=connection.ConnectionProducer)
             mock_producer._cond = mock.Mock()
             mock_producer.sockets = {}
             mock_producer.filemap = {}
+            mock_producer.backlogs = {}
             mock_socket_obj = mock.Mock()
             mock_socket_obj.bind.side_effect = IOError()
             mock_socket.return_value = mock_socket_obj
@@ -492,6 +841,7 @@ class ConnectionProducerTests(unittest.TestCase):
             mock_producer._cond = mock.Mock()
             mock_producer.sockets = {}
             mock_producer.filemap = {}
+            mock_producer.backlogs = {}
             mock_socket_obj = mock.Mock()
             mock_socket_obj.bind.side_effect = [IOError(), None]
             mock_socket_obj.fileno.return_value = FAKE_SOCK_FD
@@ -513,6 +863,7 @@ class ConnectionProducerTests(unittest.TestCase):
             mock_producer._cond = mock.Mock()
             mock_producer.sockets = { FAKE_PORT : mock_socket_obj }
             mock_producer.filemap = { FAKE_SOCK_FD : mock_socket_obj }
+            mock_producer.backlogs = { FAKE_PORT : connection.DEFAULT_BACKLOG }
             connection.ConnectionProducer.set(mock_producer, [] )
             self.assertNotIn(FAKE_PORT, mock_producer.sockets)
             self.assertNotIn(FAKE_SOCK_FD, mock_producer.filemap)
@@ -531,6 +882,7 @@ class ConnectionProducerTests(unittest.TestCase):
             mock_producer._cond = mock.Mock()
             mock_producer.sockets = { FAKE_PORT : mock_socket_obj }
             mock_producer.filemap = { FAKE_SOCK_FD : mock_socket_obj }
+            mock_producer.backlogs = { FAKE_PORT : connection.DEFAULT_BACKLOG }
             connection.ConnectionProducer.set(mock_producer, [FAKE_PORT_2] )
             self.assertNotIn(FAKE_PORT, mock_producer.sockets)
             self.assertNotIn(FAKE_SOCK_FD, mock_producer.filemap)
@@ -556,6 +908,7 @@ class ConnectionProducerTests(unittest.TestCase):
             mock_producer._cond = mock.Mock()
             mock_producer.sockets = { FAKE_PORT : mock_socket_obj }
             mock_producer.filemap = { FAKE_SOCK_FD : mock_socket_obj }
+            mock_producer.backlogs = { FAKE_PORT : connection.DEFAULT_BACKLOG }
             connection.ConnectionProducer.set(mock_producer, [FAKE_PORT_2] )
             self.assertNotIn(FAKE_PORT, mock_producer.sockets)
             self.assertNotIn(FAKE_SOCK_FD, mock_producer.filemap)
@@ -584,21 +937,53 @@ class ConnectionProducerTests(unittest.TestCase):
             self.assertEquals(mock_epoll.call_count, 1)
             self.assertEquals(mock_producer.epoll.register.call_count, 1)
 
-    def test_run_epoll_accept_one(self):
+    def _run_producer(self, accepts, backlog=connection.DEFAULT_BACKLOG):
         with mock.patch(connection.__name__ + ".Accept") as mock_accept:
+            mock_accept.side_effect = accepts
             mock_socket_obj = mock.Mock()
+            mock_socket_obj.getsockname.return_value = ("0.0.0.0", FAKE_PORT)
             mock_producer = mock.Mock(spec=connection.ConnectionProducer)
             mock_producer._cond = mock.Mock()
             mock_producer.queue = Queue.Queue()
             mock_producer.notifiers = []
             mock_producer.sockets = { FAKE_PORT : mock_socket_obj }
             mock_producer.filemap = { FAKE_SOCK_FD : mock_socket_obj }
+            mock_producer.backlogs = { FAKE_PORT : backlog }
             mock_producer.is_running.side_effect = [True, False]
             mock_producer.epoll = mock.Mock()
             mock_producer.epoll.poll.return_value = [(FAKE_SOCK_FD, GARBAGE)]
             connection.ConnectionProducer.run(mock_producer)
             self.assertEquals(mock_producer.epoll.poll.call_count, 1)
-            self.assertEquals(mock_accept.call_count, 1)
+            self.assertEquals(mock_accept.call_count, len(accepts))
+            return mock_producer
+
+    def test_run_epoll_accept_one(self):
+        mock_producer = self._run_producer(
+            [mock.Mock(), socket.error(errno.EAGAIN, "again")])
+        self.assertEquals(mock_producer.queue.qsize(), 1)
+        self.assertEquals(mock_producer.notify.call_count, 1)
+        mock_producer._count.assert_called_once_with(FAKE_PORT, 1, False)
+
+    def test_run_epoll_accept_drain(self):
+        mock_producer = self._run_producer(
+            [mock.Mock(), mock.Mock(),
+             socket.error(errno.ECONNABORTED, "aborted"),
+             mock.Mock(), socket.error(errno.EAGAIN, "again")])
+        self.assertEquals(mock_producer.queue.qsize(), 3)
+        self.assertEquals(mock_producer.notify.call_count, 1)
+        mock_producer._count.assert_called_once_with(FAKE_PORT, 3, False)
+
+    def test_run_epoll_accept_saturated(self):
+        mock_producer = self._run_producer(
+            [mock.Mock(), mock.Mock(), socket.error(errno.EAGAIN, "again")],
+            backlog=2)
+        mock_producer._count.assert_called_once_with(FAKE_PORT, 2, True)
+
+    def test_run_epoll_accept_none(self):
+        mock_producer = self._run_producer(
+            [socket.error(errno.EMFILE, "too many files")])
+        self.assertEquals(mock_producer.queue.qsize(), 0)
+        self.assertEquals(mock_producer.notify.call_count, 0)
 
     def test_run_epoll_stale_sock(self):
         mock_producer = mock.Mock(spec=connection.ConnectionProducer)
@@ -610,7 +995,40 @@ class ConnectionProducerTests(unittest.TestCase):
         mock_producer.epoll.poll.return_value = [(FAKE_SOCK_FD, GARBAGE)]
         connection.ConnectionProducer.run(mock_producer)
         self.assertEquals(mock_producer.epoll.poll.call_count, 1)
-        self.assertEquals(mock_producer._update_epoll.call_count, 1)
+        mock_producer._unregister.assert_called_once_with(FAKE_SOCK_FD)
+        self.assertEquals(mock_producer._update_epoll.call_count, 0)
+
+    def test_set_backlog(self):
+        with mock.patch('socket.socket') as mock_socket:
+            mock_producer = mock.Mock(spec=connection.ConnectionProducer)
+            mock_producer._cond = mock.Mock()
+            mock_producer.sockets = {}
+            mock_producer.filemap = {}
+            mock_producer.backlogs = {}
+            mock_socket_obj = mock.Mock()
+            mock_socket_obj.fileno.return_value = FAKE_SOCK_FD
+            mock_socket.return_value = mock_socket_obj
+            connection.ConnectionProducer.set(mock_producer, FAKE_PORTS,
+                                              backlogs={ FAKE_PORT : 512 })
+            mock_socket_obj.listen.assert_called_once_with(512)
+            mock_socket_obj.setblocking.assert_called_once_with(0)
+            mock_producer._register.assert_called_once_with(FAKE_SOCK_FD)
+
+            # Changing the backlog re-listens on the existing socket.
+            connection.ConnectionProducer.set(mock_producer, FAKE_PORTS,
+                                              backlogs={ FAKE_PORT : 1024 })
+            self.assertEquals(mock_socket.call_count, 1)
+            self.assertEquals(mock_socket_obj.listen.call_args[0][0], 1024)
+            self.assertEquals(mock_producer.backlogs[FAKE_PORT], 1024)
+
+    def test_stats(self):
+        mock_producer = mock.Mock(spec=connection.ConnectionProducer)
+        mock_producer._cond = mock.Mock()
+        mock_producer.counters = {}
+        connection.ConnectionProducer._count(mock_producer, FAKE_PORT, 3, False)
+        connection.ConnectionProducer._count(mock_producer, FAKE_PORT, 2, True)
+        stats = connection.ConnectionProducer.stats(mock_producer)
+        self.assertEquals(stats, { FAKE_PORT : (5, 1) })
 
 class ConnectionTests(unittest.TestCase):
     def test_constructor(self):
@@ -623,45 +1041,115 @@ class ConnectionTests(unittest.TestCase):
 
     def test_delete(self):
         mock_conn = mock.Mock(spec=connection.Connection)
-        mock_conn.producer = mock.Mock()
-        mock_conn.consumer = mock.Mock()
+        mock_producer = mock.Mock()
+        mock_consumer = mock.Mock()
+        mock_conn.shards = [(mock_producer, mock_consumer)]
+        mock_conn.proxy = mock.Mock()
         mock_conn.locks = mock.Mock()
         connection.Connection.__del__(mock_conn)
-        self.assertEquals(mock_conn.producer.set.call_count, 1)
-        self.assertEquals(mock_conn.producer.stop.call_count, 1)
-        self.assertEquals(mock_conn.consumer.set.call_count, 1)
-        self.assertEquals(mock_conn.consumer.stop.call_count, 1)
+        self.assertEquals(mock_producer.set.call_count, 1)
+        self.assertEquals(mock_producer.stop.call_count, 1)
+        self.assertEquals(mock_consumer.set.call_count, 1)
+        self.assertEquals(mock_consumer.stop.call_count, 1)
+        self.assertEquals(mock_conn.proxy.stop.call_count, 1)
 
     def test_change_no_ips(self):
         mock_conn = mock.Mock(spec=connection.Connection)
         mock_conn.portmap = {}
+        mock_conn.backlogs = {}
+        mock_conn.draining = {}
         mock_conn.url_info.return_value = FAKE_PORT
+        mock_conn._endpoint_config.return_value.drain_timeout = 0
         connection.Connection.change(mock_conn, FAKE_URL, [])
         self.assertEquals(mock_conn.portmap, {})
 
     def test_change_remove_ip(self):
         mock_conn = mock.Mock(spec=connection.Connection)
         mock_conn.url_info.return_value = FAKE_PORT
-        mock_conn.portmap = { FAKE_PORT : (FAKE_URL, True, False, FAKE_RECONNECT, [(FAKE_BACKEND_IP, FAKE_BACKEND_PORT)], []) }
+        mock_conn.portmap = { FAKE_PORT : (FAKE_URL, True, False, FAKE_RECONNECT, [(FAKE_BACKEND_IP, FAKE_BACKEND_PORT)], [], "socat", balance.Weighted([FAKE_BACKEND])) }
+        mock_conn.backlogs = { FAKE_PORT : connection.DEFAULT_BACKLOG }
+        mock_conn.draining = {}
+        mock_conn._endpoint_config.return_value.drain_timeout = 0
         connection.Connection.change(mock_conn, FAKE_URL, [])
         self.assertEquals(mock_conn.portmap, {})
+        self.assertEquals(mock_conn.backlogs, {})
+        self.assertEquals(mock_conn.draining, { FAKE_BACKEND : None })
+
+    def test_change_drain_timeout(self):
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_conn.url_info.return_value = FAKE_PORT
+        mock_conn.portmap = { FAKE_PORT : (FAKE_URL, False, False, 0, [FAKE_BACKEND], [], "socat", balance.Weighted([FAKE_BACKEND])) }
+        mock_conn.backlogs = {}
+        mock_conn.draining = {}
+        mock_conn._endpoint_config.return_value.drain_timeout = 30
+        connection.Connection.change(mock_conn, FAKE_URL, [])
+        deadline = mock_conn.draining[FAKE_BACKEND]
+        self.assertTrue(time.time() < deadline <= time.time() + 30)
+
+        # Coming back stops the drain.
+        mock_backend = mock.Mock()
+        mock_backend.ip = FAKE_BACKEND_IP
+        mock_backend.port = FAKE_BACKEND_PORT
+        mock_backend.weight = 1
+        mock_config = mock_conn._endpoint_config.return_value
+        mock_config.balance = "weighted"
+        mock_config.client_subnets = []
+        connection.Connection.change(mock_conn, FAKE_URL, [mock_backend])
+        self.assertEquals(mock_conn.draining, {})
 
     def test_change_add_ip(self):
         mock_backend = mock.Mock()
         mock_backend.ip = FAKE_BACKEND_IP
         mock_backend.port = FAKE_BACKEND_PORT
+        mock_backend.weight = 1
         mock_config = mock.Mock()
         mock_config.exclusive = True
         mock_config.disposable = False
         mock_config.reconnect = FAKE_RECONNECT
         mock_config.client_subnets = []
+        mock_config.proxy = "native"
+        mock_config.backlog = 512
+        mock_config.balance = "least"
+        mock_config.drain_timeout = 0
         mock_conn = mock.Mock(spec=connection.Connection)
         mock_conn.portmap = {}
+        mock_conn.backlogs = {}
+        mock_conn.draining = {}
         mock_conn.url_info.return_value = FAKE_PORT
         mock_conn._endpoint_config.return_value = mock_config
         connection.Connection.change(mock_conn, FAKE_URL, [mock_backend])
         self.assertIn(FAKE_PORT, mock_conn.portmap)
-        self.assertEquals(mock_conn.portmap[FAKE_PORT], (FAKE_URL, True, False, FAKE_RECONNECT, [(FAKE_BACKEND_IP, FAKE_BACKEND_PORT)], []))
+        self.assertEquals(mock_conn.portmap[FAKE_PORT][:5], (FAKE_URL, True, False, FAKE_RECONNECT, [(FAKE_BACKEND_IP, FAKE_BACKEND_PORT)]))
+        self.assertFalse(mock_conn.portmap[FAKE_PORT][5])
+        self.assertEquals(mock_conn.portmap[FAKE_PORT][6], "native")
+        self.assertIsInstance(mock_conn.portmap[FAKE_PORT][7], balance.LeastConnections)
+        self.assertEquals(mock_conn.backlogs, { FAKE_PORT : 512 })
+
+    def test_change_keep_strategy(self):
+        mock_backend = mock.Mock()
+        mock_backend.ip = FAKE_BACKEND_IP
+        mock_backend.port = FAKE_BACKEND_PORT
+        mock_backend.weight = 1
+        mock_config = mock.Mock()
+        mock_config.balance = "weighted"
+        mock_config.client_subnets = []
+        mock_config.drain_timeout = 0
+        strategy = balance.Weighted([FAKE_BACKEND])
+        strategy.acquire(FAKE_BACKEND)
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_conn.portmap = { FAKE_PORT : (FAKE_URL, False, False, 0, [FAKE_BACKEND], [], "native", strategy) }
+        mock_conn.backlogs = {}
+        mock_conn.draining = {}
+        mock_conn.url_info.return_value = FAKE_PORT
+        mock_conn._endpoint_config.return_value = mock_config
+        connection.Connection.change(mock_conn, FAKE_URL, [mock_backend])
+        self.assertIs(mock_conn.portmap[FAKE_PORT][7], strategy)
+
+        # A new weight rebuilds the strategy, keeping the counts.
+        mock_backend.weight = 2
+        connection.Connection.change(mock_conn, FAKE_URL, [mock_backend])
+        self.assertIsNot(mock_conn.portmap[FAKE_PORT][7], strategy)
+        self.assertEquals(mock_conn.portmap[FAKE_PORT][7].active(), { FAKE_BACKEND : 1 })
 
     def test_save(self):
         # No logic in save.
@@ -678,7 +1166,7 @@ class ConnectionTests(unittest.TestCase):
         mock_consumer.locks.find.return_value = [FAKE_BACKEND_ID]
         mock_consumer.error_notify = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], [])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], [], "socat", balance.Weighted([FAKE_BACKEND]))
         mock_consumer.children = {}
         mock_consumer.standby = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
@@ -694,10 +1182,10 @@ class ConnectionTests(unittest.TestCase):
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
         mock_consumer._cond = mock.Mock()
         mock_consumer.locks = mock.Mock()
-        mock_consumer.locks.find.return_value = ["%s:%d" % (FAKE_BACKEND_IP, FAKE_PORT)]
+        mock_consumer.locks.find.return_value = [FAKE_BACKEND_ID]
         mock_consumer.error_notify = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], ["%s/32" % FAKE_CLIENT_IP])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], subnets.SubnetMatcher(["%s/32" % FAKE_CLIENT_IP]), "socat", balance.Weighted([FAKE_BACKEND]))
         mock_consumer.children = {}
         mock_consumer.standby = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
@@ -713,10 +1201,10 @@ class ConnectionTests(unittest.TestCase):
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
         mock_consumer._cond = mock.Mock()
         mock_consumer.locks = mock.Mock()
-        mock_consumer.locks.find.return_value = ["%s:%d" % (FAKE_BACKEND_IP, FAKE_PORT)]
+        mock_consumer.locks.find.return_value = [FAKE_BACKEND_ID]
         mock_consumer.error_notify = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], ["1.2.3.4/24", "%s/32" % FAKE_CLIENT_IP])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], subnets.SubnetMatcher(["1.2.3.4/24", "%s/32" % FAKE_CLIENT_IP]), "socat", balance.Weighted([FAKE_BACKEND]))
         mock_consumer.children = {}
         mock_consumer.standby = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
@@ -732,7 +1220,7 @@ class ConnectionTests(unittest.TestCase):
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
         mock_consumer._cond = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], ["1.2.3.4/24"])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], subnets.SubnetMatcher(["1.2.3.4/24"]), "socat", balance.Weighted([FAKE_BACKEND]))
         mock_consumer.children = {}
         mock_consumer.standby = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
@@ -748,7 +1236,7 @@ class ConnectionTests(unittest.TestCase):
         mock_consumer = mock.Mock(spec=connection.ConnectionConsumer)
         mock_consumer._cond = mock.Mock()
         mock_consumer.portmap = {}
-        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], ["1.2.3.4/24", "5.6.7.8/16"])
+        mock_consumer.portmap[FAKE_PORT] = (FAKE_URL, True, False, FAKE_RECONNECT, [FAKE_BACKEND], subnets.SubnetMatcher(["1.2.3.4/24", "5.6.7.8/16"]), "socat", balance.Weighted([FAKE_BACKEND]))
         mock_consumer.children = {}
         mock_consumer.standby = {}
         handled = connection.ConnectionConsumer.handle(mock_consumer, mock_accept)
@@ -772,9 +1260,111 @@ class ConnectionTests(unittest.TestCase):
         self.assertEquals(mock_accept.drop.call_count, 1)
 
     def test_sessions(self):
-        # No logic in sessions.
-        pass
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_consumers = [mock.Mock(), mock.Mock()]
+        mock_consumers[0].sessions.return_value = { FAKE_BACKEND_ID : ["a:1"] }
+        mock_consumers[1].sessions.return_value = { FAKE_BACKEND_ID : ["b:2"] }
+        mock_conn.shards = [(mock.Mock(), c) for c in mock_consumers]
+        sessions = connection.Connection.sessions(mock_conn)
+        self.assertEquals(sessions, { FAKE_BACKEND_ID : ["a:1", "b:2"] })
+
+    def test_released(self):
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_consumers = [mock.Mock(), mock.Mock()]
+        mock_conn.shards = [(mock.Mock(), c) for c in mock_consumers]
+        connection.Connection._released(mock_conn)
+        for c in mock_consumers:
+            self.assertEquals(c.kick.call_count, 1)
 
     def test_drop_session(self):
-        # No logic in drop_sessions.
-        pass
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_consumers = [mock.Mock(), mock.Mock()]
+        mock_conn.shards = [(mock.Mock(), c) for c in mock_consumers]
+        connection.Connection.drop_session(mock_conn, FAKE_CLIENT_SESSION, FAKE_BACKEND_ID)
+        for c in mock_consumers:
+            self.assertEquals(c.drop_session.call_count, 1)
+
+    def test_metrics_shards(self):
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_conn.draining = {}
+        mock_consumers = [mock.Mock(), mock.Mock()]
+        mock_consumers[0].metrics.return_value = { FAKE_BACKEND_ID : [{ "active" : (1, 2) }] }
+        mock_consumers[1].metrics.return_value = { FAKE_BACKEND_ID : [{ "active" : (1, 1) }] }
+        mock_conn.shards = [(mock.Mock(), c) for c in mock_consumers]
+        mock_conn._listener_metrics.return_value = {}
+        mock_conn.standby = {}
+        metrics = connection.Connection.metrics(mock_conn)
+        self.assertEquals(metrics, { FAKE_BACKEND_ID : [{ "active" : (1, 3) }] })
+
+    def test_metrics_standby(self):
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_conn.draining = {}
+        mock_consumers = [mock.Mock(), mock.Mock()]
+        for c in mock_consumers:
+            c.metrics.return_value = { FAKE_BACKEND_ID : [{ "active" : (1, 0), "duration" : (1, 1.0) }] }
+        mock_conn.shards = [(mock.Mock(), c) for c in mock_consumers]
+        mock_conn._listener_metrics.return_value = {}
+        mock_conn.standby = { FAKE_BACKEND : (time.time(), False) }
+        metrics = connection.Connection.metrics(mock_conn)
+        self.assertEquals(metrics, { FAKE_BACKEND_ID : [{ "active" : (1, 1), "duration" : (2, 1.0) }] })
+
+    def test_metrics_listener(self):
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_conn.draining = {}
+        mock_conn.portmap = { FAKE_PORT : (FAKE_URL, True, False, FAKE_RECONNECT, [(FAKE_BACKEND_IP, FAKE_BACKEND_PORT)], [], "socat", balance.Weighted([FAKE_BACKEND])) }
+        mock_conn.shards = []
+        mock_conn.standby = {}
+        mock_conn._listener_metrics.return_value = { FAKE_PORT : (10.0, 2) }
+        metrics = connection.Connection.metrics(mock_conn)
+        backend = "%s:%d" % (FAKE_BACKEND_IP, FAKE_BACKEND_PORT)
+        self.assertEquals(metrics, { backend : [{
+            "active" : (1, 0), "accepts" : (1, 10.0), "overflows" : (1, 2) }] })
+
+    def test_metrics_draining(self):
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_consumer = mock.Mock()
+        mock_consumer.metrics.return_value = { FAKE_BACKEND_ID : [{ "active" : (1, 2) }] }
+        mock_conn.shards = [(mock.Mock(), mock_consumer)]
+        mock_conn._listener_metrics.return_value = {}
+        mock_conn.standby = {}
+        mock_conn.draining = { FAKE_BACKEND : None, ("10.0.0.1", 80) : None }
+        mock_conn._drain.side_effect = lambda *a: connection.Connection._drain(mock_conn, *a)
+        metrics = connection.Connection.metrics(mock_conn)
+        self.assertEquals(metrics, { FAKE_BACKEND_ID : [{ "active" : (1, 2) }] })
+        # The backend without connections is done.
+        self.assertEquals(mock_conn.draining, { FAKE_BACKEND : None })
+        self.assertEquals(mock_consumer.drop_backend.call_count, 0)
+
+        # Once the deadline passes, the connections are dropped.
+        mock_conn.draining = { FAKE_BACKEND : time.time() - 1 }
+        metrics = connection.Connection.metrics(mock_conn)
+        mock_consumer.drop_backend.assert_called_once_with(FAKE_BACKEND_IP, FAKE_BACKEND_PORT)
+        self.assertIn(FAKE_BACKEND, mock_conn.draining)
+
+        mock_consumer.metrics.return_value = {}
+        metrics = connection.Connection.metrics(mock_conn)
+        self.assertEquals(metrics, {})
+        self.assertEquals(mock_conn.draining, {})
+
+    def test_listener_metrics(self):
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_producers = [mock.Mock(), mock.Mock()]
+        mock_producers[0].stats.return_value = { FAKE_PORT : (10, 1) }
+        mock_producers[1].stats.return_value = { FAKE_PORT : (5, 0) }
+        mock_conn.shards = [(p, mock.Mock()) for p in mock_producers]
+        mock_conn._last_stats = { FAKE_PORT : (5, 0) }
+        mock_conn._last_time = time.time() - 10.0
+        result = connection.Connection._listener_metrics(mock_conn)
+        (rate, overflows) = result[FAKE_PORT]
+        self.assertTrue(0.9 < rate <= 1.0)
+        self.assertEquals(overflows, 1)
+        self.assertEquals(mock_conn._last_stats, { FAKE_PORT : (15, 1) })
+
+    def test_pending_shards(self):
+        mock_conn = mock.Mock(spec=connection.Connection)
+        mock_consumers = [mock.Mock(), mock.Mock()]
+        mock_consumers[0].pending.return_value = { FAKE_URL : 2 }
+        mock_consumers[1].pending.return_value = { FAKE_URL : 1 }
+        mock_conn.shards = [(mock.Mock(), c) for c in mock_consumers]
+        pending = connection.Connection.pending(mock_conn)
+        self.assertEquals(pending, { FAKE_URL : 3 })
@@ -0,0 +1,179 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import os
+import time
+import socket
+import select
+import threading
+import unittest
+
+import reactor.loadbalancer.tcp.proxy as proxy
+
+def _listener():
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(10)
+    return sock
+
+def _echo(sock):
+    # Echo everything back on a single connection.
+    def fn():
+        (conn, _) = sock.accept()
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                break
+            conn.sendall(data)
+        conn.close()
+    t = threading.Thread(target=fn)
+    t.daemon = True
+    t.start()
+    return t
+
+def _pair():
+    # Returns (client end, accepted end) of a local connection.
+    front = _listener()
+    client = socket.create_connection(front.getsockname())
+    (accepted, _) = front.accept()
+    front.close()
+    return (client, accepted)
+
+class ProxyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = proxy.Proxy(loops=2)
+        self.closed = threading.Event()
+        self.errors = []
+
+    def tearDown(self):
+        self.proxy.stop()
+
+    def _closed(self, relay, error):
+        self.errors.append(error)
+        self.closed.set()
+
+    def test_relay_echo(self):
+        backend = _listener()
+        _echo(backend)
+        (client, accepted) = _pair()
+        (host, port) = backend.getsockname()
+        relay = self.proxy.relay(
+            accepted.fileno(), host, port, closed=self._closed)
+        accepted.close()
+
+        # Push more than a single buffer through.
+        data = os.urandom(proxy.BUFFER_SIZE * 4)
+        sender = threading.Thread(target=client.sendall, args=(data,))
+        sender.start()
+        received = []
+        total = 0
+        while total < len(data):
+            chunk = client.recv(65536)
+            self.assertTrue(chunk)
+            received.append(chunk)
+            total += len(chunk)
+        sender.join()
+        self.assertEquals("".join(received), data)
+        self.assertTrue(relay.alive())
+
+        # Closing our end tears down the relay.
+        client.shutdown(socket.SHUT_WR)
+        self.assertEquals(client.recv(1), "")
+        client.close()
+        self.closed.wait(5.0)
+        self.assertTrue(self.closed.is_set())
+        self.assertEquals(self.errors, [False])
+        self.assertFalse(relay.alive())
+        self.assertEquals(self.proxy.count(), 0)
+        backend.close()
+
+    def test_relay_accounting(self):
+        backend = _listener()
+        _echo(backend)
+        (client, accepted) = _pair()
+        (host, port) = backend.getsockname()
+        relay = self.proxy.relay(
+            accepted.fileno(), host, port, closed=self._closed,
+            accepted=time.time() - 1.0)
+        accepted.close()
+        client.sendall("ping")
+        self.assertEquals(client.recv(4), "ping")
+        client.close()
+        self.closed.wait(5.0)
+        self.assertEquals(relay.transferred(), (4, 4))
+        self.assertTrue(relay.latency() >= 1.0)
+        backend.close()
+
+    def test_relay_connect_failed(self):
+        # Grab a port with nothing listening on it.
+        backend = _listener()
+        (host, port) = backend.getsockname()
+        backend.close()
+        (client, accepted) = _pair()
+        relay = self.proxy.relay(
+            accepted.fileno(), host, port, closed=self._closed)
+        accepted.close()
+        self.closed.wait(5.0)
+        self.assertEquals(self.errors, [True])
+        self.assertFalse(relay.alive())
+        self.assertEquals(client.recv(1), "")
+        client.close()
+
+    def test_relay_close(self):
+        backend = _listener()
+        _echo(backend)
+        (client, accepted) = _pair()
+        (host, port) = backend.getsockname()
+        relay = self.proxy.relay(
+            accepted.fileno(), host, port, closed=self._closed)
+        accepted.close()
+        client.sendall("ping")
+        self.assertEquals(client.recv(4), "ping")
+        relay.close()
+        self.closed.wait(5.0)
+        self.assertEquals(self.errors, [False])
+        self.assertEquals(client.recv(1), "")
+        client.close()
+        backend.close()
+
+class RelayTests(unittest.TestCase):
+
+    def setUp(self):
+        (self.client, self.client_peer) = socket.socketpair()
+        (self.backend, self.backend_peer) = socket.socketpair()
+        self.relay = proxy.Relay(None, self.client, self.backend)
+        self.buf = bytearray(proxy.BUFFER_SIZE)
+
+    def tearDown(self):
+        for sock in (self.client, self.client_peer,
+                     self.backend, self.backend_peer):
+            sock.close()
+
+    def test_client_hangup_connecting(self):
+        # The client going away is not a connection.
+        self.assertTrue(self.relay.handle(
+            self.client.fileno(), select.EPOLLHUP, self.buf))
+        self.assertTrue(self.relay.connecting)
+        self.assertFalse(self.relay.error)
+        self.assertEquals(self.relay.latency(), None)
+
+    def test_backend_connected(self):
+        self.assertFalse(self.relay.handle(
+            self.backend.fileno(), select.EPOLLOUT, self.buf))
+        self.assertFalse(self.relay.connecting)
+        self.assertTrue(self.relay.latency() >= 0.0)
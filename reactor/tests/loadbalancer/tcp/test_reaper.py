@@ -0,0 +1,66 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import os
+import threading
+import unittest
+
+import reactor.loadbalancer.tcp.reaper as reaper
+import reactor.loadbalancer.tcp.connection as connection
+
+class ReaperTests(unittest.TestCase):
+
+    def setUp(self):
+        self.reaper = reaper.Reaper()
+
+    def tearDown(self):
+        self.reaper.stop()
+        self.reaper.join(5.0)
+
+    def _spawn(self, cmd):
+        done = threading.Event()
+        result = []
+        def exited(pid, status):
+            result.append((pid, status))
+            done.set()
+        (rfd, wfd) = self.reaper.pipe()
+        pid = connection.fork_and_exec(cmd, child_fds=[wfd])
+        os.close(wfd)
+        self.reaper.watch(pid, rfd, exited=exited)
+        return (pid, done, result)
+
+    def test_exit_status(self):
+        (pid, done, result) = self._spawn(["sh", "-c", "exit 3"])
+        done.wait(5.0)
+        self.assertEquals(len(result), 1)
+        self.assertEquals(result[0][0], pid)
+        self.assertEquals(os.WEXITSTATUS(result[0][1]), 3)
+        self.assertEquals(self.reaper.count(), 0)
+
+    def test_many(self):
+        children = [self._spawn(["true"]) for _ in range(10)]
+        for (pid, done, result) in children:
+            done.wait(5.0)
+            self.assertEquals(result, [(pid, 0)])
+        self.assertEquals(self.reaper.count(), 0)
+
+    def test_stop_waits(self):
+        (_, done, result) = self._spawn(["sleep", "0.2"])
+        self.reaper.stop()
+        self.assertTrue(self.reaper.is_alive())
+        self.reaper.join(5.0)
+        self.assertFalse(self.reaper.is_alive())
+        self.assertTrue(done.is_set())
@@ -0,0 +1,96 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import unittest
+
+import reactor.loadbalancer.tcp.stats as stats
+from reactor.metrics import histogram
+from reactor.metrics.calculator import calculate_weighted_sums
+
+class BackendStatsTests(unittest.TestCase):
+
+    def test_snapshot(self):
+        backend = stats.BackendStats()
+        backend.open()
+        backend.open()
+        backend.transfer(100, 300)
+        backend.close(2.0, latency=0.5)
+        metrics = backend.snapshot(2.0)
+        self.assertEquals(metrics["active"], (1, 1))
+        self.assertEquals(metrics["rate"], (1, 1.0))
+        self.assertEquals(metrics["bytes"], (1, 200.0))
+        self.assertEquals(metrics["bytes_in"], (1, 50.0))
+        self.assertEquals(metrics["bytes_out"], (1, 150.0))
+        self.assertEquals(metrics["duration"], (1, 2.0))
+        self.assertEquals(metrics["connect"], (1, 0.5))
+
+        # Everything but the active count is reset.
+        metrics = backend.snapshot(1.0)
+        self.assertEquals(metrics["active"], (1, 1))
+        self.assertEquals(metrics["rate"], (1, 0.0))
+        self.assertNotIn("duration", metrics)
+        self.assertNotIn("connect", metrics)
+        self.assertFalse(backend.idle())
+        backend.close(1.0)
+        backend.snapshot(1.0)
+        self.assertTrue(backend.idle())
+
+    def test_wait(self):
+        backend = stats.BackendStats()
+        backend.open()
+        metrics = backend.snapshot(1.0)
+        self.assertNotIn("wait", metrics)
+        for _ in range(99):
+            backend.open(wait=0.01)
+        backend.open(wait=30.0)
+        metrics = backend.snapshot(1.0)
+        self.assertEquals(metrics["wait"][0], 100)
+        self.assertAlmostEquals(metrics["wait"][1], 0.3099)
+        # Only the buckets are published (percentiles come later).
+        self.assertNotIn("wait_p95", metrics)
+        sums = histogram.summarize(calculate_weighted_sums([metrics]))
+        for key in ("wait_p50", "wait_p95", "wait_p99"):
+            (weight, total) = sums[key]
+            self.assertEquals(weight, 100)
+            self.assertAlmostEquals(total / weight, 0.011)
+        self.assertNotIn("wait", backend.snapshot(1.0))
+
+class MergeTests(unittest.TestCase):
+
+    def test_merge(self):
+        merged = stats.merge([
+            { "active" : (1, 2), "duration" : (1, 1.0) },
+            { "active" : (1, 3), "duration" : (3, 3.0) },
+        ])
+        self.assertEquals(merged["active"], (1, 5))
+        self.assertEquals(merged["duration"], (4, 2.5))
+
+    def test_merge_histograms(self):
+        # One shard is fast, the other is slow. The percentiles of the
+        # merged buckets are exact, where averaging them would not be.
+        fast = stats.BackendStats()
+        slow = stats.BackendStats()
+        for _ in range(90):
+            fast.close(0.01)
+        for _ in range(10):
+            slow.close(10.0)
+        merged = stats.merge([fast.snapshot(1.0), slow.snapshot(1.0)])
+        sums = histogram.summarize(calculate_weighted_sums([merged]))
+        (weight, total) = sums["duration_p50"]
+        self.assertEquals(weight, 100)
+        self.assertTrue(total / weight < 0.02)
+        (weight, total) = sums["duration_p95"]
+        self.assertTrue(10.0 <= total / weight < 11.0)
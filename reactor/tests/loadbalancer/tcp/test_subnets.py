@@ -0,0 +1,66 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import unittest
+
+import reactor.loadbalancer.tcp.subnets as subnets
+
+class SubnetMatcherTests(unittest.TestCase):
+
+    def test_ipv4(self):
+        matcher = subnets.SubnetMatcher(["10.0.0.0/8", "192.168.1.0/24"])
+        self.assertIn("10.1.2.3", matcher)
+        self.assertIn("192.168.1.255", matcher)
+        self.assertNotIn("192.168.2.1", matcher)
+        self.assertNotIn("11.0.0.0", matcher)
+        self.assertNotIn("9.255.255.255", matcher)
+
+    def test_host(self):
+        matcher = subnets.SubnetMatcher(["1.2.3.4"])
+        self.assertIn("1.2.3.4", matcher)
+        self.assertNotIn("1.2.3.5", matcher)
+
+    def test_ipv6(self):
+        matcher = subnets.SubnetMatcher(["2001:db8::/32", "::1/128"])
+        self.assertIn("2001:db8::1", matcher)
+        self.assertIn("::1", matcher)
+        self.assertNotIn("2001:db9::1", matcher)
+        self.assertNotIn("10.0.0.1", matcher)
+
+    def test_mapped(self):
+        matcher = subnets.SubnetMatcher(["10.0.0.0/8"])
+        self.assertIn("::ffff:10.1.2.3", matcher)
+        self.assertNotIn("::ffff:11.1.2.3", matcher)
+
+    def test_overlapping(self):
+        matcher = subnets.SubnetMatcher(
+            ["10.0.0.0/16", "10.0.1.0/24", "10.1.0.0/16", "10.3.0.0/16"])
+        self.assertEquals(len(matcher), 2)
+        self.assertIn("10.1.255.255", matcher)
+        self.assertNotIn("10.2.0.0", matcher)
+        self.assertIn("10.3.0.0", matcher)
+
+    def test_empty(self):
+        matcher = subnets.SubnetMatcher([])
+        self.assertFalse(matcher)
+        self.assertNotIn("10.0.0.1", matcher)
+
+    def test_invalid(self):
+        matcher = subnets.SubnetMatcher(["bogus"])
+        # Configured, so we still filter (everything).
+        self.assertTrue(matcher)
+        self.assertNotIn("10.0.0.1", matcher)
+        self.assertNotIn("bogus", subnets.SubnetMatcher(["10.0.0.0/8"]))
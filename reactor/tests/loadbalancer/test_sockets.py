@@ -0,0 +1,105 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import os
+import sys
+import socket
+import tempfile
+import unittest
+import mock
+
+import reactor.loadbalancer.sockets as sockets
+
+# Some lines from /proc/net/tcp{,6} (on a little-endian machine).
+# There are two connections to 10.0.0.10:80, one of which is mapped,
+# and a listener on that port that should not be counted.
+FAKE_TCP = """\
+  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 0A00000A:0050 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 662 1
+   1: 0100007F:BC8F 0A00000A:0050 01 00000000:00000000 00:00000000 00000000     0        0 860 1
+   2: 0100007F:BC90 0B00000A:0050 01 00000000:00000000 00:00000000 00000000     0        0 861 1
+"""
+FAKE_TCP6 = """\
+  sl  local_address                         remote_address                        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 0000000000000000FFFF00000100007F:BC91 0000000000000000FFFF00000A00000A:0050 06 00000000:00000000 00:00000000 00000000     0        0 0 0
+"""
+FAKE_BACKEND = ("10.0.0.10", 80)
+
+class SocketsTests(unittest.TestCase):
+
+    def _write(self, data):
+        (fd, path) = tempfile.mkstemp()
+        os.write(fd, data)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
+    @unittest.skipUnless(sys.byteorder == "little", "little-endian only")
+    def test_proc_count(self):
+        paths = [self._write(FAKE_TCP), self._write(FAKE_TCP6), "/nonexistent"]
+        counts = sockets.proc_count([FAKE_BACKEND, ("10.0.0.12", 80)], paths=paths)
+        self.assertEquals(counts, { FAKE_BACKEND : 2 })
+
+    def test_proc_missing(self):
+        self.assertEquals(sockets.proc_count([FAKE_BACKEND], paths=["/nonexistent"]), None)
+
+    def test_bytecode_limit(self):
+        backends = [("10.0.%d.%d" % (i / 256, i % 256), 80) for i in range(5000)]
+        self.assertEquals(sockets._bytecode(sockets._parse(backends)), None)
+        self.assertEquals(len(sockets._bytecode(sockets._parse(backends[:2]))), 36)
+
+    def test_live(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(8)
+        self.addCleanup(listener.close)
+        backend = listener.getsockname()
+        clients = [socket.create_connection(backend) for _ in range(3)]
+        for client in clients:
+            self.addCleanup(client.close)
+
+        backends = [backend, ("127.0.0.1", 1), ("not-an-ip", 80)]
+        expected = { backend : 3 }
+        self.assertEquals(sockets.proc_count(backends), expected)
+        try:
+            counts = sockets.sock_diag_count(backends)
+        except socket.error:
+            # Not available here (e.g. no netlink).
+            pass
+        else:
+            self.assertEquals(counts, expected)
+        self.assertEquals(sockets.connection_count(backends), expected)
+
+    def test_fallback(self):
+        with mock.patch.object(sockets, "sock_diag_count") as mock_diag, \
+             mock.patch.object(sockets, "proc_count") as mock_proc, \
+             mock.patch.object(sockets, "netstat_count") as mock_netstat, \
+             mock.patch.object(sockets, "_sock_diag", True), \
+             mock.patch.object(sockets, "_proc", True):
+            mock_diag.side_effect = socket.error(93, "Protocol not supported")
+            mock_proc.return_value = None
+            mock_netstat.return_value = { FAKE_BACKEND : 1 }
+            self.assertEquals(sockets.connection_count([FAKE_BACKEND]), { FAKE_BACKEND : 1 })
+            self.assertEquals(sockets.connection_count([FAKE_BACKEND]), { FAKE_BACKEND : 1 })
+            # The unavailable methods are only tried once.
+            self.assertEquals(mock_diag.call_count, 1)
+            self.assertEquals(mock_proc.call_count, 1)
+            self.assertEquals(mock_netstat.call_count, 2)
+
+    def test_netstat_count(self):
+        with mock.patch.object(sockets.netstat, "connection_count") as mock_count:
+            mock_count.return_value = { FAKE_BACKEND : 2, ("10.0.0.12", 80) : 1 }
+            self.assertEquals(sockets.netstat_count([FAKE_BACKEND]), { FAKE_BACKEND : 2 })
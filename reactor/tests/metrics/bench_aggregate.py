@@ -0,0 +1,120 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmark for metric aggregation.
+
+This compares the original path (lists of metrics per port, scanned once per
+endpoint) with the MetricsIndex. It is not run as part of the test suite, run
+it directly with:
+
+    PYTHONPATH=. python reactor/tests/metrics/bench_aggregate.py [ports] [endpoints] [managers]
+"""
+
+import sys
+import time
+import random
+
+from reactor.metrics import aggregate
+from reactor.metrics.aggregate import MetricsIndex
+from reactor.metrics.calculator import calculate_weighted_averages
+from reactor.metrics.calculator import calculate_weighted_sums
+
+KEYS = ["rate", "response", "bytes", "active"]
+
+def generate(ports, endpoints, managers):
+    port_names = ["10.%d.%d.%d:80" % (i >> 16, (i >> 8) & 0xff, i & 0xff)
+                  for i in xrange(ports)]
+    tables = []
+    for _ in xrange(managers):
+        table = {}
+        for port in port_names:
+            table[port] = [dict([
+                (key, (random.randint(1, 10), random.random() * 100))
+                for key in KEYS])]
+        tables.append(table)
+    per_endpoint = max(ports / endpoints, 1)
+    assignment = [port_names[i * per_endpoint:(i + 1) * per_endpoint]
+                  for i in xrange(endpoints)]
+    return (tables, assignment)
+
+def original(tables, assignment):
+    all_metrics = {}
+    for table in tables:
+        for (port, port_metrics) in table.items():
+            if not port in all_metrics:
+                all_metrics[port] = port_metrics[:]
+            else:
+                all_metrics[port].extend(port_metrics)
+
+    results = []
+    for endpoint_ports in assignment:
+        metrics = []
+        for (port, port_metrics) in all_metrics.items():
+            if port in endpoint_ports:
+                metrics.extend(port_metrics)
+        results.append(calculate_weighted_averages(metrics))
+    return results
+
+def indexed(tables, assignment, use_numpy=None):
+    all_metrics = MetricsIndex(use_numpy=use_numpy)
+    for table in tables:
+        for (port, port_sums) in table.iteritems():
+            all_metrics.add(port, port_sums)
+    all_metrics.freeze()
+
+    results = []
+    for endpoint_ports in assignment:
+        indices = [all_metrics.index(port) for port in endpoint_ports]
+        sums = all_metrics.sums(indices)
+        results.append(calculate_weighted_averages([dict([
+            (key, (weight, weight and total / weight))
+            for (key, (weight, total)) in sums.items()
+        ])]))
+    return results
+
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return (time.time() - start, result)
+
+def main(ports=10000, endpoints=1000, managers=5):
+    (tables, assignment) = generate(ports, endpoints, managers)
+
+    # Sums are computed as metrics are published (see wire.py),
+    # so this is not part of the aggregation time for the index.
+    sum_tables = [
+        dict([(port, calculate_weighted_sums(port_metrics))
+              for (port, port_metrics) in table.items()])
+        for table in tables
+    ]
+
+    print "ports=%d endpoints=%d managers=%d" % (ports, endpoints, managers)
+    (base_time, expected) = timed(original, tables, assignment)
+    print "original:      %8.3fs" % base_time
+
+    variants = [("array", False)]
+    if aggregate.numpy is not None:
+        variants.append(("numpy", True))
+    for (name, use_numpy) in variants:
+        (index_time, result) = timed(indexed, sum_tables, assignment, use_numpy=use_numpy)
+        for (a, b) in zip(expected, result):
+            for key in a:
+                assert abs(a[key] - b[key]) < 1e-6 * max(1.0, abs(a[key]))
+        print "index (%s): %8.3fs (%.1fx)" % (
+            name, index_time, base_time / max(index_time, 1e-9))
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,55 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import pytest
+
+from reactor.metrics import aggregate
+from reactor.metrics.aggregate import MetricsIndex
+
+USE_NUMPY = [False]
+if aggregate.numpy is not None:
+    USE_NUMPY.append(True)
+
+def _index(use_numpy):
+    index = MetricsIndex(use_numpy=use_numpy)
+    index.add("10.0.0.1:80", {"rate": (2.0, 10.0), "active": (1.0, 2.0)})
+    index.add("10.0.0.2:80", {"rate": (1.0, 4.0)})
+    index.add("10.0.0.1:80", {"rate": (1.0, 1.0), "active": (1.0, 0.0)})
+    index.add("10.0.0.3:80", {"active": (1.0, 0.0)})
+    return index.freeze()
+
+@pytest.mark.parametrize("use_numpy", USE_NUMPY)
+def test_sums(use_numpy):
+    index = _index(use_numpy)
+    assert len(index) == 3
+    assert index.index("10.0.0.4:80") is None
+    assert index.get("10.0.0.1:80") == {"rate": (3.0, 11.0), "active": (2.0, 2.0)}
+    assert index.get("10.0.0.2:80") == {"rate": (1.0, 4.0)}
+    rows = [index.index("10.0.0.2:80"), index.index("10.0.0.3:80")]
+    assert index.sums(rows) == {"rate": (1.0, 4.0), "active": (1.0, 0.0)}
+    assert index.sums([]) == {}
+
+@pytest.mark.parametrize("use_numpy", USE_NUMPY)
+def test_active(use_numpy):
+    index = _index(use_numpy)
+    assert index.is_active(index.index("10.0.0.1:80"))
+    assert not index.is_active(index.index("10.0.0.2:80"))
+    assert not index.is_active(index.index("10.0.0.3:80"))
+
+@pytest.mark.parametrize("use_numpy", USE_NUMPY)
+def test_as_map(use_numpy):
+    index = _index(use_numpy)
+    assert index.as_map()["10.0.0.1:80"] == {"rate": (3.0, 11.0 / 3.0), "active": (2.0, 1.0)}
+    assert index.as_map()["10.0.0.2:80"] == {"rate": (1.0, 4.0)}
@@ -1,6 +1,11 @@
 import pytest
 
 from reactor.metrics.calculator import EndpointCriteria
+from reactor.metrics.calculator import calculate_weighted_sums
+from reactor.metrics.calculator import calculate_ideal_uniform
+from reactor.metrics.calculator import calculate_ideal_batch
+from reactor.metrics.calculator import RuleProgram
+from reactor.metrics.calculator import metrics_changed
 
 def test_empty():
     x = EndpointCriteria("")
@@ -45,3 +50,59 @@ def test_both_equals():
 def test_both_less():
     x = EndpointCriteria("1.0 < foo < 2.0")
     assert str(x) == "foo => (1.0,2.0)"
+
+def test_weighted_sums():
+    sums = calculate_weighted_sums([
+        {"foo": (2, 3.0), "bar": 1},
+        {"foo": (1, "bad"), "bar": "4"},
+        {"foo": 1.0},
+    ])
+    assert sums == {"foo": (3.0, 7.0), "bar": (1.0, 1.0)}
+
+def test_metrics_changed():
+    old = {"rate": 10.0, "pending": 0.0}
+    assert metrics_changed(None, old, 0.1)
+    assert not metrics_changed(old, old, 0.0)
+    assert not metrics_changed(old, {"rate": 10.5, "pending": 0.0}, 0.1)
+    assert metrics_changed(old, {"rate": 12.0, "pending": 0.0}, 0.1)
+    assert metrics_changed(old, {"rate": 10.0, "pending": 1.0}, 0.1)
+    assert metrics_changed(old, {"rate": 10.0}, 0.1)
+
+def test_program_matches_uniform():
+    rules = ["20<=rate<=50", "100<=response<800", "2<instances"]
+    program = RuleProgram(rules)
+    assert len(program) == 3
+    assert program.errors() == []
+    for metrics in [{}, {"rate": 10.0}, {"rate": 100.0, "response": 50.0}]:
+        for num_instances in [0, 1, 5]:
+            assert program.evaluate(metrics, num_instances) == \
+                calculate_ideal_uniform(rules, metrics, num_instances)
+
+def test_program_errors():
+    program = RuleProgram(["foo == 4", "", "1 < active"])
+    assert program.errors() == ["foo == 4"]
+    assert len(program) == 2
+
+def test_program_invalid_unconstrained():
+    rules = ["foo == 4", "1 < active"]
+    assert calculate_ideal_uniform(rules, {"active": 3.0}, 2) == (0, 5)
+    assert RuleProgram(["1 < active", "foo == 4"]).evaluate(
+        {"active": 3.0}, 2) == (0, 5)
+
+def test_program_immutable():
+    program = RuleProgram(["1 < active"])
+    with pytest.raises(AttributeError):
+        program.foo = 1
+
+def test_program_batch():
+    a = RuleProgram(["rate <= 10"])
+    b = RuleProgram(["2 <= instances <= 4"])
+    results = calculate_ideal_batch([
+        (a, {"rate": 20.0}, 1),
+        (b, {}, 1),
+        (a, {"rate": 5.0}, 1),
+    ])
+    assert results[0] == a.evaluate({"rate": 20.0}, 1)
+    assert results[1] == (2.0, 4.0)
+    assert results[2] == a.evaluate({"rate": 5.0}, 1)
+    assert a.evaluate_batch([({"rate": 20.0}, 1)]) == [results[0]]
@@ -0,0 +1,91 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+from reactor.metrics import histogram
+from reactor.metrics.histogram import Histogram
+from reactor.metrics.calculator import calculate_weighted_sums
+from reactor.metrics.aggregate import MetricsIndex
+
+def test_error_bound():
+    h = Histogram()
+    value = 0.0013
+    while value < 1000.0:
+        upper = h.upper(h.index(value))
+        assert value < upper <= value * (1 + 1.0 / h.sub_buckets)
+        value *= 1.37
+
+def test_percentile():
+    h = Histogram()
+    for _ in range(95):
+        h.add(0.01)
+    h.add(10.0, count=5)
+    assert h.count == 100
+    assert abs(h.mean() - 0.5095) < 1e-9
+    assert 0.01 <= h.percentile(0.5) < 0.0125
+    assert 0.01 <= h.percentile(0.95) < 0.0125
+    assert 10.0 <= h.percentile(0.99) < 12.5
+
+def test_empty():
+    h = Histogram()
+    assert h.mean() == 0.0
+    assert h.percentile(0.5) == 0.0
+
+def test_range():
+    h = Histogram()
+    h.add(0.0)
+    h.add(1e12)
+    assert h.counts[0] == 1
+    assert h.counts[-1] == 1
+
+def test_merge():
+    a = Histogram()
+    b = Histogram()
+    a.add(0.01, count=10)
+    b.add(1.0, count=10)
+    a.merge(b)
+    assert a.count == 20
+    assert a.percentile(0.5) < 0.0125
+    assert a.percentile(0.95) >= 1.0
+
+def test_summarize():
+    # Two managers see the same backend, with different latencies.
+    # Their histograms merge exactly (where averages of percentiles
+    # would put the p99 somewhere in the middle).
+    fast = Histogram()
+    fast.add(0.01, count=90)
+    slow = Histogram()
+    slow.add(2.0, count=10)
+    index = MetricsIndex(use_numpy=False)
+    for h in (fast, slow):
+        metrics = h.as_metrics("response")
+        metrics["rate"] = (1, 5.0)
+        index.add("10.0.0.1:80", calculate_weighted_sums([metrics]))
+    index.freeze()
+
+    sums = histogram.summarize(index.get("10.0.0.1:80"))
+    assert sums["rate"] == (2.0, 10.0)
+    assert not [key for key in sums if histogram.HIST in key]
+    (weight, total) = sums["response_p50"]
+    assert weight == 100
+    assert 0.01 <= total / weight < 0.0125
+    (weight, total) = sums["response_p95"]
+    assert 2.0 <= total / weight < 2.5
+    (weight, total) = sums["response_p99"]
+    assert 2.0 <= total / weight < 2.5
+
+def test_summarize_bad_keys():
+    sums = histogram.summarize({"x_hist_y": (1, 1), "x_hist_99999": (1, 1)})
+    assert sums == {}
@@ -0,0 +1,113 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+
+from reactor.metrics import wire
+
+TABLE = {
+    "10.0.0.1:80": {"rate": (2.0, 10.0), "active": (1.0, 3.0)},
+    "10.0.0.2:80": {"rate": (1.0, 4.0)},
+}
+
+def test_roundtrip():
+    (header, table) = wire.decode(wire.encode(TABLE, epoch="e", seq=3))
+    assert header["epoch"] == "e"
+    assert header["seq"] == 3
+    assert header["base"] is None
+    assert table == TABLE
+
+def test_empty():
+    assert wire.decode(wire.encode({}))[1] == {}
+    assert wire.decode("") == ({}, {})
+
+def test_json_fallback():
+    data = json.dumps({"10.0.0.1:80": [{"rate": [2, 5]}, {"rate": 1}]})
+    (header, table) = wire.decode(data)
+    assert header == {}
+    assert table == {"10.0.0.1:80": {"rate": (3.0, 11.0)}}
+
+def test_delta():
+    publisher = wire.Publisher(keyframe_interval=100)
+    state = wire.merge("m", None, publisher.encode(TABLE))
+    assert state[2] == TABLE
+
+    # Only the changed port is sent.
+    changed = dict(TABLE)
+    changed["10.0.0.2:80"] = {"rate": (1.0, 8.0)}
+    data = publisher.encode(changed)
+    (header, table) = wire.decode(data)
+    assert table.keys() == ["10.0.0.2:80"]
+    state = wire.merge("m", state, data)
+    assert state[2] == changed
+
+    # Removed ports are dropped.
+    removed = {"10.0.0.2:80": changed["10.0.0.2:80"]}
+    state = wire.merge("m", state, publisher.encode(removed))
+    assert state[2] == removed
+
+def test_unchanged():
+    publisher = wire.Publisher(keyframe_interval=3)
+    assert publisher.encode(TABLE) is not None
+    assert publisher.encode(TABLE) is None
+    assert publisher.encode(dict(TABLE)) is None
+    # Keyframes are written out regardless.
+    (header, table) = wire.decode(publisher.encode(TABLE))
+    assert header["base"] is None
+    assert header["seq"] == 1
+
+def test_dropped_delta():
+    publisher = wire.Publisher(keyframe_interval=4)
+    state = wire.merge("m", None, publisher.encode(TABLE))
+
+    # This delta never makes it to us.
+    first = dict(TABLE)
+    first["10.0.0.1:80"] = {"rate": (2.0, 20.0)}
+    publisher.encode(first)
+
+    # The next is not applied on top of the stale table.
+    second = dict(first)
+    second["10.0.0.2:80"] = {"rate": (1.0, 8.0)}
+    state = wire.merge("m", state, publisher.encode(second))
+    assert state[1] is None
+    assert state[2] == TABLE
+
+    # Nor is anything else until the keyframe.
+    third = {"10.0.0.2:80": {"rate": (1.0, 9.0)}}
+    state = wire.merge("m", state, publisher.encode(third))
+    assert state[2] == TABLE
+    state = wire.merge("m", state, publisher.encode(third))
+    assert state[1] is not None
+    assert state[2] == third
+
+def test_delta_without_base():
+    publisher = wire.Publisher(keyframe_interval=100)
+    publisher.encode(TABLE)
+    changed = {"10.0.0.2:80": {"rate": (1.0, 8.0)}}
+    state = wire.merge("m", None, publisher.encode(changed))
+    assert state[1] is None
+    assert state[2] == {}
+
+def test_keyframe():
+    publisher = wire.Publisher(keyframe_interval=2)
+    publisher.encode(TABLE)
+    publisher.encode(TABLE)
+    (header, table) = wire.decode(publisher.encode(TABLE))
+    assert header["base"] is None
+    assert table == TABLE
+
+def test_malformed():
+    state = ("e", TABLE)
+    assert wire.merge("m", state, wire.MAGIC + chr(wire.VERSION) + "junk") == state
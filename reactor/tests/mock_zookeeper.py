@@ -42,6 +42,7 @@ SEQUENCE = 2
 
 # Events.
 OK = 0
+NONODE = -101
 CHANGED_EVENT = 3
 CHILD_EVENT = 4
 
@@ -60,6 +61,9 @@ class NodeExistsException(Exception):
 class BadArgumentsException(Exception):
     pass
 
+class BadVersionException(Exception):
+    pass
+
 # Our pending list of tasks.
 TASKS = Queue.Queue()
 
@@ -184,9 +188,15 @@ class ZkNode(object):
             # Handle the case for standard nodes.
             return self._parent._abspath() + "/" + self._name
 
+    def stat(self):
+        # NOTE: We only support the ephemeralOwner and version.
+        with self._lock:
+            return {"ephemeralOwner": self._handle or 0, "version": self._version}
+
     def set(self, data):
         with self._lock:
             self._data = data
+            self._version += 1
             self._fire_data_callbacks()
         return self._abspath()
 
@@ -196,13 +206,15 @@ class ZkNode(object):
                 self._data_callbacks.append((handle, callback))
             return self._data
 
-    def delete(self, child):
+    def delete(self, child, version=-1):
         with self._lock:
             if not child in self._children:
                 raise NoNodeException()
             node = self._children[child]
             if len(node._children) != 0:
                 raise BadArgumentsException()
+            if version != -1 and version != node._version:
+                raise BadVersionException()
             del self._children[child]
             self._fire_child_callbacks()
         with node._lock:
@@ -213,6 +225,7 @@ class ZkNode(object):
         with self._lock:
             self._children = collections.OrderedDict()
             self._data = data
+            self._version = 0
             self._data_callbacks = []
             self._child_callbacks = []
 
@@ -258,18 +271,22 @@ def set_debug_level(level):
 def close(handle):
     ROOT.close(handle)
 
+@log
+def client_id(handle):
+    # The handle doubles as our session id.
+    return (handle, "")
+
 @log
 def exists(handle, path):
     try:
-        _find(path)
-        return True
+        return _find(path).stat()
     except NoNodeException:
-        return False
+        return None
 
 @log
-def delete(handle, path):
+def delete(handle, path, version=-1):
     (parent, child) = _find(path, parent=True)
-    return parent.delete(child)
+    return parent.delete(child, version=version)
 
 @log
 def create(handle, path, data, acl, flags):
@@ -284,15 +301,26 @@ def set(handle, path, data):
 
 @log
 def get(handle, path, callback=None):
-    # NOTE: We don't support timeinfo.
     node = _find(path)
-    return node.get(handle, callback=callback), None
+    return node.get(handle, callback=callback), node.stat()
 
 @log
 def get_children(handle, path, callback=None):
     node = _find(path)
     return node.get_children(handle, callback=callback)
 
+@log
+def aget(handle, path, callback=None, completion=None):
+    # The completion is always fired asynchronously,
+    # exactly as it would be for the real zookeeper.
+    try:
+        node = _find(path)
+        data = node.get(handle, callback=callback)
+        _task_run(completion, handle, OK, data, None)
+    except NoNodeException:
+        _task_run(completion, handle, NONODE, None, None)
+    return OK
+
 @log
 def dump():
     ROOT.dump()
@@ -51,3 +51,75 @@ def test_find(ips):
     ips.add("ip1", value="foo")
     ips.add("ip2", value="bar")
     assert ips.find("bar") == ["ip2"]
+
+@fixture()
+def locks(request):
+    from reactor.objects.ip_address import IPLocks
+    return IPLocks(zk_client(request), '/locks')
+
+def test_locks_mirror(zk_conn, locks):
+    from reactor.objects.ip_address import IPAddresses
+    other = IPAddresses(locks._zk_client, locks._path)
+    other.add("ip1", value="foo")
+    locks.watch()
+    assert locks.find("foo") == ["ip1"]
+    other.add("ip2", value="bar")
+    zk_conn.sync()
+    assert locks.find("bar") == ["ip2"]
+
+def test_locks_lock(zk_conn, locks):
+    locks.watch()
+    assert locks.lock(["ip1"], value="foo") == "ip1"
+    assert locks.get("ip1") == "foo"
+    assert locks.find("foo") == ["ip1"]
+    # Already held locally, so no candidates.
+    assert locks.lock(["ip1"], value="bar") is None
+
+def test_locks_conflict(zk_conn, locks):
+    from reactor.objects.ip_address import IPLocks
+    other = IPLocks(locks._zk_client, locks._path)
+    locks.watch()
+    other.watch()
+    assert other.lock(["ip1"], value="foo") == "ip1"
+    # Before the watch fires, we still think it's free.
+    # The create fails, and we don't try the same item again.
+    with locks._table_lock:
+        locks._unset("ip1")
+    assert locks.lock(["ip1"], value="bar") is None
+    # We know the real owner, whether or not the watch has fired.
+    assert locks.find("foo") == ["ip1"]
+    assert locks.find("bar") == []
+    assert locks.lock(["ip1"], value="bar") is None
+    zk_conn.sync()
+    assert locks.find("foo") == ["ip1"]
+
+def test_locks_conflict_next(zk_conn, locks):
+    from reactor.objects.ip_address import IPLocks
+    other = IPLocks(locks._zk_client, locks._path)
+    locks.watch()
+    other.watch()
+    assert other.lock(["ip1"], value="foo") == "ip1"
+    assert other.lock(["ip2"], value="foo") == "ip2"
+    # However the candidates are ordered, losing the race
+    # for the stale ones doesn't stop us taking a free one.
+    for _ in range(10):
+        with locks._table_lock:
+            locks._unset("ip1")
+            locks._unset("ip2")
+        assert locks.lock(["ip1", "ip2", "ip3"], value="bar") == "ip3"
+        locks.remove("ip3")
+
+def test_locks_released(zk_conn, locks):
+    released = []
+    from reactor.objects.ip_address import IPLocks
+    other = IPLocks(locks._zk_client, locks._path)
+    def released_fn():
+        released.append(True)
+    locks.watch(released=released_fn)
+    other.lock(["ip1"], value="foo")
+    zk_conn.sync()
+    assert locks.find("foo") == ["ip1"]
+    other.remove("ip1")
+    zk_conn.sync()
+    assert locks.find("foo") == []
+    assert released
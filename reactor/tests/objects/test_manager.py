@@ -37,3 +37,22 @@ def test_info(managers):
     assert not "notmyuuid" in managers.info_map()
     assert managers.info_map()["myuuid"] == ["key1", "key2"]
     assert len(managers.list_active()) == 1
+
+def test_published_session(managers):
+    from reactor.objects.manager import Managers
+    from reactor.zookeeper.client import ZookeeperClient
+
+    # A node left behind by our previous session.
+    old_client = ZookeeperClient(zk_servers=["mock"])
+    Managers(old_client).set_pending("myuuid", 1)
+
+    conn = managers._zk_client.connect()
+    path = managers.pending()._path + "/myuuid"
+    managers.set_pending("myuuid", 2)
+    assert conn.exists(path)["ephemeralOwner"] == conn.session_id()
+    managers.set_pending("myuuid", 3)
+    assert conn.exists(path)["ephemeralOwner"] == conn.session_id()
+
+    # The old session expiring doesn't take our node with it.
+    old_client.disconnect()
+    assert managers.pending_map()["myuuid"] == 3
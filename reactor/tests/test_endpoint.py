@@ -14,6 +14,7 @@
 #    under the License.
 
 import uuid
+import mock
 
 from reactor.endpoint import State
 
@@ -47,6 +48,42 @@ def test_managed(reactor, endpoint):
 def test_update(endpoint):
     pass
 
+def _scale(endpoint, instances, active_ids, pending=0):
+    launched = []
+    with mock.patch.object(endpoint, "_filter_instances", return_value=list(instances)), \
+         mock.patch.object(endpoint, "_recommission_instances", return_value=0), \
+         mock.patch.object(endpoint, "_decommission_instances"), \
+         mock.patch.object(endpoint, "_find_cloud_connection", return_value=None), \
+         mock.patch.object(endpoint, "_launch_instance",
+                           side_effect=lambda: launched.append(True)):
+        endpoint.state = State.running
+        endpoint._update(instances,
+                         active_ids=active_ids,
+                         inactive_ids=[x for x in instances if not x in active_ids],
+                         metrics=[],
+                         metric_instances=len(instances),
+                         pending=pending)
+    return len(launched)
+
+def test_update_no_spares(endpoint):
+    endpoint.scaling.max_instances = 10
+    assert _scale(endpoint, ["a", "b"], ["a", "b"], pending=3) == 0
+
+def test_update_spares(endpoint):
+    endpoint.scaling.max_instances = 10
+    endpoint.scaling.spare = 2
+    # Both instances are busy, so we need two more.
+    assert _scale(endpoint, ["a", "b"], ["a", "b"]) == 2
+    # One is idle already.
+    assert _scale(endpoint, ["a", "b"], ["a"]) == 1
+    # Waiting connections need backends on top of the spares.
+    assert _scale(endpoint, ["a", "b"], ["a", "b"], pending=3) == 5
+
+def test_update_spares_limited(endpoint):
+    endpoint.scaling.max_instances = 3
+    endpoint.scaling.spare = 2
+    assert _scale(endpoint, ["a", "b"], ["a", "b"], pending=3) == 1
+
 def test_session_opened(endpoint):
     pass
 
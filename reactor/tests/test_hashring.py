@@ -0,0 +1,82 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import uuid
+import bisect
+
+from reactor import utils
+from reactor.hashring import HashRing
+
+def _managers(count, keys=16, clouds=None, loadbalancers=None):
+    managers = {}
+    for i in range(count):
+        managers[str(uuid.uuid4())] = (
+            [utils.random_key() for _ in range(keys)],
+            clouds and clouds[i % len(clouds)] or ["osapi"],
+            loadbalancers and loadbalancers[i % len(loadbalancers)] or ["nginx"])
+    return managers
+
+def _probe(managers, key, cloud=None, loadbalancer=None):
+    # The original linear probing implementation.
+    key_to_uuid = {}
+    for (manager, (keys, _, _)) in managers.items():
+        for k in keys:
+            key_to_uuid[k] = manager
+    keys = sorted(key_to_uuid.keys())
+    if not keys:
+        return None
+    index = bisect.bisect(keys, key)
+    for i in range(len(keys)):
+        owner = key_to_uuid[keys[(index + i) % len(keys)]]
+        (clouds, loadbalancers) = managers[owner][1:]
+        if (not cloud or cloud in clouds) and \
+           (not loadbalancer or loadbalancer in loadbalancers):
+            return owner
+    return None
+
+def test_empty():
+    ring = HashRing()
+    assert len(ring) == 0
+    assert ring.owner(utils.random_key()) is None
+
+def test_matches_probing():
+    managers = _managers(7,
+        clouds=[["osapi"], ["docker"], ["osapi", "docker"]],
+        loadbalancers=[["nginx"], ["tcp", "nginx"]])
+    ring = HashRing(managers)
+    for _ in range(500):
+        key = utils.random_key()
+        for cloud in [None, "osapi", "docker", "unknown"]:
+            for loadbalancer in [None, "nginx", "tcp"]:
+                assert ring.owner(key, cloud, loadbalancer) == \
+                    _probe(managers, key, cloud, loadbalancer)
+
+def test_moved():
+    managers = _managers(5)
+    old_ring = HashRing(managers)
+    joined = dict(managers)
+    joined.update(_managers(1))
+    new_ring = HashRing(joined)
+    items = dict([
+        (i, (utils.random_key(), None, None)) for i in range(200)
+    ])
+    moved = old_ring.moved(new_ring, items)
+    (new_manager,) = set(joined.keys()) - set(managers.keys())
+    for (item, (key, _, _)) in items.items():
+        if item in moved:
+            assert moved[item] == (old_ring.owner(key), new_manager)
+        else:
+            assert old_ring.owner(key) == new_ring.owner(key)
+    assert old_ring.moved(old_ring, items) == {}
@@ -35,3 +35,109 @@ def test_multi_endpoints_multiple_managers(endpoints, managers):
     for endpoint in endpoints:
         owners = [m for m in managers if m.endpoint_owned(endpoint)]
         assert len(owners) == 1
+
+def test_owner_holds_lease(endpoints, managers):
+    for endpoint in endpoints:
+        owners = [m for m in managers if m.endpoint_owned(endpoint)]
+        assert len(owners) == 1
+        assert endpoint.zkobj.manager == owners[0]._uuid
+
+def test_lease_waits_for_release(endpoint, managers):
+    # Someone else is still holding on to the endpoint.
+    assert endpoint.zkobj.acquire("previous")
+    assert not endpoint.zkobj.acquire("next")
+    owners = [m for m in managers if m.endpoint_owned(endpoint)]
+    assert len(owners) == 0
+
+    # Once they let go, the owner picks it up.
+    assert endpoint.zkobj.release("previous")
+    owners = [m for m in managers if m.endpoint_owned(endpoint)]
+    assert len(owners) == 1
+
+def test_lease_previous_session(zk_conn, endpoint):
+    from reactor.zookeeper.client import ZookeeperClient
+
+    # Our lease, but held by our previous session.
+    old_client = ZookeeperClient(zk_servers=["mock"])
+    old = endpoint.zkobj.__class__(old_client, endpoint.zkobj._path)
+    assert old.acquire("me")
+
+    # We take it over, so it survives the old session.
+    assert endpoint.zkobj.acquire("me")
+    assert endpoint.zkobj._get_child("manager")._owned()
+    old_client.disconnect()
+    assert endpoint.zkobj.manager == "me"
+    assert endpoint.zkobj.acquire("me")
+
+def test_release_only_ours(endpoint):
+    assert endpoint.zkobj.acquire("other")
+    assert not endpoint.zkobj.release("me")
+    assert endpoint.zkobj.manager == "other"
+    assert endpoint.zkobj.release("other")
+    assert not endpoint.zkobj.release("other")
+
+def test_lease_held_while_updating(endpoint, manager):
+    from reactor.threadpool import Job
+    assert manager.endpoint_owned(endpoint)
+
+    # An update from an earlier pass is still running.
+    job = Job(lambda: None, (), {})
+    manager._track_update(endpoint.uuid(), [], job)
+    manager._disown(endpoint.uuid())
+    manager._release_leases()
+    assert endpoint.zkobj.manager == manager._uuid
+
+    # Once it's done (and reaped), the lease goes.
+    job.run()
+    manager._reap_updates()
+    manager._release_leases()
+    assert endpoint.zkobj.manager != manager._uuid
+
+def test_update_not_reentrant(endpoint, manager):
+    from reactor.threadpool import Job
+    assert manager.endpoint_owned(endpoint)
+
+    manager.config.interval = 1
+
+    # An update from an earlier pass is still running.
+    job = Job(lambda: None, (), {})
+    manager._track_update(endpoint.uuid(), [], job)
+    manager._scheduler.mark(endpoint.uuid(), "state")
+    manager._update_endpoints({}, {})
+    assert manager._in_flight[endpoint.uuid()] == [([], job)]
+    assert endpoint.uuid() in manager._scheduler.due([endpoint.uuid()])
+
+    # Once it's done, the endpoint is updated again.
+    job.run()
+    manager._scheduler.mark(endpoint.uuid(), "state")
+    manager._update_endpoints({}, {})
+    assert not job in [other for (_, other) in
+                       manager._in_flight.get(endpoint.uuid(), [])]
+
+def test_incremental_handoff(zk_conn, endpoints, managers):
+    for m in managers:
+        for endpoint in endpoints:
+            m.endpoint_owned(endpoint)
+
+    # Remove a manager that owns something.
+    owned = lambda m: [e.uuid() for e in endpoints if m.endpoint_owned(e)]
+    leaving = [m for m in managers if owned(m)][0]
+    moved = owned(leaving)
+    remaining = [m for m in managers if m != leaving]
+    leaving.unserve()
+    zk_conn.sync()
+
+    # Only the moved endpoints were invalidated.
+    for m in remaining:
+        for endpoint in endpoints:
+            cached = endpoint.uuid() in m._uuid_to_owned
+            assert cached == (not endpoint.uuid() in moved)
+
+    # Everything has exactly one owner holding the lease.
+    for endpoint in endpoints:
+        owners = [m for m in remaining if m.endpoint_owned(endpoint)]
+        assert len(owners) == 1
+        assert endpoint.zkobj.manager == owners[0]._uuid
+
+    # The handoff is counted.
+    assert sum([m.stats()["endpoints_moved"] for m in remaining]) >= len(moved)
@@ -0,0 +1,99 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import time
+import threading
+
+from reactor import scheduler
+from reactor.scheduler import UpdateScheduler
+
+def test_new_then_idle():
+    s = UpdateScheduler(sweep=60)
+    assert s.due(["a"], now=0) == {"a": scheduler.NEW}
+    assert s.done("a", reason=scheduler.NEW, now=0) is None
+    assert s.due(["a"], now=1) == {}
+
+def test_sweep():
+    s = UpdateScheduler(sweep=60)
+    s.done("a", reason=scheduler.NEW, now=0)
+    assert s.due(["a"], now=59) == {}
+    assert s.next_wakeup() == 60
+    assert s.due(["a"], now=60) == {"a": scheduler.SWEEP}
+    assert s.done("a", reason=scheduler.SWEEP, now=60) == 60
+
+def test_declared_interval():
+    s = UpdateScheduler(sweep=60)
+    s.done("a", reason=scheduler.NEW, now=0, interval=2)
+    s.done("b", reason=scheduler.NEW, now=0, interval=30)
+    assert s.due(["a", "b"], now=1) == {}
+    assert s.due(["a", "b"], now=2) == {"a": scheduler.SWEEP}
+    s.done("a", reason=scheduler.SWEEP, now=2, interval=2)
+    assert s.info("a") == {"last": 2, "next": 4, "interval": 2}
+    assert s.next_wakeup() == 4
+
+def test_learned_interval():
+    s = UpdateScheduler(sweep=60)
+    s.done("a", reason=scheduler.METRICS, now=0, minimum=10)
+    assert s.info("a")["interval"] == 30
+    s.done("a", reason=scheduler.METRICS, now=1, minimum=10)
+    s.done("a", reason=scheduler.METRICS, now=2, minimum=10)
+    assert s.info("a")["interval"] == 10
+    s.done("a", reason=scheduler.SWEEP, now=12, minimum=10)
+    assert s.info("a")["interval"] == 20
+    for now in range(3):
+        s.done("a", reason=scheduler.SWEEP, now=now, minimum=10)
+    assert s.info("a")["interval"] == 60
+
+def test_mark_consumed():
+    s = UpdateScheduler(sweep=60)
+    s.done("a", reason=scheduler.NEW, now=0)
+    s.mark("a", scheduler.CONFIG)
+    s.mark("a", scheduler.STATE)
+    assert s.due(["a"], now=1) == {"a": scheduler.CONFIG}
+    assert s.due(["a"], now=2) == {}
+
+def test_mark_untracked():
+    s = UpdateScheduler(sweep=60)
+    s.mark("b", scheduler.CONFIG)
+    assert s.due(["a"], now=0) == {"a": scheduler.NEW}
+    assert s.due(["a", "b"], now=0) == {"a": scheduler.NEW, "b": scheduler.NEW}
+
+def test_forget():
+    s = UpdateScheduler(sweep=60)
+    s.done("a", reason=scheduler.NEW, now=0)
+    s.forget("a")
+    assert s.info("a") is None
+    assert s.next_wakeup() is None
+    assert s.due(["a"], now=60) == {"a": scheduler.NEW}
+    assert s.done("a", reason=scheduler.NEW, now=60) is None
+
+def test_wait_wakes_on_mark():
+    s = UpdateScheduler(sweep=60)
+    timer = threading.Timer(0.1, s.mark, args=("a", scheduler.CONFIRMED))
+    timer.start()
+    start = time.time()
+    s.wait(start + 10.0)
+    assert time.time() - start < 5.0
+    timer.join()
+
+def test_wait_deferred():
+    s = UpdateScheduler(sweep=60)
+    s.done("a", reason=scheduler.NEW, now=time.time())
+    s.mark("a", scheduler.SETTLING, wake=False)
+    start = time.time()
+    s.wait(start + 0.1)
+    assert time.time() - start >= 0.1
+    assert s.due(["a"]) == {"a": scheduler.SETTLING}
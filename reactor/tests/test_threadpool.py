@@ -0,0 +1,100 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+
+from reactor.threadpool import Threadpool
+
+def test_submit_join():
+    pool = Threadpool(max_workers=2)
+    job = pool.submit(lambda x, y=0: x + y, 1, y=2)
+    assert job.join() == 3
+    pool.clear()
+
+def test_join_raises():
+    pool = Threadpool(max_workers=1)
+    def fail():
+        raise ValueError("failed")
+    job = pool.submit(fail)
+    try:
+        job.join()
+        assert False
+    except ValueError:
+        pass
+    pool.clear()
+
+def test_bounded_workers():
+    pool = Threadpool(max_workers=2)
+    gate = threading.Event()
+    jobs = [pool.submit(gate.wait) for _ in range(10)]
+    assert pool.workers() == 2
+    gate.set()
+    for job in jobs:
+        job.join()
+    assert pool.workers() == 2
+    stats = pool.stats()
+    assert stats["started"] == 10
+    assert stats["depth"] == 0
+    pool.clear()
+
+def test_wait_timeout():
+    pool = Threadpool(max_workers=1)
+    gate = threading.Event()
+    job = pool.submit(gate.wait)
+    assert not job.wait(0.05)
+    assert not job.done()
+    gate.set()
+    assert job.wait(5.0)
+    assert job.done()
+    job.join()
+    pool.clear()
+
+def test_coalesce_queued():
+    pool = Threadpool(max_workers=1)
+    gate = threading.Event()
+    blocker = pool.submit(gate.wait)
+
+    # While the only worker is blocked, updates for the
+    # same key fold into a single job with the latest args.
+    first = pool.submit_keyed("a", lambda x: x, 1)
+    second = pool.submit_keyed("a", lambda x: x, 2)
+    other = pool.submit_keyed("b", lambda x: x, 3)
+    assert first is second
+    assert first is not other
+    assert pool.stats()["coalesced"] == 1
+
+    gate.set()
+    blocker.join()
+    assert first.join() == 2
+    assert other.join() == 3
+
+    # Once the job has been started, a new one is queued.
+    third = pool.submit_keyed("a", lambda x: x, 4)
+    assert third is not first
+    assert third.join() == 4
+    pool.clear()
+
+def test_resize():
+    pool = Threadpool(max_workers=4)
+    gate = threading.Event()
+    jobs = [pool.submit(gate.wait) for _ in range(4)]
+    assert pool.workers() == 4
+    pool.resize(1)
+    assert pool.workers() == 1
+    gate.set()
+    for job in jobs:
+        job.join()
+    assert pool.submit(lambda: 1).join() == 1
+    pool.clear()
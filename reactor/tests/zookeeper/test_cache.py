@@ -0,0 +1,59 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import uuid
+
+from reactor.zookeeper.cache import Mirror
+from reactor.zookeeper.objects import JSONObject
+
+def _parent(zk_client):
+    return JSONObject(zk_client, '/test/' + str(uuid.uuid4()))
+
+def test_mirror_existing(zk_conn, zk_client):
+    parent = _parent(zk_client)
+    parent._get_child("a")._set_data({"x": 1})
+    mirror = Mirror(parent)
+    assert mirror.as_map() == {"a": {"x": 1}}
+    assert mirror.get("a") == {"x": 1}
+    assert mirror.list() == ["a"]
+
+def test_mirror_changes(zk_conn, zk_client):
+    parent = _parent(zk_client)
+    parent._set_data()
+    mirror = Mirror(parent)
+    assert mirror.as_map() == {}
+
+    parent._get_child("a")._set_data({"x": 1})
+    zk_conn.sync()
+    assert mirror.as_map() == {"a": {"x": 1}}
+
+    parent._get_child("a")._set_data({"x": 2})
+    zk_conn.sync()
+    assert mirror.get("a") == {"x": 2}
+
+    parent._get_child("a")._delete()
+    zk_conn.sync()
+    assert mirror.as_map() == {}
+    assert mirror.get("a") is None
+
+def test_mirror_no_create(zk_conn, zk_client):
+    parent = _parent(zk_client)
+    parent._set_data()
+    mirror = Mirror(parent)
+
+    # A child that vanishes before it is watched is not recreated.
+    mirror.update(["gone"])
+    assert not zk_conn.exists(parent._path + "/gone")
+    assert mirror.as_map() == {}
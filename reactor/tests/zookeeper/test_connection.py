@@ -41,6 +41,9 @@ class FakeNodeExistsException(FakeZookeeperException):
 class FakeNoNodeException(FakeZookeeperException):
     pass
 
+class FakeBadVersionException(FakeZookeeperException):
+    pass
+
 mock_zookeeper_mod = mock.Mock(name="zookeeper")
 mock_zookeeper_mod.CONNECTED_STATE = 3
 mock_zookeeper_mod.INVALIDSTATE = -9
@@ -50,6 +53,9 @@ mock_zookeeper_mod.ZooKeeperException  = FakeZookeeperException
 mock_zookeeper_mod.BadArgumentsException = FakeBadArgumentsException
 mock_zookeeper_mod.NodeExistsException = FakeNodeExistsException
 mock_zookeeper_mod.NoNodeException = FakeNoNodeException
+mock_zookeeper_mod.BadVersionException = FakeBadVersionException
+mock_zookeeper_mod.OK = 0
+mock_zookeeper_mod.NONODE = -101
 
 # Fake data
 FAKE_ZK_HANDLE = 0x5a5a5a5a
@@ -266,6 +272,32 @@ class ConnectionTests(unittest.TestCase):
                     (FAKE_ZK_HANDLE, FAKE_ZK_PATH, FAKE_ZK_CONTENTS, [conn.acl], mock_zookeeper_mod.EPHEMERAL))
             self.assertEquals(mock_set.call_count, 0)
 
+    def test_write_existing_path_ephemeral_inplace(self):
+        with mock.patch("zookeeper.init") as mock_init,\
+                mock.patch("zookeeper.exists") as mock_exists,\
+                mock.patch("zookeeper.client_id") as mock_client_id,\
+                mock.patch("zookeeper.create") as mock_create,\
+                mock.patch("zookeeper.delete") as mock_delete,\
+                mock.patch("zookeeper.set") as mock_set:
+            mock_init.side_effect = mock_zookeeper_init()
+            conn = connection.ZookeeperConnection(FAKE_SERVERS)
+            mock_client_id.return_value = (FAKE_ZK_HANDLE, "")
+            mock_exists.return_value = {"ephemeralOwner": FAKE_ZK_HANDLE}
+            written = conn.write(FAKE_ZK_PATH, FAKE_ZK_CONTENTS, ephemeral=True, inplace=True)
+            self.assertTrue(written)
+            # Our own node is updated in place.
+            self.assertEquals(mock_set.call_count, 1)
+            self.assertEquals(mock_delete.call_count, 0)
+            self.assertEquals(mock_create.call_count, 0)
+
+            # A node from another session is re-created.
+            mock_exists.return_value = {"ephemeralOwner": FAKE_ZK_HANDLE + 1}
+            written = conn.write(FAKE_ZK_PATH, FAKE_ZK_CONTENTS, ephemeral=True, inplace=True)
+            self.assertTrue(written)
+            self.assertEquals(mock_set.call_count, 1)
+            self.assertEquals(mock_delete.call_count, 1)
+            self.assertEquals(mock_create.call_count, 1)
+
     def test_write_existing_path_ephemeral_exclusive(self):
         with mock.patch("zookeeper.init") as mock_init,\
                 mock.patch("zookeeper.exists") as mock_exists,\
@@ -320,12 +352,12 @@ class ConnectionTests(unittest.TestCase):
                 mock.patch("zookeeper.get") as mock_get:
             mock_init.side_effect = mock_zookeeper_init()
             conn = connection.ZookeeperConnection(FAKE_SERVERS)
-            mock_exists.return_value = False
+            mock_get.side_effect = FakeNoNodeException()
             val = conn.read(FAKE_ZK_PATH, GARBAGE)
             self.assertEquals(val, GARBAGE)
-            self.assertEquals(mock_exists.call_count, 1)
-            self.assertEquals(mock_exists.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
-            self.assertEquals(mock_get.call_count, 0)
+            self.assertEquals(mock_exists.call_count, 0)
+            self.assertEquals(mock_get.call_count, 1)
+            self.assertEquals(mock_get.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
 
     def test_read_existing_path(self):
         with mock.patch("zookeeper.init") as mock_init,\
@@ -333,29 +365,55 @@ class ConnectionTests(unittest.TestCase):
                 mock.patch("zookeeper.get") as mock_get:
             mock_init.side_effect = mock_zookeeper_init()
             conn = connection.ZookeeperConnection(FAKE_SERVERS)
-            mock_exists.return_value = True
             mock_get.return_value = (FAKE_ZK_CONTENTS, GARBAGE)
             val = conn.read(FAKE_ZK_PATH, GARBAGE)
             self.assertEquals(val, FAKE_ZK_CONTENTS)
-            self.assertEquals(mock_exists.call_count, 1)
-            self.assertEquals(mock_exists.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
+            self.assertEquals(mock_exists.call_count, 0)
             self.assertEquals(mock_get.call_count, 1)
             self.assertEquals(mock_get.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
 
-    def test_read_disappearing_path(self):
+    def test_read_many(self):
+        def _aget(handle, path, watcher, completion):
+            # Complete out of order, and lose one node.
+            if path.endswith("bar"):
+                completion(handle, mock_zookeeper_mod.NONODE, None, None)
+            else:
+                thread.start_new_thread(
+                    completion, (handle, mock_zookeeper_mod.OK, path, None))
         with mock.patch("zookeeper.init") as mock_init,\
-                mock.patch("zookeeper.exists") as mock_exists,\
-                mock.patch("zookeeper.get") as mock_get:
+                mock.patch("zookeeper.aget") as mock_aget:
             mock_init.side_effect = mock_zookeeper_init()
+            mock_aget.side_effect = _aget
             conn = connection.ZookeeperConnection(FAKE_SERVERS)
-            mock_exists.return_value = True
-            mock_get.side_effect = FakeNoNodeException()
-            val = conn.read(FAKE_ZK_PATH, GARBAGE)
-            self.assertEquals(val, GARBAGE)
-            self.assertEquals(mock_exists.call_count, 1)
-            self.assertEquals(mock_exists.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
-            self.assertEquals(mock_get.call_count, 1)
-            self.assertEquals(mock_get.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
+            paths = [FAKE_ZK_PATH + "/" + child for child in FAKE_ZK_CHILDREN]
+            val = conn.read_many(paths)
+            self.assertEquals(val, {paths[0]: paths[0]})
+            self.assertEquals(mock_aget.call_count, len(paths))
+
+    def test_read_many_error(self):
+        def _aget(handle, path, watcher, completion):
+            completion(handle, -4, None, None)
+        with mock.patch("zookeeper.init") as mock_init,\
+                mock.patch("zookeeper.aget") as mock_aget:
+            mock_init.side_effect = mock_zookeeper_init()
+            mock_aget.side_effect = _aget
+            conn = connection.ZookeeperConnection(FAKE_SERVERS)
+            with self.assertRaises(FakeZookeeperException):
+                conn.read_many([FAKE_ZK_PATH])
+
+    def test_read_children(self):
+        def _aget(handle, path, watcher, completion):
+            completion(handle, mock_zookeeper_mod.OK, FAKE_ZK_CONTENTS, None)
+        with mock.patch("zookeeper.init") as mock_init,\
+                mock.patch("zookeeper.get_children") as mock_get,\
+                mock.patch("zookeeper.aget") as mock_aget:
+            mock_init.side_effect = mock_zookeeper_init()
+            mock_get.return_value = FAKE_ZK_CHILDREN
+            mock_aget.side_effect = _aget
+            conn = connection.ZookeeperConnection(FAKE_SERVERS)
+            val = conn.read_children(FAKE_ZK_PATH)
+            self.assertEquals(val, dict([
+                (child, FAKE_ZK_CONTENTS) for child in FAKE_ZK_CHILDREN]))
 
     def test_list_children_with_bad_args(self):
         with mock.patch("zookeeper.init") as mock_init:
@@ -370,12 +428,12 @@ class ConnectionTests(unittest.TestCase):
                 mock.patch("zookeeper.get_children") as mock_get:
             mock_init.side_effect = mock_zookeeper_init()
             conn = connection.ZookeeperConnection(FAKE_SERVERS)
-            mock_exists.return_value = False
+            mock_get.side_effect = FakeNoNodeException()
             val = conn.list_children(FAKE_ZK_PATH)
             self.assertEquals(val, [])
-            self.assertEquals(mock_exists.call_count, 1)
-            self.assertEquals(mock_exists.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
-            self.assertEquals(mock_get.call_count, 0)
+            self.assertEquals(mock_exists.call_count, 0)
+            self.assertEquals(mock_get.call_count, 1)
+            self.assertEquals(mock_get.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
 
     def test_list_children_existing_path(self):
         with mock.patch("zookeeper.init") as mock_init,\
@@ -383,27 +441,10 @@ class ConnectionTests(unittest.TestCase):
                 mock.patch("zookeeper.get_children") as mock_get:
             mock_init.side_effect = mock_zookeeper_init()
             conn = connection.ZookeeperConnection(FAKE_SERVERS)
-            mock_exists.return_value = True
             mock_get.return_value = FAKE_ZK_CHILDREN
             val = conn.list_children(FAKE_ZK_PATH)
             self.assertEquals(val, FAKE_ZK_CHILDREN)
-            self.assertEquals(mock_exists.call_count, 1)
-            self.assertEquals(mock_exists.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
-            self.assertEquals(mock_get.call_count, 1)
-            self.assertEquals(mock_get.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
-
-    def test_list_children_disappearing_path(self):
-        with mock.patch("zookeeper.init") as mock_init,\
-                mock.patch("zookeeper.exists") as mock_exists,\
-                mock.patch("zookeeper.get_children") as mock_get:
-            mock_init.side_effect = mock_zookeeper_init()
-            conn = connection.ZookeeperConnection(FAKE_SERVERS)
-            mock_exists.return_value = True
-            mock_get.side_effect = FakeNoNodeException()
-            val = conn.list_children(FAKE_ZK_PATH)
-            self.assertEquals(val, [])
-            self.assertEquals(mock_exists.call_count, 1)
-            self.assertEquals(mock_exists.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
+            self.assertEquals(mock_exists.call_count, 0)
             self.assertEquals(mock_get.call_count, 1)
             self.assertEquals(mock_get.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
 
@@ -421,14 +462,34 @@ class ConnectionTests(unittest.TestCase):
                 mock.patch("zookeeper.delete") as mock_delete:
             mock_init.side_effect = mock_zookeeper_init()
             conn = connection.ZookeeperConnection(FAKE_SERVERS)
-            mock_exists.return_value = False
+            mock_get.side_effect = FakeNoNodeException()
             conn.delete(FAKE_ZK_PATH)
-            self.assertEquals(mock_exists.call_count, 1)
-            self.assertEquals(mock_exists.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
-            self.assertEquals(mock_get.call_count, 0)
+            self.assertEquals(mock_exists.call_count, 0)
+            self.assertEquals(mock_get.call_count, 1)
             self.assertEquals(mock_delete.call_count, 1)
             self.assertEquals(mock_delete.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
 
+    def test_delete_version(self):
+        with mock.patch("zookeeper.init") as mock_init,\
+                mock.patch("zookeeper.get_children") as mock_get,\
+                mock.patch("zookeeper.delete") as mock_delete:
+            mock_init.side_effect = mock_zookeeper_init()
+            conn = connection.ZookeeperConnection(FAKE_SERVERS)
+            self.assertTrue(conn.delete(FAKE_ZK_PATH, version=3))
+            self.assertEquals(mock_get.call_count, 0)
+            self.assertEquals(mock_delete.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH, 3))
+
+    def test_delete_bad_version(self):
+        with mock.patch("zookeeper.init") as mock_init,\
+                mock.patch("zookeeper.get_children") as mock_get,\
+                mock.patch("zookeeper.delete") as mock_delete:
+            mock_init.side_effect = mock_zookeeper_init()
+            conn = connection.ZookeeperConnection(FAKE_SERVERS)
+            mock_delete.side_effect = FakeBadVersionException()
+            self.assertFalse(conn.delete(FAKE_ZK_PATH, version=3))
+            self.assertEquals(mock_get.call_count, 0)
+            self.assertEquals(mock_delete.call_count, 1)
+
     def test_delete_existing_path(self):
         with mock.patch("zookeeper.init") as mock_init,\
                 mock.patch("zookeeper.exists") as mock_exists,\
@@ -436,11 +497,9 @@ class ConnectionTests(unittest.TestCase):
                 mock.patch("zookeeper.delete") as mock_delete:
             mock_init.side_effect = mock_zookeeper_init()
             conn = connection.ZookeeperConnection(FAKE_SERVERS)
-            mock_exists.return_value = True
             mock_get.return_value = []
             conn.delete(FAKE_ZK_PATH)
-            self.assertEquals(mock_exists.call_count, 1)
-            self.assertEquals(mock_exists.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
+            self.assertEquals(mock_exists.call_count, 0)
             self.assertEquals(mock_get.call_count, 1)
             self.assertEquals(mock_delete.call_count, 1)
             self.assertEquals(mock_delete.call_args_list[0][0], (FAKE_ZK_HANDLE, FAKE_ZK_PATH))
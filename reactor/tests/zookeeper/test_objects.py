@@ -96,3 +96,16 @@ def test_delete(zk_conn, zk_object):
     assert not zk_conn.exists(zk_object._path)
     zk_object._set_data(None)
     assert zk_conn.exists(zk_object._path)
+
+def test_delete_version(zk_conn, zk_object):
+    zk_object._set_data(_test_obj(zk_object))
+    (data, stat) = zk_object._get_data_stat()
+    assert data == _test_obj(zk_object)
+    # The node has changed since we read it.
+    zk_object._set_data(_test_obj(zk_object))
+    assert not zk_object._delete(version=stat["version"])
+    assert zk_conn.exists(zk_object._path)
+    (_, stat) = zk_object._get_data_stat()
+    assert zk_object._delete(version=stat["version"])
+    assert not zk_conn.exists(zk_object._path)
+    assert zk_object._get_data_stat() == (zk_object._deserialize(None), None)
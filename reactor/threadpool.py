@@ -14,10 +14,15 @@
 #    under the License.
 
 import sys
+import time
 import threading
+import collections
 
 from . atomic import Atomic
 
+# The default bound on the number of workers.
+DEFAULT_WORKERS = 16
+
 class Worker(threading.Thread):
 
     def __init__(self, queue):
@@ -35,15 +40,27 @@ class Worker(threading.Thread):
 
 class Job(object):
 
-    def __init__(self, fn, args, kwargs):
+    def __init__(self, fn, args, kwargs, key=None):
         super(Job, self).__init__()
         self._fn = fn
         self._args = args
         self._kwargs = kwargs
+        self._key = key
         self._cond = threading.Condition()
         self._exc_info = None
         self._returnval = None
         self._done = False
+        self._submitted = time.time()
+
+    def key(self):
+        return self._key
+
+    def replace(self, fn, args, kwargs):
+        # NOTE: This is only safe to call while the job
+        # is still sitting in the queue (see Queue.push()).
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
 
     def run(self):
         assert not self._done
@@ -60,6 +77,32 @@ class Job(object):
             self._cond.notifyAll()
             self._cond.release()
 
+    def done(self):
+        self._cond.acquire()
+        try:
+            return self._done
+        finally:
+            self._cond.release()
+
+    def wait(self, timeout=None):
+        # Wait for the job to finish (for at most the timeout).
+        # Returns whether it is done, the result is from join().
+        self._cond.acquire()
+        try:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._done:
+                if timeout is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._done
+        finally:
+            self._cond.release()
+
     def join(self):
         self._cond.acquire()
         try:
@@ -79,14 +122,51 @@ class Queue(object):
         super(Queue, self).__init__()
         self._cond = threading.Condition()
         self._waiting = 0
-        self._jobs = []
+        self._jobs = collections.deque()
+
+        # Jobs that are still queued, by key.
+        # A job submitted with the same key as a job that has
+        # not yet started is folded into the existing job.
+        self._keyed = {}
+
+        # Statistics.
+        self._submitted = 0
+        self._coalesced = 0
+        self._completed = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
 
     def push(self, job):
         self._cond.acquire()
         try:
+            if job is None:
+                self._jobs.append(None)
+                return None
+            key = job.key()
+            if key is not None and key in self._keyed:
+                # Fold this work into the queued job. The caller
+                # gets back the existing job, and the newest
+                # arguments win (older ones are stale anyway).
+                existing = self._keyed[key]
+                existing.replace(job._fn, job._args, job._kwargs)
+                self._coalesced += 1
+                return existing
+            if key is not None:
+                self._keyed[key] = job
             self._jobs.append(job)
+            self._submitted += 1
+            return job
         finally:
-            self._cond.notifyAll()
+            # Only one worker can pick this up.
+            self._cond.notify()
+            self._cond.release()
+
+    def push_front(self, job):
+        self._cond.acquire()
+        try:
+            self._jobs.appendleft(job)
+        finally:
+            self._cond.notify()
             self._cond.release()
 
     def spare(self):
@@ -99,23 +179,58 @@ class Queue(object):
         finally:
             self._cond.release()
 
+    def depth(self):
+        self._cond.acquire()
+        try:
+            return len(self._jobs)
+        finally:
+            self._cond.release()
+
     def pop(self):
         self._cond.acquire()
         try:
             self._waiting += 1
             while len(self._jobs) == 0:
                 self._cond.wait()
-            return self._jobs.pop(0)
+            job = self._jobs.popleft()
+            if job is not None:
+                key = job.key()
+                if key is not None and self._keyed.get(key) is job:
+                    del self._keyed[key]
+                wait = time.time() - job._submitted
+                self._completed += 1
+                self._total_wait += wait
+                self._max_wait = max(self._max_wait, wait)
+            return job
         finally:
             self._waiting -= 1
             self._cond.release()
 
+    def stats(self):
+        self._cond.acquire()
+        try:
+            if self._completed > 0:
+                avg_wait = self._total_wait / self._completed
+            else:
+                avg_wait = 0.0
+            return {
+                "depth": len(self._jobs),
+                "submitted": self._submitted,
+                "coalesced": self._coalesced,
+                "started": self._completed,
+                "avg_wait": avg_wait,
+                "max_wait": self._max_wait,
+            }
+        finally:
+            self._cond.release()
+
 class Threadpool(Atomic):
 
-    def __init__(self):
+    def __init__(self, max_workers=DEFAULT_WORKERS):
         super(Threadpool, self).__init__()
         self._queue = Queue()
         self._workers = 0
+        self._max_workers = max_workers
 
     def __del__(self):
         self.clear()
@@ -126,15 +241,47 @@ class Threadpool(Atomic):
             self._queue.push(None)
         self._workers = 0
 
+    @Atomic.sync
+    def resize(self, max_workers):
+        # Shrink the pool by retiring excess workers. The
+        # sentinels go to the front so that workers exit
+        # promptly rather than after the current backlog.
+        self._max_workers = max_workers
+        while self._workers > max(max_workers, 0):
+            self._queue.push_front(None)
+            self._workers -= 1
+
     @Atomic.sync
     def new_worker(self):
+        # We never grow beyond the bound. Once every worker
+        # is busy, jobs simply wait in the queue.
+        if self._workers >= self._max_workers:
+            return
         self._workers += 1
         w = Worker(self._queue)
         w.start()
 
+    @Atomic.sync
+    def workers(self):
+        return self._workers
+
+    def stats(self):
+        stats = self._queue.stats()
+        stats["workers"] = self.workers()
+        stats["max_workers"] = self._max_workers
+        return stats
+
     def submit(self, fn, *args, **kwargs):
         job = Job(fn, args, kwargs)
         if self._queue.spare() == 0:
             self.new_worker()
-        self._queue.push(job)
-        return job
+        return self._queue.push(job)
+
+    def submit_keyed(self, key, fn, *args, **kwargs):
+        # Like submit(), but work for the same key is coalesced
+        # while it is queued. If a job for this key has not yet
+        # started, the returned job is that one (with the new args).
+        job = Job(fn, args, kwargs, key=key)
+        if self._queue.spare() == 0:
+            self.new_worker()
+        return self._queue.push(job)
@@ -116,3 +116,95 @@ class Cache(Atomic):
 
     def __repr__(self):
         return "cache[%s]" % self.zkobj._path
+
+class Mirror(Cache):
+
+    """
+    A cache that holds the contents of every child node.
+
+    Unlike the plain Cache, which populates lazily on get(), the mirror
+    places a content watch on each child as it appears. The in-memory
+    copy is therefore always fresh, and a child is only re-read when
+    its contents actually change.
+
+    An optional merge hook may be given, which is called as
+    merge(name, current, value) and returns the value to hold.
+    """
+
+    def __init__(self, zkobj, clazz=None, update=None, merge=None):
+        self._clazz = clazz
+        if merge is None:
+            self._merge = lambda name, current, value: value
+        else:
+            self._merge = merge
+        self._children = {}
+        self._watches = {}
+        super(Mirror, self).__init__(zkobj, update=update)
+        self.as_map = self._as_map
+
+        # Start watching all existing children.
+        self._refresh()
+
+    @Atomic.sync
+    def _diff_children(self):
+        added = [name for name in self._index if not name in self._children]
+        removed = [
+            (name, self._children[name])
+            for name in self._children.keys()
+            if not name in self._index
+        ]
+        for name in added:
+            self._children[name] = self._get_child(name, clazz=self._clazz)
+            self._watches[name] = self._make_watch(name)
+        for (name, _) in removed:
+            del self._children[name]
+            del self._watches[name]
+            if name in self._cache:
+                del self._cache[name]
+        return (
+            [(name, self._children[name], self._watches[name]) for name in added],
+            [child for (_, child) in removed])
+
+    def _make_watch(self, name):
+        def _watch(value):
+            self._changed(name, value)
+        _watch.__name__ = "mirror_%s" % name
+        return _watch
+
+    @Atomic.sync
+    def _changed(self, name, value):
+        # Ignore any stray events for removed children.
+        if name in self._children:
+            self._cache[name] = self._merge(name, self._cache.get(name), value)
+
+    def _refresh(self):
+        # NOTE: We can't be holding our lock while we set
+        # or clear watches (see the note in manager.py), so
+        # the child diff is computed above and acted on here.
+        (added, removed) = self._diff_children()
+        for child in removed:
+            child._unwatch()
+        for (name, child, watch) in added:
+            value = child._get_data(watch=watch, create=False)
+            if value is not None:
+                self._changed(name, value)
+
+    def update(self, values):
+        changed = self._update(values)
+        self._refresh()
+        if changed:
+            self._update_hook()
+
+    def get(self, name, **kwargs):
+        return self._get_value(name)
+
+    @Atomic.sync
+    def _get_value(self, name):
+        return self._cache.get(name)
+
+    @Atomic.sync
+    def _as_map(self):
+        return self._cache.copy()
+
+    def __repr__(self):
+        return "mirror[%s]" % self.zkobj._path
@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import time
 import logging
 import threading
 import traceback
@@ -22,6 +23,7 @@ from reactor.log import log
 
 ZOO_OPEN_ACL_UNSAFE = {"perms":0x1f, "scheme":"world", "id":"anyone"}
 ZOO_CONNECT_WAIT_TIME = 10.0
+ZOO_BULK_READ_WAIT_TIME = 30.0
 
 # Save the exception for use in other modules.
 ZookeeperException = zookeeper.ZooKeeperException
@@ -135,7 +137,27 @@ class ZookeeperConnection(object):
     def silence(self):
         zookeeper.set_debug_level(zookeeper.LOG_LEVEL_ERROR)
 
-    def _write(self, path, contents, ephemeral, exclusive, sequential, mustexist):
+    @log
+    @wrap_exceptions
+    def session_id(self):
+        """
+        Returns the id of our current session (as in ephemeralOwner).
+        """
+        return zookeeper.client_id(self.handle)[0]
+
+    @log
+    @wrap_exceptions
+    def owned(self, path, stat=None):
+        """
+        Return whether the path is an ephemeral node held by our session.
+        If the stat is given (from read_stat()), it is used as is.
+        """
+        if stat is None:
+            stat = zookeeper.exists(self.handle, path)
+        return bool(stat) and \
+            stat.get("ephemeralOwner") == self.session_id()
+
+    def _write(self, path, contents, ephemeral, exclusive, sequential, mustexist, inplace):
         # We start from the second element because we do not want to inclued
         # the initial empty string before the first "/" because all paths begin
         # with "/". We also don't want to include the final node because that
@@ -164,7 +186,12 @@ class ZookeeperConnection(object):
 
         # We make sure that we have the creation flags for ephemeral nodes,
         # otherwise they could be associated with previous connections that
-        # have not yet timed out.
+        # have not yet timed out. If asked, a node that belongs to our
+        # current session is simply updated in place.
+        if ephemeral and exists and inplace and \
+            exists.get("ephemeralOwner") == self.session_id():
+            zookeeper.set(self.handle, path, contents)
+            return path
         if ephemeral and exists:
             try:
                 zookeeper.delete(self.handle, path)
@@ -194,7 +221,8 @@ class ZookeeperConnection(object):
         ephemeral=False,
         exclusive=False,
         sequential=False,
-        mustexist=False):
+        mustexist=False,
+        inplace=False):
 
         """
         Writes the contents to the path in zookeeper. It will create the path in
@@ -203,6 +231,10 @@ class ZookeeperConnection(object):
         This method will return the path if the value is written, False otherwise.
         (The value will not be written if the exclusive is True and the node
         already exists.)
+
+        Ephemeral nodes are normally deleted and recreated. With inplace, a
+        node that already belongs to our session is updated instead (so
+        that watchers do not see it disappear).
         """
         if not(path) or contents is None:
             raise BadArgumentsException("Invalid path/contents: %s/%s" % (path, contents))
@@ -215,7 +247,8 @@ class ZookeeperConnection(object):
                                    ephemeral=ephemeral,
                                    exclusive=exclusive,
                                    sequential=sequential,
-                                   mustexist=mustexist)
+                                   mustexist=mustexist,
+                                   inplace=inplace)
             except zookeeper.NodeExistsException:
                 # If we're writing to an exclusive path, then the caller lost
                 # to another thread/writer. Else, retry.
@@ -239,42 +272,134 @@ class ZookeeperConnection(object):
         if not path:
             raise BadArgumentsException("Invalid path: %s" % (path))
 
-        value = default
-        if zookeeper.exists(self.handle, path):
-            try:
-                value, _ = zookeeper.get(self.handle, path)
-            except zookeeper.NoNodeException:
-                pass
+        # NOTE: We don't probe with exists() first. A missing
+        # node costs us exactly the same single round trip.
+        try:
+            value, _ = zookeeper.get(self.handle, path)
+        except zookeeper.NoNodeException:
+            value = default
 
         return value
 
+    @log
+    @wrap_exceptions
+    def read_stat(self, path):
+        """
+        Returns the contents in the path along with its stat (both from
+        the same read), or (None, None) if the path does not exist.
+        """
+        if not path:
+            raise BadArgumentsException("Invalid path: %s" % (path))
+
+        try:
+            return zookeeper.get(self.handle, path)
+        except zookeeper.NoNodeException:
+            return (None, None)
+
+    @log
+    @wrap_exceptions
+    def read_many(self, paths):
+        """
+        Returns a map of path -> contents for all the given paths. The reads
+        are pipelined, so this costs roughly one round trip regardless of the
+        number of paths. Paths that do not exist (or that vanish while the
+        read is in flight) are simply omitted from the result.
+        """
+        paths = list(paths)
+        if len(paths) == 0:
+            return {}
+
+        cond = threading.Condition()
+        results = {}
+        errors = []
+        outstanding = [len(paths)]
+
+        def make_completion(path):
+            def completion(zh, rc, value, stat):
+                cond.acquire()
+                try:
+                    if rc == zookeeper.OK:
+                        results[path] = value
+                    elif rc != zookeeper.NONODE:
+                        errors.append((path, rc))
+                    outstanding[0] -= 1
+                    if outstanding[0] == 0:
+                        cond.notify()
+                finally:
+                    cond.release()
+            return completion
+
+        cond.acquire()
+        try:
+            for path in paths:
+                zookeeper.aget(self.handle, path, None, make_completion(path))
+            deadline = time.time() + ZOO_BULK_READ_WAIT_TIME
+            while outstanding[0] > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    # We haven't heard back after a very long time.
+                    # The handle is probably dead, so bail out.
+                    raise ZookeeperException(
+                        "Timed out reading %d paths." % outstanding[0])
+                cond.wait(remaining)
+        finally:
+            cond.release()
+
+        if errors:
+            raise ZookeeperException("Error reading %s: %s" % errors[0])
+
+        return results
+
+    @log
+    @wrap_exceptions
+    def read_children(self, path):
+        """
+        Returns a map of child -> contents for all the children of path.
+        Children that disappear between listing and reading are omitted.
+        """
+        children = self.list_children(path)
+        contents = self.read_many(
+            [path + "/" + child for child in children])
+        result = {}
+        for child in children:
+            child_path = path + "/" + child
+            if child_path in contents:
+                result[child] = contents[child_path]
+        return result
+
     @log
     @wrap_exceptions
     def list_children(self, path):
         """
-        Returns a list of all the children nodes in the path. None is returned if the path does
-        not exist.
+        Returns a list of all the children nodes in the path. An empty list
+        is returned if the path does not exist.
         """
         if not path:
             raise BadArgumentsException("Invalid path: %s" % (path))
 
-        if zookeeper.exists(self.handle, path):
-            try:
-                value = zookeeper.get_children(self.handle, path)
-                return value
-            except zookeeper.NoNodeException:
-                pass
-        return []
+        try:
+            return zookeeper.get_children(self.handle, path)
+        except zookeeper.NoNodeException:
+            return []
 
     @log
     @wrap_exceptions
-    def delete(self, path):
+    def delete(self, path, version=None):
         """
-        Delete the path.
+        Delete the path. If a version is given, then only that node is
+        deleted and only if it is still at that version (returns whether
+        it was deleted).
         """
         if not path:
             raise BadArgumentsException("Invalid path: %s" % (path))
 
+        if version is not None:
+            try:
+                zookeeper.delete(self.handle, path, version)
+                return True
+            except (zookeeper.NoNodeException, zookeeper.BadVersionException):
+                return False
+
         path_children = self.list_children(path)
         for child in path_children:
             try:
@@ -288,11 +413,15 @@ class ZookeeperConnection(object):
 
     @log
     @wrap_exceptions
-    def watch_contents(self, path, fn, default_value="", clean=False):
+    def watch_contents(self, path, fn, default_value="", clean=False, create=True):
         if not (path and fn):
             raise BadArgumentsException("Invalid path/fn: %s/%s" % (path, fn))
 
         if not zookeeper.exists(self.handle, path):
+            # NOTE: Watches on ephemeral nodes should not
+            # create them (they would then stick around forever).
+            if not create:
+                return None
             self.write(path, default_value)
 
         self.cond.acquire()
@@ -301,7 +430,13 @@ class ZookeeperConnection(object):
                 self.content_watches[path] = []
             if not(fn in self.content_watches.get(path, [])):
                 self.content_watches[path] = self.content_watches.get(path, []) + [fn]
-            value, _ = zookeeper.get(self.handle, path, self.zookeeper_watch)
+            try:
+                value, _ = zookeeper.get(self.handle, path, self.zookeeper_watch)
+            except zookeeper.NoNodeException:
+                if create:
+                    raise
+                self.content_watches[path].remove(fn)
+                value = None
         finally:
             self.cond.release()
         return value
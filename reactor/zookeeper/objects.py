@@ -78,7 +78,7 @@ class ZookeeperObject(object):
     def _deserialize(self, data):
         raise NotImplementedError()
 
-    def _get_data(self, watch=None):
+    def _get_data(self, watch=None, create=True):
         client = self._zk_client.connect()
         if watch:
             with self._lock:
@@ -90,10 +90,17 @@ class ZookeeperObject(object):
                     client.clear_watch_fn(self._watch_content)
                 self._watch_content = _fn
                 return self._deserialize(
-                    client.watch_contents(self._path, self._watch_content))
+                    client.watch_contents(
+                        self._path, self._watch_content, create=create))
         else:
             return self._deserialize(client.read(self._path))
 
+    def _get_data_stat(self):
+        # Returns (data, stat) from a single read (the stat is None
+        # if the node does not exist, see ZookeeperConnection.read_stat).
+        (value, stat) = self._zk_client.connect().read_stat(self._path)
+        return (self._deserialize(value), stat)
+
     def _set_data(self, value="", **kwargs):
         return self._zk_client.connect().write(
             self._path, self._serialize(value), **kwargs)
@@ -113,15 +120,31 @@ class ZookeeperObject(object):
         else:
             return client.list_children(self._path) or []
 
+    def _get_children_data(self, clazz=None):
+        # Read all children in a single pipelined pass.
+        # Children that disappear mid-read are omitted.
+        client = self._zk_client.connect()
+        if clazz is None:
+            deserialize = self._deserialize
+        else:
+            deserialize = clazz(self._zk_client, self._path)._deserialize
+        return dict([
+            (child, deserialize(value))
+            for (child, value) in client.read_children(self._path).items()
+        ])
+
     def _get_child(self, child, clazz=None):
         if clazz is None:
             return self.__class__(self._zk_client, path=os.path.join(self._path, child))
         else:
             return clazz(self._zk_client, path=os.path.join(self._path, child))
 
-    def _delete(self):
+    def _delete(self, version=None):
         client = self._zk_client.connect()
-        client.delete(self._path)
+        return client.delete(self._path, version=version)
+
+    def _owned(self, stat=None):
+        return self._zk_client.connect().owned(self._path, stat=stat)
 
 class DatalessObject(ZookeeperObject):
 
@@ -181,7 +204,7 @@ class Collection(DatalessObject):
         self._delete()
 
     def as_map(self):
-        return dict(map(lambda x: (x, self.get(x)), self.list()))
+        return self._get_children_data(clazz=JSONObject)
 
     def lock(self, items, value=None):
         locked = self.list()
@@ -66,6 +66,7 @@ setup(
     package_data={
         "reactor.loadbalancer.nginx" : [
             "nginx.template",
+            "upstreams.template",
             "reactor.conf"
         ],
         "reactor.loadbalancer.haproxy" : [